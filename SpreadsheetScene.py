@@ -3,9 +3,13 @@
 #
 # Main code file -- contains top-level UI for spreadsheet app
 import os
+import sys
 
 from data_visualization import ChartData, ChartType
 from formulae import Cell
+from formulae.engine import SheetEngine
+from formulae.workbook import readWorkbook
+from formulae.worker import EngineWorker
 from modular_graphics import UIElement, App
 from modular_graphics.atomic_elements import Rectangle
 from ui_components import SpreadsheetGrid, Confirmation, FileSelector, Toolbar, \
@@ -16,7 +20,7 @@ from utils import splitEscapedString
 class SpreadsheetScene(UIElement):
     kChartDelimiter = '/'
 
-    def __init__(self):
+    def __init__(self, useEngineWorker=False):
         # TODO: This could probably be even bigger
         super().__init__('scene', 0, 0, {})
         self.kGridX = 5
@@ -25,6 +29,12 @@ class SpreadsheetScene(UIElement):
         self.height = 750
         self.sheets = [Sheet.defaultEmpty()]
         self.activeSheet = 0
+        Cell.setEngine(self.sheets[0].engine)
+        # only compute what's on screen (and what that reads) as cells change
+        Cell.setLazyEvaluation(True)
+        # optionally, recalculate on a worker thread rather than the UI's
+        self.engineWorker = (EngineWorker(App.lock) if useEngineWorker
+                             else None)
 
     def initChildren(self):
         self.makeKeyListener()
@@ -42,7 +52,8 @@ class SpreadsheetScene(UIElement):
 
         gridX = self.kGridX
         gridY = toolbar.getHeight() + 10
-        grid = SpreadsheetGrid('grid', gridX, gridY)
+        grid = SpreadsheetGrid('grid', gridX, gridY,
+                               engineWorker=self.engineWorker)
         self.appendChild(grid)
 
         # UI scaffolding to hide off-screen charts
@@ -104,7 +115,9 @@ class SpreadsheetScene(UIElement):
             self.openSheet(sheetIndex)
 
     def openSheet(self, sheetIndex):
-        Cell.loadRawCells(self.sheets[sheetIndex].cells)
+        # every sheet stays loaded in its own engine, so this doesn't have to
+        # re-parse (or recompute) anything
+        Cell.setEngine(self.sheets[sheetIndex].engine)
         self.getChild('grid').reload(self.sheets[sheetIndex].charts)
         self.activeSheet = sheetIndex
         self.getChild('sheet-select').props['active'] = sheetIndex
@@ -113,9 +126,9 @@ class SpreadsheetScene(UIElement):
         self.getChild('sheet-select').refresh()
 
     # loads the modified sheet contents into the app-level sheets list
+    # (cells are already there, in the sheet's engine)
     def storeCurrentSheet(self):
         self.sheets[self.activeSheet].charts = self.getChild('grid').charts
-        self.sheets[self.activeSheet].cells = Cell.getRawCells()
 
     def deleteSheet(self, index):
         if index > self.activeSheet:
@@ -136,7 +149,7 @@ class SpreadsheetScene(UIElement):
         isUnmodified = len(self.sheets) == 1
         if isUnmodified:
             firstSheetUnmodified = (len(self.sheets[0].charts) == 0
-                                    and len(self.sheets[0].cells) == 0)
+                                    and self.sheets[0].engine.empty())
             isUnmodified = isUnmodified and firstSheetUnmodified
 
         if not isUnmodified:
@@ -211,43 +224,28 @@ class SpreadsheetScene(UIElement):
             return
 
         try:
-            with open(path, 'r') as file:
-                # note -- we want to get empty strings, so splitlines() and
-                # other "clever" Python built-ins are a bad idea
-                lines = file.read().split('\n')
-
-                self.sheets.clear()
-
-                curSheetName = ''
-                curSheetCells = []
-                curSheetCharts = []
-                for i in range(len(lines)):
-                    if i % 3 == 0:
-                        # name line
-                        curSheetName = lines[i]
-                    elif i % 3 == 1:
-                        # cells line
-                        curSheetCells = Cell.deserializeRawCells(lines[i])
-                    elif i % 3 == 2:
-                        # charts line
-                        chartStrs = splitEscapedString(lines[i],
-                            SpreadsheetScene.kChartDelimiter)
-                        curSheetCharts = []
-                        for chartStr in chartStrs:
-                            chartStr = chartStr.replace(
-                                '\\' + SpreadsheetScene.kChartDelimiter,
-                                SpreadsheetScene.kChartDelimiter)
-                            chart = ChartData.deserialize(chartStr)
-                            if chart is not None:
-                                curSheetCharts.append(chart)
-                        self.sheets.append(
-                            Sheet(curSheetName, curSheetCells, curSheetCharts))
-
-                if len(self.sheets) == 0:  # in case file empty
-                    self.sheets.append(Sheet.defaultEmpty())
-
-                # open the first sheet, which also reloads the grid
-                self.openSheet(0)
+            # (only replace the open sheets once the file's been read)
+            newSheets = []
+            for sheetData in readWorkbook(path):
+                chartStrs = splitEscapedString(
+                    sheetData.charts, SpreadsheetScene.kChartDelimiter)
+                charts = []
+                for chartStr in chartStrs:
+                    chartStr = chartStr.replace(
+                        '\\' + SpreadsheetScene.kChartDelimiter,
+                        SpreadsheetScene.kChartDelimiter)
+                    chart = ChartData.deserialize(chartStr)
+                    if chart is not None:
+                        charts.append(chart)
+                newSheets.append(
+                    Sheet(sheetData.name, sheetData.cells, charts))
+
+            if len(newSheets) == 0:  # in case file empty
+                newSheets.append(Sheet.defaultEmpty())
+            self.sheets[:] = newSheets
+
+            # open the first sheet, which also reloads the grid
+            self.openSheet(0)
         except:
             self.runModal(Confirmation(
                 message=f'The file {path} could not be read.'))
@@ -259,12 +257,19 @@ class Sheet:
 
     def __init__(self, name: str, cells: dict, charts: list):
         self.name = name
-        self.cells = cells
+        # the sheet's cells, parsed once into an engine of their own
+        self.engine = SheetEngine.fromRawCells(cells)
         self.charts = charts
 
+    # the sheet's cells' raw contents
+    @property
+    def cells(self):
+        return self.engine.getRawCells()
+
     @staticmethod
     def defaultEmpty():
         return Sheet(Sheet.kDefaultSheetPrefix + '1', {}, [])
 
 if __name__ == '__main__':
-    App.load('SimpleSheets', SpreadsheetScene())
+    App.load('SimpleSheets', SpreadsheetScene(
+        useEngineWorker='--engine-worker' in sys.argv))
@@ -29,6 +29,14 @@ class Series:
     def dataLength(self):
         return len(self._data)
 
+    # returns refs to every cell the series shows (including its title)
+    def cellRefs(self):
+        from formulae import CellRef
+        refs = [datum for datum in self._data if isinstance(datum, CellRef)]
+        if self._titleRef:
+            refs.append(self._titleRef)
+        return refs
+
     def evaluatedData(self):
         from formulae import CellRef
         res = []
@@ -99,6 +107,13 @@ class ChartData:
         if autocolor:
             self.assignRandomColors()
 
+    # returns refs to every cell the chart shows
+    def cellRefs(self):
+        refs = self.independentSeries.cellRefs()
+        for series in self.dependentSeries:
+            refs += series.cellRefs()
+        return refs
+
     def assignRandomColors(self):
         colors = ['red', 'orange', 'yellow', 'blue', 'green', 'cyan', 'pink',
                   'green yellow', 'midnight blue', 'purple', 'thistle']
@@ -2,79 +2,480 @@
 # Joseph Rotella (jrotella, F0)
 #
 # Contains main classes for formula parsing, representation, and evaluation.
-import string
+import sys
+import weakref
 from functools import reduce
 
 from typing import Union
 
-from formulae.data_structures import Stack, DependencyGraph
-from formulae.operators import Operator
+from formulae.aggregates import RunningSum
+from formulae.data_structures import Stack, DependencyGraph, ColumnIndex
+from formulae.engine import SheetEngine
+from formulae.errors import FormulaError, kCycleError, kRefError
+from formulae.lexer import tokenize, TokenType, FormulaSyntaxError
+from formulae.operators import Operator, numberize, parseLiteral
 from utils import splitEscapedString
 
 
 class Cell(object):
-    def __init__(self):
+    # there can be millions of cells, so don't give each one a __dict__
+    __slots__ = ('row', 'col', 'raw', 'template', 'cachedValue', 'dirty',
+                 'numeric', 'running')
+
+    def __init__(self, row, col):
+        self.row = row
+        self.col = col
         self.raw = ''
-        self.formula = None
+        # formulae are stored as a shared template relative to this cell
+        self.template = None
+        self.cachedValue = None
+        self.dirty = True  # whether cachedValue needs to be recomputed
+        self.numeric = None  # numeric view of a non-formula cell's value
+        # RunningSum of the range a single-range aggregate formula reads (see
+        # FormulaTemplate.runningRange), once it's been computed
+        self.running = None
 
-    _cells = {}
-    _deps = DependencyGraph()
+    # the active sheet's engine (see formulae.engine); its state is kept in
+    # the class attributes below (_store, _deps, _volatileCells, and
+    # _columnIndexes) while it's active
+    _engine = SheetEngine()
+    _store = _engine.store
+    _deps = _engine.deps
+
+    # value cache statistics (reads served from cache vs. recomputed)
+    cacheHits = 0
+    cacheMisses = 0
+
+    @staticmethod
+    def getEngine():
+        return Cell._engine
+
+    # Makes another sheet's engine the active one, putting the current
+    # sheet's state back into its engine. Nothing is re-parsed or
+    # recomputed, so this takes constant time.
+    @staticmethod
+    def setEngine(engine):
+        current = Cell._engine
+        current.store, current.deps = Cell._store, Cell._deps
+        current.volatileCells = Cell._volatileCells
+        current.columnIndexes = Cell._columnIndexes
+        current.demanded, current.demand = Cell._demanded, Cell._demand
+        current.pendingRoots = Cell._pendingRoots
+        Cell._engine = engine
+        Cell._store, Cell._deps = engine.store, engine.deps
+        Cell._volatileCells = engine.volatileCells
+        Cell._columnIndexes = engine.columnIndexes
+        Cell._demanded, Cell._demand = engine.demanded, engine.demand
+        Cell._pendingRoots = engine.pendingRoots
+
+    # Switches to a different storage backend (a CellStore subclass from
+    # formulae.storage), moving all current cells into it
+    @staticmethod
+    def setStorageBackend(storeClass):
+        rawCells = Cell.getRawCells()
+        Cell._store = storeClass()
+        Cell.loadRawCells(rawCells)
+
+    # Switches to a different dependency graph implementation (DependencyGraph
+    # or, for huge sheets, CompactDependencyGraph), rebuilding it for all
+    # current cells
+    @staticmethod
+    def setDependencyGraph(graphClass):
+        rawCells = Cell.getRawCells()
+        Cell._deps = graphClass()
+        Cell.loadRawCells(rawCells)
 
     @staticmethod
     def getValue(row, col):
-        if (row, col) in Cell._cells:
-            return Cell._cells[row, col].value()
-        else:
-            return ''
+        if Cell._pendingRoots and not Cell._evaluating:
+            Cell._beforeRead(row, col)
+        return Cell._store.getValue(row, col)
+
+    # Returns the cell's value as a number, or None if it isn't numerical
+    # (which is all numerical operators need)
+    @staticmethod
+    def getNumericValue(row, col):
+        if Cell._pendingRoots and not Cell._evaluating:
+            Cell._beforeRead(row, col)
+        return Cell._store.getNumericValue(row, col)
 
     @staticmethod
     def getRaw(row, col):
-        if (row, col) in Cell._cells:
-            return Cell._cells[row, col].raw
-        else:
-            return ''
+        return Cell._store.getRaw(row, col)
 
     @staticmethod
     def hasFormula(row, col):
-        if (row, col) in Cell._cells:
-            return Cell._cells[row, col].formula is not None
+        if (row, col) in Cell._store:
+            return Cell._store.getFormulaCell(row, col) is not None
 
     @staticmethod
     def delete(row, col):
-        if (row, col) in Cell._cells:
-            Cell._deps.setDependencies(CellRef(row, col), set())
-            del Cell._cells[row, col]
+        if (row, col) in Cell._store:
+            Cell._erase(row, col)
+            Cell._invalidateDependents(row, col)
+
+    # Deletes a cell without touching its dependents
+    @staticmethod
+    def _erase(row, col):
+        Cell._formulaEdited(row, col, '')
+        oldValue = Cell._lastValue(row, col)
+        Cell._deps.setDependencies(CellRef(row, col), set())
+        Cell._volatileCells.discard(CellRef(row, col))
+        Cell._store.delete(row, col)
+        Cell._cellChanged(row, col, oldValue, '')
 
     # Sets raw value of cell as well as formula, if applicable
     # By default, will throw if formula illegal. If you REALLY, REALLY promise
     # to handle the error elsewhere
     @staticmethod
     def setRaw(row, col, text):
-        if (row, col) in Cell._cells:
-            cell = Cell._cells[row, col]
+        try:
+            Cell._write(row, col, text)
+        finally:
+            Cell._invalidateDependents(row, col)
+
+    # Sets many cells at once, given {(row, col): raw text, or None to delete
+    # the cell}. Each cell is stored (and its dependencies updated) as it
+    # would be by setRaw, but their dependents are only found once, for all
+    # of them together, and recalculated in one pass (unless recalculate is
+    # False, in which case they're just marked as out of date). Cells with
+    # illegal formulae keep their text. Returns CellRefs to the recalculated
+    # cells (including those written) whose values changed.
+    @staticmethod
+    def setRawMany(rawCells, recalculate=True):
+        written = []
+        if Cell._lazy:
+            # (any pending invalidations are for the demanded cells before
+            # these writes)
+            Cell._getDemand()
+        for row, col in rawCells:
+            text = rawCells[row, col]
+            if text is None:
+                if (row, col) in Cell._store:
+                    Cell._erase(row, col)
+                    written.append(CellRef(row, col))
+                continue
+            try:
+                Cell._write(row, col, text)
+            except:
+                pass  # (the cell's stored as text, just as setRaw leaves it)
+            written.append(CellRef(row, col))
+        Cell._deps.compact()
+
+        if Cell._lazy:
+            order = Cell._demandedRecalcOrder(written)
+            Cell._pendingRoots += written
         else:
-            cell = Cell()
-            Cell._cells[row, col] = cell
-        cell.raw = text
-        if len(cell.raw) > 0 and cell.raw[0] == '=':
-            cell.formula = Formula.fromText(cell.raw)
-            Cell._deps.setDependencies(CellRef(row, col),
-                                       cell.formula.getDependencies())
+            order = Cell._deps.getGroupRecalcOrder(written)
+        for cellRef in order:
+            cell = Cell._store.getFormulaCell(cellRef.row, cellRef.col)
+            if cell is not None:
+                cell.dirty = True
+        changed = []
+        if recalculate:
+            Cell.recalculateCells(order, changed)
+        return changed
+
+    # Stores a cell's raw text and formula (see setRaw) without touching its
+    # dependents. Changes to its value are only passed on to the indexes and
+    # running sums that track values if trackChanges is set.
+    @staticmethod
+    def _write(row, col, text, trackChanges=True):
+        Cell._formulaEdited(row, col, text)
+        oldValue = Cell._lastValue(row, col) if trackChanges else None
+        template = None
+        try:
+            if len(text) > 0 and text[0] == '=':
+                template = FormulaTemplate.fromText(text, row, col)
+        finally:
+            # if the formula's illegal, the cell keeps its text (and NOT a
+            # stale formula)
+            if template is None:
+                Cell._store.setLiteral(row, col, text)
+                Cell._deps.setDependencies(CellRef(row, col), set())
+            else:
+                Cell._store.setFormula(row, col, text, template)
+                Cell._deps.setDependencies(
+                    CellRef.interned(row, col),
+                    template.getDependencies(row, col))
+            if template is not None and template.volatile:
+                Cell._volatileCells.add(CellRef.interned(row, col))
+            else:
+                Cell._volatileCells.discard(CellRef(row, col))
+            if trackChanges:
+                # (a new formula has no value until it's computed)
+                Cell._cellChanged(row, col, oldValue,
+                                  Cell._lastValue(row, col))
+
+    # A cell's value as its dependents last read it: for formulae, that's the
+    # last value computed, even if it's now out of date (or None if none was)
+    @staticmethod
+    def _lastValue(row, col):
+        cell = Cell._store.getCell(row, col)
+        if cell is None:
+            # (not every backend keeps Cell objects for non-formula cells)
+            return Cell._store.getValue(row, col)
+        return cell.cachedValue
+
+    # Applies a change in a cell's value to the structures that track values
+    # without re-reading them: lookup indexes of its column, and the running
+    # sums of aggregate formulae over ranges containing it
+    @staticmethod
+    def _cellChanged(row, col, oldValue, newValue):
+        if not Cell.valueChanged(oldValue, newValue):
+            return
+        index = Cell._columnIndexes.get(col)
+        if index is not None:
+            index.replace(row, oldValue, newValue)
+        oldNumber, newNumber = numberize(oldValue), numberize(newValue)
+        if not Cell.valueChanged(oldNumber, newNumber):
+            return
+        for dependent in Cell._deps.getRangeDependents(CellRef(row, col)):
+            cell = Cell._store.getFormulaCell(dependent.row, dependent.col)
+            if cell is not None and cell.running is not None:
+                cell.running.replace(oldNumber, newNumber)
+
+    # Marks every cell that (transitively) depends on the given cell as
+    # needing recomputation
+    @staticmethod
+    def _invalidateDependents(row, col):
+        if Cell._lazy:
+            # only demanded dependents are invalidated now; the rest are
+            # once something else is read (see _flushPending)
+            dependents = Cell._getDemand().getDependents(CellRef(row, col))
+            Cell._pendingRoots.append(CellRef(row, col))
         else:
-            cell.formula = None
-            Cell._deps.setDependencies(CellRef(row, col), set())
+            dependents = Cell._deps.getDependents(CellRef(row, col))
+        for dependent in dependents:
+            cell = Cell._store.getFormulaCell(dependent.row, dependent.col)
+            if cell is not None:
+                cell.dirty = True
+
+    # LAZY EVALUATION
+    # In lazy mode, only the demanded cells (e.g., the ones on screen and
+    # the ones charts show; see setDemanded) and the cells they read
+    # (transitively) are kept up to date as cells change. Other dependents
+    # of an edited cell aren't recomputed, or even marked as out of date,
+    # until a cell outside of those is read. Editing a cell feeding lots of
+    # off-screen formulae then only costs as much as what's on screen.
+    _lazy = False
+    # the demanded Ranges
+    _demanded = []
+    # DependencyGraph of just the demanded cells, the cells they read, and
+    # kDemandRef (which depends on the demanded ranges), or None if it needs
+    # rebuilding
+    _demand = None
+    # CellRefs to the cells whose (non-demanded) dependents haven't been
+    # invalidated since they changed
+    _pendingRoots = []
+
+    @staticmethod
+    def setLazyEvaluation(lazy):
+        if not lazy:
+            Cell._flushPending()
+        Cell._lazy = lazy
+
+    # Sets which cells need to be kept up to date, as a list of Ranges
+    @staticmethod
+    def setDemanded(ranges):
+        Cell._demanded = list(ranges)
+        Cell._demand = None
+
+    @staticmethod
+    def _getDemand():
+        if Cell._demand is None:
+            # cells that weren't demanded may be now, so they can't be left
+            # out of date
+            Cell._flushPending()
+            demand = DependencyGraph()
+            demand.setDependencies(kDemandRef, set(Cell._demanded))
+            visited = set()
+            toVisit = list(Cell._demanded)
+            while toVisit:
+                dependency = toVisit.pop()
+                if dependency in visited:
+                    continue
+                visited.add(dependency)
+                if dependency.isRange:
+                    cells = Cell._store.formulaCellsInRange(dependency)
+                else:
+                    cell = Cell._store.getFormulaCell(dependency.row,
+                                                      dependency.col)
+                    cells = [cell] if cell is not None else []
+                for cell in cells:
+                    cellRef = CellRef(cell.row, cell.col)
+                    dependencies = Cell._deps.getShallowDependencies(cellRef)
+                    demand.setDependencies(cellRef, dependencies)
+                    toVisit.extend(dependencies)
+            Cell._demand = demand
+        return Cell._demand
+
+    # Whether a cell is demanded, or read (transitively) by one that is
+    @staticmethod
+    def _isDemanded(cellRef):
+        demand = Cell._getDemand()
+        return (cellRef in demand.dependents
+                or len(demand.rangeIndex.getContaining(cellRef.row,
+                                                       cellRef.col)) > 0)
+
+    # The demanded cells among the given ones and their dependents, in
+    # recalculation order (see DependencyGraph.getGroupRecalcOrder)
+    @staticmethod
+    def _demandedRecalcOrder(cellRefs):
+        return [cellRef for cellRef
+                in Cell._getDemand().getGroupRecalcOrder(cellRefs)
+                if cellRef is not kDemandRef and Cell._isDemanded(cellRef)]
+
+    # Called before a cell is written or erased: if it's demanded and it
+    # was or will be a formula, which cells demanded cells read may change
+    @staticmethod
+    def _formulaEdited(row, col, text):
+        if (Cell._demand is not None
+                and (text[:1] == '=' or Cell.hasFormula(row, col))
+                and Cell._isDemanded(CellRef(row, col))):
+            Cell._demand = None
+
+    # Called before a cell is read from outside of any formula while there
+    # are pending invalidations: cells that aren't demanded may be out of
+    # date without knowing it, so invalidate their dependents first
+    @staticmethod
+    def _beforeRead(row, col):
+        if not Cell._isDemanded(CellRef(row, col)):
+            Cell._flushPending()
+
+    # Marks the pending cells and all of their dependents as out of date
+    @staticmethod
+    def _flushPending():
+        if not Cell._pendingRoots:
+            return
+        roots = Cell._pendingRoots
+        Cell._pendingRoots = []
+        for cellRef in roots + list(Cell._deps.getGroupDependents(roots)):
+            cell = Cell._store.getFormulaCell(cellRef.row, cellRef.col)
+            if cell is not None:
+                cell.dirty = True
+
+    # lookup indexes of columns' values (col -> ColumnIndex), which are only
+    # built once a lookup formula needs them
+    _columnIndexes = {}
+
+    # Returns the lookup index of a column's values, building it if need be.
+    # Like the other structures tracking values, it holds the values last
+    # computed (see _lastValue), so building it doesn't compute anything.
+    @staticmethod
+    def getColumnIndex(col):
+        index = Cell._columnIndexes.get(col)
+        if index is None:
+            store = Cell._store
+            positions = store.positionsInRange(Range(0, col, sys.maxsize, col))
+            index = ColumnIndex((row, Cell._lastValue(row, col))
+                                for row, _ in positions)
+            Cell._columnIndexes[col] = index
+        return index
+
+    # Computes any out-of-date formula cells in a range. Anything reading a
+    # range through a lookup index or running sum needs to do this first, as
+    # those only know about values that have been computed.
+    @staticmethod
+    def settleRange(cellRange):
+        for cell in Cell._store.formulaCellsInRange(cellRange):
+            if cell.dirty:
+                cell.value()
+
+    @staticmethod
+    def resetCacheStats():
+        Cell.cacheHits = 0
+        Cell.cacheMisses = 0
 
     @staticmethod
     def getDependents(row, col):
         return Cell._deps.getDependents(CellRef(row, col))
 
+    # Recomputes everything that depends on the given cell, each cell exactly
+    # once and in dependency order. Returns CellRefs to the cells whose values
+    # changed, in the order they were recomputed.
+    @staticmethod
+    def recalculate(row, col):
+        if not Cell._lazy and Cell._recalculator is not None:
+            return Cell._recalculator.recalculate(row, col)
+        changed = []
+        Cell.recalculateCells(Cell.getRecalcOrder(row, col), changed)
+        return changed
+
+    # CellRefs to the cells recalculate(row, col) recomputes, in the order it
+    # recomputes them (in lazy mode, just the demanded ones)
+    @staticmethod
+    def getRecalcOrder(row, col):
+        if Cell._lazy:
+            return [cellRef for cellRef
+                    in Cell._getDemand().getRecalcOrder(CellRef(row, col))
+                    if cellRef is not kDemandRef]
+        return Cell._deps.getRecalcOrder(CellRef(row, col))
+
+    # CellRefs to the cells with volatile formulae (see Operator.volatile)
+    _volatileCells = set()
+
+    # Starts a new recalculation epoch (e.g., after an edit, or when asked
+    # to): recomputes every volatile cell and everything that depends on
+    # them, all together. Between epochs, volatile cells keep their values.
+    # Returns CellRefs to the cells whose values changed.
+    @staticmethod
+    def recalculateVolatile():
+        changed = []
+        Cell.recalculateCells(Cell.startVolatileEpoch(), changed)
+        return changed
+
+    # Marks every volatile cell and everything that depends on them as out
+    # of date without recomputing anything yet. Returns CellRefs to the
+    # cells that need recomputing, in recalculation order.
+    @staticmethod
+    def startVolatileEpoch():
+        if not Cell._volatileCells:
+            return []
+        if Cell._lazy:
+            order = Cell._demandedRecalcOrder(Cell._volatileCells)
+            Cell._pendingRoots += Cell._volatileCells
+        else:
+            order = Cell._deps.getGroupRecalcOrder(Cell._volatileCells)
+        for cellRef in order:
+            cell = Cell._store.getFormulaCell(cellRef.row, cellRef.col)
+            if cell is not None:
+                cell.dirty = True
+        return order
+
+    # Optional engine that recalculate() hands off to (e.g., a
+    # formulae.parallel.ParallelRecalculator), or None to recalculate here
+    _recalculator = None
+
+    @staticmethod
+    def setRecalculator(recalculator):
+        Cell._recalculator = recalculator
+
+    # Recomputes the given (dirty) cells one by one, in the order given.
+    # Appends CellRefs to the cells whose values changed to changed.
+    @staticmethod
+    def recalculateCells(cellRefs, changed):
+        for cellRef in cellRefs:
+            cell = Cell._store.getFormulaCell(cellRef.row, cellRef.col)
+            if cell is None or not cell.dirty:
+                continue
+            oldValue = cell.cachedValue
+            # cells come in dependency order, so there's no need to look for
+            # dirty dependencies first (as value() would)
+            if Cell.valueChanged(oldValue, cell._evaluate()):
+                changed.append(cellRef)
+
+    @staticmethod
+    def valueChanged(oldValue, newValue):
+        return type(newValue) is not type(oldValue) or newValue != oldValue
+
     @staticmethod
     def getShallowDependencies(row, col):
         return Cell._deps.getShallowDependencies(CellRef(row, col))
 
     @staticmethod
     def empty():
-        return len(Cell._cells) == 0
+        return len(Cell._store) == 0
 
     # serializes a raw cell content dictionary, obtainable from
     # Cell.getRawCells()
@@ -93,24 +494,32 @@ class Cell(object):
     @staticmethod
     def getRawCells():
         rawDict = {}
-        for row, col in Cell._cells:
-            rawDict[row, col] = Cell._cells[row, col].raw
+        for row, col in Cell._store.positions():
+            rawDict[row, col] = Cell._store.getRaw(row, col)
         return rawDict
 
     # replaces stored cell data with data from provided cells,
     # or simply resets all cells if None is passed
     @staticmethod
     def loadRawCells(cells: Union[None, dict[tuple[int, int], str]]):
-        Cell._cells = {}
-        Cell._deps = DependencyGraph()
+        Cell._store = type(Cell._store)()
+        Cell._deps = type(Cell._deps)()
+        Cell._volatileCells = set()
+        Cell._columnIndexes = {}
+        Cell._demand = None
+        Cell._pendingRoots = []
+        CellRef.clearInterned()
         if cells is not None:
+            # every cell's new, so nothing's been computed yet: there are no
+            # dependents to invalidate or tracked values to update
             for row, col in cells:
                 try:
-                    Cell.setRaw(row, col, cells[row, col])
+                    Cell._write(row, col, cells[row, col], False)
                 except:
                     # if there's a syntax error, the spreadsheet grid will
                     # figure it out when it loads
                     pass
+            Cell._deps.compact()
 
     # deserializes serialized cells and returns a string dictionary suitable
     # for loading via loadRawCells()
@@ -132,40 +541,231 @@ class Cell(object):
             i += 1
         return res
 
-    # Returns computed value of cell (with appropriate type/formula result)
+    # The cell's formula, with references relative to the cell resolved. Note
+    # that this builds a new tree (cells only store their shared template).
+    @property
+    def formula(self):
+        if self.template is None:
+            return None
+        return self.template.instantiate(self.row, self.col)
+
+    # Makes this a non-formula cell with the given text. Its value (and
+    # numeric view) are parsed now, once, rather than every time it's read.
+    def setLiteral(self, text):
+        self.raw = text
+        self.template = None
+        self.cachedValue = parseLiteral(text)
+        self.numeric = numberize(self.cachedValue)
+        self.running = None
+        self.dirty = False
+
+    # Makes this a formula cell. Its old value is dropped (and dependents are
+    # told that it's gone, see Cell.setRaw) until the formula's computed.
+    def setFormula(self, text, template):
+        self.raw = text
+        self.template = template
+        self.cachedValue = None
+        self.numeric = None
+        self.running = None
+        self.dirty = True
+
+    # Returns computed value of cell (with appropriate type/formula result),
+    # recomputing only if an input has changed since it was last read
     def value(self):
-        if self.formula:
-            try:
-                return self.formula.evaluate()
-            except:
-                return 'RUNTIME-ERROR'
+        if not self.dirty:
+            Cell.cacheHits += 1
+            return self.cachedValue
+        if self.template is not None:
+            Cell._evaluateWithDependencies(self)
+            if not self.dirty:
+                return self.cachedValue
+        return self._evaluate()
+
+    # cells whose values are being computed right now; needing one of their
+    # values in the meantime means there's a circular reference, so the cell
+    # reading it gets #CYCLE! (which then propagates around the cycle)
+    _evaluating = set()
+
+    def _evaluate(self):
+        if self in Cell._evaluating:
+            return kCycleError
+        Cell.cacheMisses += 1
+        Cell._evaluating.add(self)
+        try:
+            value = self._computeValue()
+        finally:
+            Cell._evaluating.discard(self)
+        self._cacheValue(value)
+        return value
+
+    _evaluateUntimed = _evaluate
+
+    def _evaluateTimed(self):
+        return Cell._profiler.evaluate(self, Cell._evaluateUntimed)
+
+    # Optional profiler (a formulae.profiler.FormulaProfiler) that times
+    # every evaluation, or None. Setting one swaps in a timed _evaluate, so
+    # not profiling costs nothing at all.
+    _profiler = None
+
+    @staticmethod
+    def setProfiler(profiler):
+        Cell._profiler = profiler
+        if profiler is None:
+            Cell._evaluate = Cell._evaluateUntimed
         else:
+            Cell._evaluate = Cell._evaluateTimed
+
+    # Computes a formula cell and every dirty formula cell it (transitively)
+    # depends on, dependencies first. This uses an explicit stack rather than
+    # having each formula compute its inputs as it reads them, so that chains
+    # of references of any length can't overflow Python's call stack: by the
+    # time a formula is computed, every cell it reads is already cached.
+    @staticmethod
+    def _evaluateWithDependencies(cell):
+        store = Cell._store
+        profiler = Cell._profiler
+        expanded = set()
+        stack = [cell]
+        while stack:
+            cur = stack[-1]
+            if not cur.dirty:
+                stack.pop()
+            elif cur in expanded:
+                # all of its dependencies have been computed
+                stack.pop()
+                cur._evaluate()
+            else:
+                expanded.add(cur)
+                for dependency in Cell._deps.getShallowDependencies(
+                        CellRef(cur.row, cur.col)):
+                    if dependency.isRange:
+                        dependencyCells = store.formulaCellsInRange(
+                            dependency)
+                    else:
+                        dependencyCell = store.getFormulaCell(dependency.row,
+                                                              dependency.col)
+                        dependencyCells = ([dependencyCell]
+                                           if dependencyCell else [])
+                    for dependencyCell in dependencyCells:
+                        # (cells that are already expanded are in a cycle)
+                        if (dependencyCell.dirty
+                                and dependencyCell not in expanded):
+                            stack.append(dependencyCell)
+                            if profiler is not None:
+                                profiler.demand(dependencyCell, cur)
+
+    # Stores a value computed elsewhere (e.g., in another process)
+    def setComputedValue(self, value):
+        self._cacheValue(value)
+
+    def _cacheValue(self, value):
+        oldValue = self.cachedValue
+        self.cachedValue = value
+        self.dirty = False
+        Cell._cellChanged(self.row, self.col, oldValue, value)
+
+    def _computeValue(self):
+        if self.template:
             try:
-                return int(self.raw)
-            except:
-                try:
-                    return float(self.raw)
-                except:
-                    return self.raw
+                if self.template.runningRange is not None:
+                    return self._computeRunning()
+                return self.template.compiled(self.row, self.col)
+            except Exception as e:
+                # (errors are normally returned as values, not raised)
+                return FormulaError.fromException(e)
+        else:
+            return parseLiteral(self.raw)
+
+    # Computes a single-range aggregate from its range's running sum, which
+    # is only built by reading the range the first time; after that, it's
+    # kept up to date as the range's cells change (see _cellChanged)
+    def _computeRunning(self):
+        cellRange = self.template.runningRange.shifted(self.row, self.col)
+        if self.running is None:
+            self.running = RunningSum(cellRange.getNumbers())
+        else:
+            Cell.settleRange(cellRange)
+        if self.running.errorCount > 0:
+            # the result is the range's first error, which only reading the
+            # range can find
+            return self.template.compiled(self.row, self.col)
+        return self.template.formula.operator.runningFunc(self.running,
+                                                          cellRange.size())
+
+    # Returns the cell's value as a number, or None if it isn't numerical (or
+    # the error, if it's one)
+    def numericValue(self):
+        if self.template is None:
+            return self.numeric
+        return numberize(self.value())
 
     def __repr__(self):
         rep = f'Cell({self.raw}'
-        if self.formula:
+        if self.template:
             rep += f' -> {self.formula}'
         rep += ')'
         return rep
 
 # Represents a formula reference to a cell. We use refs instead of pointing
 # to cells directly so that we don't end up with zombies (and unexpected
-# behavior) if a previously-referenced cell is subsequently cleared/deleted
+# behavior) if a previously-referenced cell is subsequently cleared/deleted.
+# CellRefs are immutable flyweights: refs that are kept around (by formulae
+# and the dependency graph) are interned, and constructing a CellRef for
+# coordinates that have an interned ref returns that same object.
 class CellRef(object):
-    def __init__(self, row, col):
-        self.row = row
-        self.col = col
+    __slots__ = ('row', 'col', '_hash')
+    isRange = False
+
+    # col -> row -> CellRef. Keying by column, then row, means the table's
+    # keys are the refs' own coordinates rather than new (row, col) tuples.
+    _interned = {}
+
+    def __new__(cls, row, col):
+        column = CellRef._interned.get(col)
+        if column is not None:
+            cellRef = column.get(row)
+            if cellRef is not None:
+                return cellRef
+        return CellRef._create(row, col)
+
+    @staticmethod
+    def _create(row, col):
+        cellRef = object.__new__(CellRef)
+        cellRef.row = row
+        cellRef.col = col
+        cellRef._hash = hash((row, col))  # refs are hashed constantly
+        return cellRef
+
+    # Returns the shared CellRef for the given coordinates, creating it if
+    # there isn't one yet. Use this for refs that will be stored; temporary
+    # refs (e.g., for lookups) needn't be interned.
+    @staticmethod
+    def interned(row, col):
+        column = CellRef._interned.get(col)
+        if column is None:
+            column = CellRef._interned[col] = {}
+        cellRef = column.get(row)
+        if cellRef is None:
+            cellRef = column[row] = CellRef._create(row, col)
+        return cellRef
+
+    # Forgets every interned CellRef (e.g., when a sheet is unloaded).
+    # Existing refs stay valid, they just won't be shared with new ones.
+    @staticmethod
+    def clearInterned():
+        CellRef._interned = {}
+
+    # keep refs interned when they're copied or pickled
+    def __reduce__(self):
+        return CellRef.interned, (self.row, self.col)
 
     def getValue(self):
         return Cell.getValue(self.row, self.col)
 
+    def shifted(self, drow, dcol):
+        return CellRef.interned(self.row + drow, self.col + dcol)
+
     def serialize(self):
         return f'{self.row}:{self.col}'
 
@@ -175,123 +775,244 @@ class CellRef(object):
         return CellRef(int(entities[0]), int(entities[1]))
 
     def __hash__(self):
-        return hash((self.row, self.col))
+        return self._hash
 
     def __eq__(self, other):
-        return (isinstance(other, CellRef)
-                and other.row == self.row and other.col == self.col)
+        return self is other or (
+            isinstance(other, CellRef)
+            and other.row == self.row and other.col == self.col)
 
     def __repr__(self):
         return f'CellRef({self.row}, {self.col})'
 
+# stands in for whatever demands the demanded cells (see Cell.setDemanded)
+kDemandRef = CellRef(-1, -1)
+
+# Represents a formula reference to a rectangular range of cells. Only the
+# corners are stored: the cells in the range are looked up when the formula is
+# evaluated, and only those that actually exist are visited.
+class Range(object):
+    isRange = True
+
+    def __init__(self, startRow, startCol, endRow, endCol):
+        self.startRow = min(startRow, endRow)
+        self.startCol = min(startCol, endCol)
+        self.endRow = max(startRow, endRow)
+        self.endCol = max(startCol, endCol)
+
+    def contains(self, row, col):
+        return (self.startRow <= row <= self.endRow
+                and self.startCol <= col <= self.endCol)
+
+    def size(self):
+        return ((self.endRow - self.startRow + 1)
+                * (self.endCol - self.startCol + 1))
+
+    # Returns the (row, col) positions of populated cells in the range, in
+    # row-major order
+    def populatedPositions(self):
+        return Cell._store.positionsInRange(self)
+
+    # Returns the values of the cells in the range. Empty cells are only
+    # included (as '') if includeEmpty is set, as only operators that count
+    # their operands care about them.
+    def getValues(self, includeEmpty=False):
+        values = Cell._store.valuesInRange(self)
+        if includeEmpty:
+            values += [''] * (self.size() - len(values))
+        return values
+
+    # Returns the numeric views of the range's numerical cells' values
+    def getNumbers(self):
+        return Cell._store.numbersInRange(self)
+
+    # Returns the range's populated cells' values as a NumericArray (or None
+    # if they can't all be represented as floats). Requires NumPy.
+    def getNumericArray(self):
+        return Cell._store.numericArrayInRange(self)
+
+    # Returns the value of the cell at the given offsets from the range's
+    # top-left corner (or #REF! if that's outside the range)
+    def valueAt(self, rowOffset, colOffset):
+        row, col = self.startRow + rowOffset, self.startCol + colOffset
+        if not self.contains(row, col):
+            return kRefError
+        return Cell.getValue(row, col)
+
+    # Looks a value up in the range's first column (or along its first row),
+    # returning the matching cell's offset from the start, or None. With
+    # matchType 0, values must match exactly; with 1, the largest value no
+    # larger than the one given matches, and with -1, the smallest value no
+    # smaller than it. Columns are searched through their lookup indexes.
+    def find(self, value, matchType=0, alongRow=False):
+        if alongRow:
+            # (rows aren't indexed, but they're usually short)
+            index = ColumnIndex((col - self.startCol,
+                                 Cell.getValue(self.startRow, col))
+                                for col in range(self.startCol,
+                                                 self.endCol + 1))
+            start, end, offset = 0, self.endCol - self.startCol, 0
+        else:
+            Cell.settleRange(Range(self.startRow, self.startCol,
+                                   self.endRow, self.startCol))
+            index = Cell.getColumnIndex(self.startCol)
+            start, end, offset = self.startRow, self.endRow, self.startRow
+        if matchType == 0:
+            found = index.firstRow(value, start, end)
+        elif matchType > 0:
+            found = index.lastAtMost(value, start, end)
+        else:
+            found = index.firstAtLeast(value, start, end)
+        return None if found is None else found - offset
+
+    # Counts the cells in the range whose values compare to a value as asked
+    # (see ColumnIndex.countCompared)
+    def countCompared(self, comparison, value):
+        count = 0
+        for col in range(self.startCol, self.endCol + 1):
+            Cell.settleRange(Range(self.startRow, col, self.endRow, col))
+            count += Cell.getColumnIndex(col).countCompared(
+                comparison, value, self.startRow, self.endRow)
+        return count
+
+    # Returns the overlap of this range with the given bounds, or None if
+    # they don't overlap
+    def clippedTo(self, startRow, startCol, endRow, endCol):
+        startRow = max(startRow, self.startRow)
+        startCol = max(startCol, self.startCol)
+        endRow = min(endRow, self.endRow)
+        endCol = min(endCol, self.endCol)
+        if startRow > endRow or startCol > endCol:
+            return None
+        return Range(startRow, startCol, endRow, endCol)
+
+    def shifted(self, drow, dcol):
+        return Range(self.startRow + drow, self.startCol + dcol,
+                     self.endRow + drow, self.endCol + dcol)
+
+    # Returns a CellRef for every position in the range (populated or not)
+    def cellRefs(self):
+        return [CellRef(row, col)
+                for row in range(self.startRow, self.endRow + 1)
+                for col in range(self.startCol, self.endCol + 1)]
+
+    def __hash__(self):
+        return hash((self.startRow, self.startCol, self.endRow, self.endCol))
+
+    def __eq__(self, other):
+        return (isinstance(other, Range)
+                and other.startRow == self.startRow
+                and other.startCol == self.startCol
+                and other.endRow == self.endRow
+                and other.endCol == self.endCol)
+
+    def __repr__(self):
+        return (f'Range({self.startRow}, {self.startCol}, '
+                f'{self.endRow}, {self.endCol})')
+
 # represents a formula in a cell, where a formula is composed of an operator
 # applied to multiple operands, each of which could be another formula,
 # a cell reference, or a numerical literal
 class Formula(object):
+    __slots__ = ('operator', 'operands')
+
     def __init__(self, operator: Operator,
-                 operands: list[Union[int, str, CellRef]]):
+                 operands: list[Union[int, str, CellRef, Range]]):
         self.operator = operator
         self.operands = operands
 
     @staticmethod
     def fromText(text):
-        # remove leading equals sign, ditch spaces, ignore case
-        text = text[1:].replace(' ', '').upper()
-        return Formula._parseFormula(text)
+        # skip leading equals sign, ignore case (the lexer ditches spaces).
+        # We keep the equals sign so error positions match the cell's text.
+        return Formula._parseFormula(text.upper(), 1)
+
+    @staticmethod
+    def _parseFormula(text, start=0):
+        return Formula._parseTokens(tokenize(text, start), start, len(text))
 
+    # Builds a formula from tokens; start and end are the positions of the
+    # start and end of the formula text (for error reporting)
     @staticmethod
-    def _parseFormula(argString):
+    def _parseTokens(tokens, start, end):
         activeFormulae = Stack()
         result = None
+        # the most recent value, which becomes an operator if followed by `(`
+        pendingValue = None
 
-        foundTokens = False
-        for token, value in Formula._getTokens(argString):
-            foundTokens = True
-            if token == '(':
-                activeFormulae.push(Formula(Operator.get(value), []))
-            elif token == ')':
-                formula = activeFormulae.pop()
-                formula.operands += Formula._getCellOrLiteral(value)
-                containerFormula = activeFormulae.get()
-                if containerFormula:
-                    activeFormulae.get().operands.append(formula)
-                else:
-                    # We store the result rather than immediately returning
-                    # it so that malformed expressions (i.e., where extra tokens
-                    # follow what should be the end) are flagged as such
-                    result = formula
-            else:
-                activeFormulae.get().operands += Formula._getCellOrLiteral(
-                    value)
+        for token in tokens:
+            if result is not None:
+                # malformed expressions (i.e., where extra tokens follow what
+                # should be the end) are flagged as such
+                raise FormulaSyntaxError(f'Unexpected {token.text!r} after '
+                                         f'end of formula', token.position)
 
-        if not foundTokens:  # Something like `=D4` or `=2`
-            operand = Formula._getCellOrLiteral(argString)
-            if len(operand) > 1:
-                raise Exception('Formula literal cannot be multiple values')
-            result = Formula(Operator.get('LITERAL'), operand)
+            if token.type == TokenType.OPEN:
+                if pendingValue is None:
+                    raise FormulaSyntaxError('Missing operator name',
+                                             token.position)
+                if pendingValue.type != TokenType.IDENTIFIER:
+                    raise FormulaSyntaxError(f'Illegal operator '
+                                             f'{pendingValue.text}',
+                                             pendingValue.position)
+                try:
+                    operator = Operator.get(pendingValue.text)
+                except Exception as e:
+                    raise FormulaSyntaxError(str(e), pendingValue.position)
+                activeFormulae.push(Formula(operator, []))
+                pendingValue = None
+                continue
 
-        # TODO: Figure out why the types of the operands aren't consistent
-        return result
+            if token.type == TokenType.COMMA or token.type == TokenType.CLOSE:
+                formula = activeFormulae.get()
+                if formula is None:
+                    raise FormulaSyntaxError(f'Unexpected {token.text!r}',
+                                             token.position)
+                if pendingValue is not None:
+                    formula.operands.append(
+                        Formula._operandFromToken(pendingValue))
+                    pendingValue = None
+                if token.type == TokenType.CLOSE:
+                    activeFormulae.pop()
+                    containerFormula = activeFormulae.get()
+                    if containerFormula:
+                        containerFormula.operands.append(formula)
+                    else:
+                        result = formula
+                continue
 
-    # Iteratively returns all tokens and their preceding values in a given
-    # formula string
-    @staticmethod
-    def _getTokens(formulaString):
-        while True:
-            nextOpen = formulaString.find('(')
-            nextClose = formulaString.find(')')
-            nextComma = formulaString.find(',')
-            nonnegative = lambda x: x >= 0
-            existentTokens = list(filter(nonnegative,
-                                         [nextOpen, nextClose, nextComma]))
-            if not existentTokens:
-                return
-            else:
-                nextTokenIdx = min(existentTokens)
-                nextToken = formulaString[nextTokenIdx]
-                nextValue = formulaString[:nextTokenIdx]
-                formulaString = formulaString[nextTokenIdx + 1:]
-                yield nextToken, nextValue
-
-    # Takes an input string and attempts to turn it into a cell reference;
-    # if it isn't a valid cell reference, returns the literal value instead.
-    # Returns as a list of 1 item. If the input is empty, returns empty list.
-    @staticmethod
-    def _getCellOrLiteral(text):
-        if text == '':
-            return []
+            # values can only be followed by punctuation, and the lexer
+            # merges runs of characters, so there can't already be a pending
+            # value here unless a formula just closed (which raised above)
+            pendingValue = token
+
+        if activeFormulae.get() is not None:
+            raise FormulaSyntaxError('Missing closing parenthesis', end)
+
+        if result is None:  # Something like `=D4` or `=2`
+            if pendingValue is None:
+                raise FormulaSyntaxError('Empty formula', start)
+            operand = Formula._operandFromToken(pendingValue)
+            if isinstance(operand, Range):
+                raise FormulaSyntaxError('Formula literal cannot be multiple '
+                                         'values', pendingValue.position)
+            result = Formula(Operator.get('LITERAL'), [operand])
 
-        if ':' in text:
-            cells = text.split(':')
-            if len(cells) != 2:
-                raise Exception('Illegal cell range format')
-            cell0 = Formula._getCellOrLiteral(cells[0])[0]
-            cell1 = Formula._getCellOrLiteral(cells[1])[0]
-            if not isinstance(cell0, CellRef) or not isinstance(cell1, CellRef):
-                raise Exception('Illegal entity in cell range')
-            startCol = min(cell0.col, cell1.col)
-            endCol = max(cell0.col, cell1.col)
-            startRow = min(cell0.row, cell1.row)
-            endRow = max(cell0.row, cell1.row)
-
-            cellsInRange = []
-            for row in range(startRow, endRow + 1):
-                for col in range(startCol, endCol + 1):
-                    cellsInRange.append(CellRef(row, col))
-            return cellsInRange
-
-        hasRowNum = True
-        for char in text[1:]:
-            if char not in string.digits:
-                hasRowNum = False
-                break
-
-        if text[0] in string.ascii_uppercase and hasRowNum:
-            cellRow = int(text[1:]) - 1  # User-facing numbering is 1-based
-            cellCol = ord(text[0]) - ord('A')
-            return [CellRef(cellRow, cellCol)]
+        return result
+
+    # Turns a value token into an operand: a cell reference, a range, or a
+    # (numerical or text) literal
+    @staticmethod
+    def _operandFromToken(token):
+        if token.type == TokenType.REF:
+            return CellRef.interned(*token.value)
+        elif token.type == TokenType.RANGE:
+            (startRow, startCol), (endRow, endCol) = token.value
+            if (startRow, startCol) == (endRow, endCol):
+                return CellRef.interned(startRow, startCol)
+            return Range(startRow, startCol, endRow, endCol)
         else:
-            return [text]
+            return token.value
 
     def evaluate(self):
         evaluatedOperands = []
@@ -300,14 +1021,51 @@ class Formula(object):
                 evaluatedOperands.append(operand.evaluate())
             elif isinstance(operand, CellRef):
                 evaluatedOperands.append(operand.getValue())
+            elif isinstance(operand, Range):
+                if self.operator.rangeOperands:
+                    evaluatedOperands.append(operand)
+                elif self.operator.countsEmptyOperands():
+                    evaluatedOperands += operand.getValues(True)
+                else:
+                    evaluatedOperands += operand.getNumbers()
             else:
                 evaluatedOperands.append(operand)
         return self.operator.operate(evaluatedOperands)
 
+    # Returns a flat function equivalent to evaluate(). The function takes an
+    # anchor (row, col): if relative is set, the formula's references are
+    # taken as offsets from it, otherwise it's ignored. The tree-walking
+    # evaluate() remains as a fallback and reference.
+    def compile(self, relative=False):
+        from formulae.compiler import compileFormula
+        return compileFormula(self, Cell.getValue, Cell.getNumericValue,
+                              relative)
+
+    # Returns a copy of this formula with every reference moved by the
+    # given number of rows and columns
+    def shifted(self, drow, dcol):
+        operands = []
+        for operand in self.operands:
+            if (isinstance(operand, Formula) or isinstance(operand, CellRef)
+                    or isinstance(operand, Range)):
+                operands.append(operand.shifted(drow, dcol))
+            else:
+                operands.append(operand)
+        return Formula(self.operator, operands)
+
+    # Whether any of the formula's operators are volatile (e.g., RAND)
+    def isVolatile(self):
+        if self.operator.volatile:
+            return True
+        for operand in self.operands:
+            if isinstance(operand, Formula) and operand.isVolatile():
+                return True
+        return False
+
     def getDependencies(self):
         deps = set()
         for operand in self.operands:
-            if isinstance(operand, CellRef):
+            if isinstance(operand, CellRef) or isinstance(operand, Range):
                 deps.add(operand)
             elif isinstance(operand, Formula):
                 deps = deps.union(operand.getDependencies())
@@ -320,6 +1078,76 @@ class Formula(object):
         return f'{self.operator.name}({operandsStr})'
 
 
+# A formula stored relative to the cell containing it (its anchor), so that
+# every cell in a filled column of structurally identical formulae (e.g.,
+# =MULTIPLY(B2, C2), =MULTIPLY(B3, C3), ...) can share one parsed and
+# compiled template. Templates are interned by their relative token sequence,
+# which is cheap to compute, so only the first cell of such a column is
+# actually parsed and compiled.
+class FormulaTemplate(object):
+    _templates = weakref.WeakValueDictionary()  # relative key -> template
+    _nextIdent = 0
+
+    def __init__(self, formula: Formula):
+        self.ident = FormulaTemplate._nextIdent
+        FormulaTemplate._nextIdent += 1
+        self.formula = formula  # references are offsets from the anchor
+        self.compiled = formula.compile(relative=True)
+        self.dependencies = formula.getDependencies()
+        self.volatile = formula.isVolatile()
+        # the (relative) range, if this is an aggregate of just one range
+        # that can be kept as a running sum (e.g., =SUM(A1:A50000))
+        self.runningRange = None
+        if (formula.operator.runningFunc is not None
+                and len(formula.operands) == 1
+                and isinstance(formula.operands[0], Range)):
+            self.runningRange = formula.operands[0]
+
+    @staticmethod
+    def fromText(text, row, col):
+        tokens = list(tokenize(text.upper(), 1))
+        key = FormulaTemplate._relativeKey(tokens, row, col)
+        template = FormulaTemplate._templates.get(key)
+        if template is None:
+            formula = Formula._parseTokens(tokens, 1, len(text))
+            template = FormulaTemplate(formula.shifted(-row, -col))
+            FormulaTemplate._templates[key] = template
+        return template
+
+    # Describes a token sequence with references relative to (row, col), so
+    # that formulae differing only in their anchor get the same key. Each
+    # part has its token's type, so that no other token (e.g., the text R0C1)
+    # can be mistaken for a reference.
+    @staticmethod
+    def _relativeKey(tokens, row, col):
+        parts = []
+        for token in tokens:
+            if token.type == TokenType.REF:
+                refRow, refCol = token.value
+                parts.append((token.type, (refRow - row, refCol - col)))
+            elif token.type == TokenType.RANGE:
+                (startRow, startCol), (endRow, endCol) = token.value
+                parts.append((token.type, (startRow - row, startCol - col,
+                                           endRow - row, endCol - col)))
+            else:
+                parts.append((token.type, token.text))
+        return tuple(parts)
+
+    # Returns an absolute copy of the formula for a cell at (row, col)
+    def instantiate(self, row, col):
+        return self.formula.shifted(row, col)
+
+    def getDependencies(self, row, col):
+        return {dependency.shifted(row, col)
+                for dependency in self.dependencies}
+
+    @staticmethod
+    def count():
+        return len(FormulaTemplate._templates)
+
+    def __repr__(self):
+        return f'FormulaTemplate({self.ident}: {self.formula})'
+
 
 # test cases
 if __name__ == '__main__':
@@ -343,3 +1171,469 @@ if __name__ == '__main__':
         Formula.fromText('=ADD(1, 2, AVERAGE(1, 3, 7, 6, 4, 2), 9)'))
         == 'ADD(1, 2, AVERAGE(1, 3, 7, 6, 4, 2), 9)'
     )
+
+    # syntax errors report where they happened
+    for formulaText, position in [('=ADD(1, 2', 9), ('=FOO(1)', 1),
+                                  ('=ADD(1))', 7), ('=SUM(A1:B)', 5),
+                                  ('=SUM(A²:B1)', 5), ('=SUM(A1:A²)', 5)]:
+        try:
+            Formula.fromText(formulaText)
+            assert False, formulaText
+        except FormulaSyntaxError as e:
+            assert e.position == position, formulaText
+    # (non-ASCII digits don't make references, so these are text)
+    assert Formula.fromText('=A²').operands == ['A²']
+    assert Formula.fromText('=ADD(A², 1)').operands == ['A²', 1]
+    assert Formula.fromText('=A' + '1' * 5000).operands == ['A' + '1' * 5000]
+
+    # running this file directly creates a second copy of this module, so
+    # use the package's classes (which the compiler checks against) from here
+    from formulae import Cell, CellRef, Formula, Range
+    from formulae.errors import kDivZeroError, kNotFoundError, kNumError, \
+        kValueError
+
+    # compiled formulae must agree with the tree-walking evaluator
+    Cell.loadRawCells({(0, 0): '4', (1, 0): '1,000', (2, 0): 'text',
+                       (0, 1): '=ADD(A1, A2, A3, 2)'})
+    for formulaText in ['=ADD(1, 2, AVERAGE(1, 3, 7, 6, 4, ADD(2, 3)), 2)',
+                        '=SUBTRACT(A2, MULTIPLY(A1, 2.5))',
+                        '=COUNT(A1:A4, B1, hello)', '=MODE(A1:B3, 4)',
+                        '=ABS(A1, A2)', '=DIVIDE(A1, 0)', '=A2', '=hi',
+                        '=POW(A1, B1)', '=MAX(A3)']:
+        formula = Formula.fromText(formulaText)
+        try:
+            expected = formula.evaluate()
+        except Exception as e:
+            expected = type(e)
+        try:
+            actual = formula.compile()(0, 0)
+        except Exception as e:
+            actual = type(e)
+        assert expected == actual, formulaText
+    Cell.loadRawCells(None)
+
+    # values are cached until one of their inputs changes (and non-formula
+    # values are parsed once, when set, so they're never recomputed)
+    Cell.loadRawCells({(0, 0): '1', (0, 1): '=ADD(A1, 1)',
+                       (0, 2): '=ADD(B1, A1)'})
+    Cell.resetCacheStats()
+    assert Cell.getValue(0, 2) == 3
+    assert Cell.getValue(0, 2) == 3 and Cell.getValue(0, 1) == 2
+    assert (Cell.cacheHits, Cell.cacheMisses) == (3, 2)
+    Cell.setRaw(0, 0, '5')
+    assert Cell.getValue(0, 2) == 11
+    Cell.delete(0, 0)
+    assert Cell.getValue(0, 2) == 1
+
+    # recalculation visits dependents in dependency order, once each
+    Cell.loadRawCells({(0, 0): '1', (0, 1): '=ADD(A1, 1)',
+                       (1, 1): '=ADD(A1, 2)', (0, 2): '=ADD(B1, B2)',
+                       (1, 2): '=C1', (2, 2): '=MAX(A1, 100)'})
+    for row, col in [(0, 1), (1, 1), (0, 2), (1, 2), (2, 2)]:
+        Cell.getValue(row, col)
+    Cell.setRaw(0, 0, '2')
+    Cell.resetCacheStats()
+    changed = Cell.recalculate(0, 0)
+    assert set(changed[:2]) == {CellRef(0, 1), CellRef(1, 1)}
+    assert changed[2:] == [CellRef(0, 2), CellRef(1, 2)]
+    assert Cell.cacheMisses == 5
+
+    # bulk writes find and recalculate everything affected once, together
+    Cell.loadRawCells({(3, 0): '7', (0, 1): '=SUM(A1:A4)',
+                       (1, 1): '=MULTIPLY(B1, A1)', (2, 1): '=B2'})
+    assert Cell.getValue(2, 1) == 7
+    changed = Cell.setRawMany({(0, 0): '2', (1, 0): '3', (2, 0): '=ADD(',
+                               (3, 0): None, (0, 2): '=ADD(B3, 1)'})
+    assert set(changed) == {CellRef(0, 1), CellRef(1, 1), CellRef(2, 1),
+                            CellRef(0, 2)}
+    assert changed.index(CellRef(1, 1)) < changed.index(CellRef(2, 1))
+    assert Cell.getValue(0, 2) == 11 and not Cell.hasFormula(2, 0)
+    assert Cell.getRaw(2, 0) == '=ADD(' and (3, 0) not in Cell._store
+
+    # long chains of references are evaluated without recursing, and cycles
+    # are #CYCLE! errors rather than stack overflows
+    rawCells = {(row, 0): f'=ADD(A{row}, 1)' for row in range(1, 20000)}
+    rawCells[0, 0] = '0'
+    rawCells[0, 1] = '=SUM(A1:A20000, C1)'
+    rawCells[0, 2] = '=B1'
+    Cell.loadRawCells(rawCells)
+    assert Cell.getValue(19999, 0) == 19999
+    assert Cell.getValue(0, 2) is Cell.getValue(0, 1) is kCycleError
+    Cell.setRaw(0, 0, '1')
+    Cell.recalculate(0, 0)
+    assert Cell.getValue(19999, 0) == 20000
+    Cell.loadRawCells(None)
+
+    # volatile formulae keep their values until a new recalculation epoch,
+    # when they're recomputed along with their dependents
+    Cell.loadRawCells({(0, 0): '=RAND()', (0, 1): '=MULTIPLY(A1, 2)',
+                       (1, 0): '=ADD(RAND(), 5)', (1, 1): '=ADD(2, 2)'})
+    values = [Cell.getValue(row, col) for row in range(2) for col in range(2)]
+    assert values == [Cell.getValue(row, col)
+                      for row in range(2) for col in range(2)]
+    changed = Cell.recalculateVolatile()
+    assert set(changed) == {CellRef(0, 0), CellRef(0, 1), CellRef(1, 0)}
+    assert changed.index(CellRef(0, 0)) < changed.index(CellRef(0, 1))
+    assert Cell.getValue(0, 1) == Cell.getValue(0, 0) * 2 != values[1]
+    Cell.setRaw(0, 0, '3')
+    assert Cell.recalculateVolatile() == [CellRef(1, 0)]
+    Cell.loadRawCells(None)
+
+    # ranges are single operands/dependencies that only visit populated cells
+    Cell.loadRawCells({(0, 0): '1', (5, 0): '2', (0, 1): '=SUM(A1:A100000)',
+                       (1, 1): '=COUNT(A1:A100000)'})
+    assert Formula.fromText('=SUM(A1:A100000)').operands == [
+        Range(0, 0, 99999, 0)]
+    assert Cell.getValue(0, 1) == 3 and Cell.getValue(1, 1) == 100000
+    Cell.setRaw(70000, 0, '4')
+    assert Cell.recalculate(70000, 0) == [CellRef(0, 1)]
+    assert Cell.getValue(0, 1) == 7
+
+    # single-range SUM/AVERAGE/COUNT formulae keep running sums, so edits in
+    # their ranges are applied as changes rather than by re-reading them, and
+    # the results are still exactly the (correctly rounded) sums
+    import math
+    rawCells = {(row, 0): f'{row}.1' for row in range(1000)}
+    rawCells.update({(0, 1): '=SUM(A1:A1000)', (1, 1): '=AVERAGE(A1:A1000)',
+                     (2, 1): '=COUNT(A1:A1000)'})
+    Cell.loadRawCells(rawCells)
+    Cell.getValue(0, 1)
+    running = Cell._store.getCell(0, 1).running
+    for row, text in [(5, '7'), (6, 'text'), (7, '=MULTIPLY(A9, 2)'),
+                      (8, '1e10'), (5, '-0.3'), (998, '=A1')]:
+        Cell.setRaw(row, 0, text)
+        Cell.recalculate(row, 0)
+    Cell.delete(9, 0)
+    Cell.recalculate(9, 0)
+    numbers = Range(0, 0, 999, 0).getNumbers()
+    assert Cell.getValue(0, 1) == math.fsum(numbers)
+    assert Cell.getValue(1, 1) == math.fsum(numbers) / len(numbers)
+    assert Cell.getValue(2, 1) == 1000
+    assert Cell._store.getCell(0, 1).running is running
+
+    # ...and every other way of summing a range gets the same result (small
+    # ranges and ones with other operands aren't kept as running sums, and
+    # large columnar ones may be summed by NumPy)
+    from formulae.storage import ColumnarCellStore, DictCellStore
+    for storeClass in [DictCellStore, ColumnarCellStore]:
+        Cell.setStorageBackend(storeClass)
+        for numRows in [3, 300]:
+            rawCells = {(row, 0): ['0.1', '0.2', '0.3'][row % 3]
+                        for row in range(numRows)}
+            rawCells.update({(0, 1): f'=SUM(A1:A{numRows})',
+                             (1, 1): f'=SUM(A1:A{numRows}, 0)',
+                             (2, 1): f'=AVERAGE(A1:A{numRows})',
+                             (3, 1): f'=AVERAGE(A1:A{numRows}, '
+                                     f'A1:A{numRows})'})
+            Cell.loadRawCells(rawCells)
+            numbers = Range(0, 0, numRows - 1, 0).getNumbers()
+            assert (Cell.getValue(0, 1) == Cell.getValue(1, 1)
+                    == math.fsum(numbers))
+            assert Cell.getValue(2, 1) == Cell.getValue(3, 1)
+    Cell.setStorageBackend(DictCellStore)
+    assert Formula.fromText('=ADD(0.1, 0.2, 0.3)').evaluate() == 0.6
+    Cell.loadRawCells(None)
+
+    # lookups find cells through column indexes, which follow edits
+    rawCells = {(row, 0): str(row * 10) for row in range(100)}
+    rawCells.update({(row, 1): f'Item{row}' for row in range(100)})
+    rawCells.update({(0, 2): '=VLOOKUP(D1, A1:B100, 2, 0)',
+                     (1, 2): '=VLOOKUP(D1, A1:B100, 2)',
+                     (2, 2): '=MATCH(item3, B1:B100, 0)',
+                     (3, 2): '=INDEX(A1:B100, 4, 2)',
+                     (4, 2): '=COUNTIF(A1:A100, >985)',
+                     (5, 2): '=MATCH(D1, A1:A100, -1)', (0, 3): '25'})
+    Cell.loadRawCells(rawCells)
+    assert [Cell.getValue(row, 2) for row in range(6)] == \
+        [kNotFoundError, 'Item2', 4, 'Item3', 1, 4]
+    Cell.setRaw(0, 3, '990')
+    Cell.setRaw(98, 0, '=ADD(D1, 1)')
+    Cell.recalculate(98, 0)
+    Cell.recalculate(0, 3)
+    assert [Cell.getValue(row, 2) for row in range(6)] == \
+        ['Item99', 'Item99', 4, 'Item3', 2, 100]
+    Cell.loadRawCells(None)
+
+    # errors are typed values that propagate through operators (including
+    # running sums) rather than exceptions
+    Cell.loadRawCells({(0, 0): '3', (1, 0): '=DIVIDE(A1, 0)',
+                       (2, 0): '=INDEX(A1:A3, 5)', (3, 0): '=ABS(A1, A2)',
+                       (4, 0): '=POW(-8, 0.5)', (0, 1): '=SUM(A1:A4)',
+                       (1, 1): '=ADD(A3, A2)', (2, 1): '=COUNT(A1:A5)',
+                       (3, 1): '=VLOOKUP(A2, A1:A3, 1)'})
+    assert [Cell.getValue(row, 0) for row in range(1, 5)] == \
+        [kDivZeroError, kRefError, kValueError, kNumError]
+    assert [Cell.getValue(row, 1) for row in range(4)] == \
+        [kDivZeroError, kRefError, 5, kDivZeroError]
+    assert str(Cell.getValue(1, 0)) == '#DIV/0!'
+    Cell.setRaw(1, 0, '=DIVIDE(A1, 2)')
+    Cell.recalculate(1, 0)
+    assert Cell.getValue(0, 1) is kRefError
+    Cell.setRawMany({(2, 0): '4', (3, 0): '=ABS(A1)'})
+    assert Cell.getValue(0, 1) == 3 + 1.5 + 4 + 3
+    Cell.loadRawCells(None)
+
+    # the profiler counts and times each cell's evaluations
+    import json
+    from formulae.profiler import FormulaProfiler
+    profiler = FormulaProfiler()
+    Cell.setProfiler(profiler)
+    Cell.loadRawCells({(0, 0): '1', (1, 0): '=ADD(A1, 1)',
+                       (2, 0): '=SUM(A1:A2)', (3, 0): '=MULTIPLY(A2, A3)'})
+    assert Cell.getValue(3, 0) == 6
+    Cell.setRaw(0, 0, '2')
+    Cell.recalculate(0, 0)
+    Cell.setProfiler(None)
+    Cell.getValue(0, 0)
+    hotspots = profiler.hotspots(sortBy='fanIn')
+    assert [(profile.name, profile.evaluations, profile.fanIn,
+             profile.fanOut) for profile in hotspots] == \
+        [('A3', 2, 2, 1), ('A4', 2, 2, 0), ('A2', 2, 1, 2)]
+    assert all(0 < profile.selfTime <= profile.totalTime
+               for profile in hotspots)
+    assert len(json.loads(profiler.toJSON())['cells']) == 3
+    assert profiler.report(limit=1).count('\n') == 2
+    # a formula's total time includes the cells it reads that were evaluated
+    # for it, even though they're evaluated before it rather than inside it
+    Cell.loadRawCells({(row, 0): f'=ADD(A{row}, 1)' for row in range(1, 50)})
+    profiler.reset()
+    Cell.setProfiler(profiler)
+    Cell.getValue(49, 0)
+    Cell.setProfiler(None)
+    profiles = profiler.hotspots(sortBy='totalTime')
+    assert profiles[0].name == 'A50' and len(profiles) == 49
+    assert math.isclose(profiles[0].totalTime,
+                        sum(profile.selfTime for profile in profiles))
+    Cell.loadRawCells(None)
+
+    # each sheet keeps its own engine, so switching sheets keeps formulae
+    # parsed and values cached, and edits stay on their own sheet
+    from formulae.engine import SheetEngine
+    first = Cell.getEngine()
+    Cell.loadRawCells({(0, 0): '2', (0, 1): '=MULTIPLY(A1, 3)'})
+    assert Cell.getValue(0, 1) == 6
+    second = SheetEngine.fromRawCells({(0, 0): '5', (1, 0): '=SUM(A1:A1)'})
+    assert Cell.getEngine() is first
+    Cell.setEngine(second)
+    assert Cell.getValue(1, 0) == 5 and not Cell.hasFormula(0, 1)
+    Cell.setRaw(0, 0, '7')
+    Cell.recalculate(0, 0)
+    Cell.resetCacheStats()
+    Cell.setEngine(first)
+    assert Cell.getValue(0, 1) == 6 and Cell.cacheMisses == 0
+    assert second.getRawCells() == {(0, 0): '7', (1, 0): '=SUM(A1:A1)'}
+    assert second.run(Cell.getValue, 1, 0) == 7
+    Cell.loadRawCells(None)
+
+    # in lazy mode, edits only recompute the demanded cells and what they
+    # read; everything else is invalidated (all at once) once it's read
+    rawCells = {(row, 1): f'=MULTIPLY(A1, {row})' for row in range(1000)}
+    rawCells.update({(0, 0): '1', (0, 2): '=SUM(B999:B1000)',
+                     (999, 2): '=ADD(B1000, 1)'})
+    Cell.loadRawCells(rawCells)
+    Cell.setLazyEvaluation(True)
+    Cell.setDemanded([Range(0, 0, 9, 2)])
+    assert Cell.getValue(0, 2) == 998 + 999 and Cell.getValue(999, 2) == 1000
+    assert Cell.getValue(500, 1) == 500
+    Cell.setRaw(0, 0, '2')
+    assert set(Cell.recalculate(0, 0)) == {CellRef(row, 1)
+                                           for row in range(10)} | \
+        {CellRef(998, 1), CellRef(999, 1), CellRef(0, 2)}
+    assert Cell._store.getCell(500, 1).cachedValue == 500
+    assert not Cell._store.getCell(999, 2).dirty
+    assert Cell.getValue(999, 2) == 1999 and Cell.getValue(500, 1) == 1000
+    Cell.setLazyEvaluation(False)
+    Cell.setDemanded([])
+    Cell.loadRawCells(None)
+
+    # filled columns of formulae share a single relative template
+    Cell.loadRawCells(None)
+    for row in range(1, 100):
+        Cell.setRaw(row, 1, str(row))
+        Cell.setRaw(row, 2, '2')
+        Cell.setRaw(row, 0, f'=MULTIPLY(B{row + 1}, SUM(C{row}:C{row + 1}))')
+    assert len({Cell._store.getCell(row, 0).template
+                for row in range(2, 100)}) == 1
+    assert Cell.getValue(50, 0) == 50 * 4
+    assert repr(Cell._store.getCell(50, 0).formula) == \
+        'MULTIPLY(CellRef(50, 1), SUM(Range(49, 2, 50, 2)))'
+    assert Cell.getDependents(50, 1) == {CellRef(50, 0)}
+    Cell.loadRawCells(None)
+
+    # ...but text that reads like a relative reference doesn't share one
+    # with an actual reference, whichever was entered first
+    for order in [[(0, 0), (5, 5)], [(5, 5), (0, 0)]]:
+        Cell.loadRawCells({(0, 1): '7', (5, 6): '8'})
+        for row, col in order:
+            Cell.setRaw(row, col, '=B1' if (row, col) == (0, 0) else '=R0C1')
+        assert [Cell.getValue(0, 0), Cell.getValue(5, 5)] == [7, 'R0C1']
+    Cell.loadRawCells(None)
+
+    # stored refs are interned, so equal refs are usually the same object
+    import pickle
+    Cell.loadRawCells({(0, 1): '=ADD(A1, A1)', (1, 1): '=B1'})
+    assert CellRef(0, 0) is Cell._store.getCell(0, 1).formula.operands[1]
+    assert CellRef(0, 1) is pickle.loads(pickle.dumps(CellRef(0, 1)))
+    assert kDivZeroError is pickle.loads(pickle.dumps(kDivZeroError))
+    assert CellRef(50, 50) == CellRef(50, 50) and \
+        hash(CellRef(50, 50)) == hash(CellRef.interned(50, 50))
+    Cell.loadRawCells(None)
+
+    # non-formula cells are typed once, when set; comma-formatted numbers
+    # stay text but have a numeric view for numerical operators
+    Cell.loadRawCells({(0, 0): '1,000', (1, 0): ' 7', (2, 0): '2.5',
+                       (3, 0): 'hi', (0, 1): '=SUM(A1:A4)'})
+    assert [Cell.getValue(row, 0) for row in range(4)] == \
+        ['1,000', 7, 2.5, 'hi']
+    assert [Cell.getNumericValue(row, 0) for row in range(5)] == \
+        [1000, 7, 2.5, None, None]
+    assert Cell.getValue(0, 1) == 1009.5
+    Cell.loadRawCells(None)
+
+    # the columnar storage backend behaves just like the default one
+    rawCells = {(0, 0): '1', (1, 0): '2.50', (2, 0): '1,000', (3, 0): 'hi',
+                (4, 0): ' 7', (5, 0): '', (6, 0): str(2 ** 60), (7, 0): '-0.5',
+                (0, 1): '=SUM(A1:A8)', (1, 1): '=COUNT(A1:A10)',
+                (2, 1): '=MAX(A1:B1, A8)', (3, 1): '=ADD(A3, A4, 1)',
+                (4, 1): '=ADD(', (9, 3): 'far away'}
+    results = []
+    for storeClass in [DictCellStore, ColumnarCellStore]:
+        Cell.setStorageBackend(storeClass)
+        Cell.loadRawCells(rawCells)
+        assert Cell.getRawCells() == rawCells
+        results.append([(Cell.getValue(row, col), Cell.hasFormula(row, col),
+                         Cell.getNumericValue(row, col))
+                        for row in range(11) for col in range(4)])
+        Cell.delete(0, 0)
+        Cell.setRaw(9, 3, '3')
+        results.append([Cell.getValue(row, col)
+                        for row in range(11) for col in range(4)])
+        Cell.loadRawCells(None)
+        assert Cell.empty()
+    assert results[0] == results[2] and results[1] == results[3]
+    Cell.setStorageBackend(DictCellStore)
+
+    # parallel recalculation gives the same results as serial recalculation
+    from formulae.parallel import ParallelRecalculator
+    rawCells = {(row, 0): str(row) for row in range(1, 40)}
+    rawCells[0, 0] = '1,000'
+    for row in range(40):
+        rawCells[row, 1] = f'=ADD(A1, A{row + 1}, SUM(A{row + 1}:A{row + 5}))'
+        rawCells[row, 2] = f'=MULTIPLY(B{row + 1}, 2)'
+    rawCells[0, 3] = '=DIVIDE(A1, 0)'
+    results = []
+    for recalculator in [None, ParallelRecalculator(2, minParallelCells=1)]:
+        Cell.setRecalculator(recalculator)
+        Cell.loadRawCells(rawCells)
+        for row, col in rawCells:
+            Cell.getValue(row, col)
+        Cell.setRaw(0, 0, '7')
+        results.append((set(Cell.recalculate(0, 0)),
+                        {pos: Cell.getValue(*pos) for pos in rawCells}))
+        if recalculator is not None:
+            recalculator.shutdown()
+    assert results[0] == results[1] and len(results[0][0]) == 80
+    Cell.setRecalculator(None)
+    Cell.loadRawCells(None)
+
+    # the compact dependency graph gives the same answers as the default one,
+    # including after its buffered edits have been merged
+    import random
+    from formulae.data_structures import CompactDependencyGraph, \
+        CSRAdjacency, DependencyGraph
+    CSRAdjacency.kMinPendingEdits = 8
+    graphs = [DependencyGraph(), CompactDependencyGraph()]
+    rng = random.Random(112)
+    for _ in range(500):
+        cellRef = CellRef(rng.randrange(20), rng.randrange(4))
+        dependencies = {CellRef(rng.randrange(20), rng.randrange(4))
+                        for _ in range(rng.randrange(3))}
+        if rng.random() < 0.2:
+            dependencies.add(Range(rng.randrange(20), 0,
+                                   rng.randrange(20), rng.randrange(4)))
+        for graph in graphs:
+            graph.setDependencies(cellRef, dependencies)
+        probe = CellRef(rng.randrange(20), rng.randrange(4))
+        answers = [(graph.getShallowDependents(probe),
+                    graph.getShallowDependencies(probe),
+                    graph.getRangeDependents(probe),
+                    graph.getDependents(probe),
+                    set(graph.getRecalcOrder(probe))) for graph in graphs]
+        assert answers[0] == answers[1]
+    CSRAdjacency.kMinPendingEdits = 4096
+    # (negative numbers stand for ranges, so refs above row 1 can't be kept)
+    try:
+        CompactDependencyGraph().setDependencies(CellRef(0, 0),
+                                                 {CellRef(-1, 0)})
+        assert False
+    except Exception as e:
+        assert str(e) == 'Row -1 is out of bounds'
+
+    Cell.setDependencyGraph(CompactDependencyGraph)
+    Cell.loadRawCells({(0, 0): '1', (0, 1): '=ADD(A1, 1)',
+                       (1, 1): '=SUM(A1:A5)', (0, 2): '=ADD(B1, B2)'})
+    Cell.getValue(0, 2)
+    Cell.setRaw(2, 0, '10')
+    assert Cell.recalculate(2, 0) == [CellRef(1, 1), CellRef(0, 2)]
+    assert Cell.getValue(0, 2) == 13
+    assert Cell.getShallowDependencies(1, 1) == {Range(0, 0, 4, 0)}
+    Cell.setDependencyGraph(DependencyGraph)
+    Cell.loadRawCells(None)
+
+    # a recalculation done in slices (and replaced part-way through by one
+    # for a newer edit) ends up with the same values as doing it at once
+    from formulae.scheduler import SlicedRecalculation
+    Cell.loadRawCells({(row, 1): f'=MULTIPLY(A1, {row})'
+                       for row in range(2000)})
+    Cell.setRaw(0, 0, '2')
+    recalculation = SlicedRecalculation(Cell.getRecalcOrder(0, 0))
+    changed = recalculation.step(sliceTime=0)
+    assert 0 < len(changed) < 2000 and not recalculation.isDone()
+    assert Cell.getValue(1999, 1) == 3998  # (out-of-date cells still read)
+    Cell.setRaw(0, 0, '3')
+    recalculation = SlicedRecalculation.replacing(recalculation,
+                                                  Cell.getRecalcOrder(0, 0))
+    assert recalculation.progress() == 0
+    assert len(recalculation.finish()) == 2000
+    assert [Cell.getValue(row, 1) for row in (1, 1999)] == [3, 5997]
+
+    # the same, on a worker thread, which posts the new values in batches
+    from formulae.worker import EngineWorker
+    worker = EngineWorker()
+    with worker.lock:
+        Cell.setRaw(0, 0, '4')
+        worker.recalculate(0, 0)
+        assert worker.isBusy()
+    worker.wait()
+    assert not worker.isBusy()
+    batches = worker.getBatches()
+    assert batches[-1].done and batches[-1].progress == 1
+    values = dict(value for batch in batches for value in batch.values)
+    # (B1 is A1 times 0, so it doesn't change)
+    assert len(values) == 1999 and values[CellRef(1999, 1)] == 7996
+    worker.stop()
+    Cell.loadRawCells(None)
+
+    # saved workbooks are read (and evaluated) without the UI
+    from formulae.workbook import parseWorkbook
+    sheets = parseWorkbook('One\n' + Cell.serializeRaw(
+        {(0, 0): '2', (0, 1): '=ADD(A1, 1)', (1, 0): '=ADD('}) + '\n\nTwo\n\n')
+    assert [sheet.name for sheet in sheets] == ['One', 'Two']
+    assert list(sheets[0].evaluate()) == [((0, 0), 2), ((0, 1), 3),
+                                          ((1, 0), 'SYNTAX-ERROR')]
+    assert list(sheets[1].evaluate()) == []
+    # (as JSON Lines, non-finite values are text, since JSON has no NaN)
+    import json
+    import os
+    import tempfile
+    from formulae.__main__ import evaluateWorkbook, jsonLine
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'book')
+        with open(path, 'w') as file:
+            file.write('One\n' + Cell.serializeRaw(
+                {(0, 0): 'nan', (0, 1): '=MULTIPLY(1e200, 1e200)',
+                 (0, 2): '1.5'}) + '\n\n')
+        values = [json.loads(jsonLine(record))['value']
+                  for record in evaluateWorkbook(path)]
+    assert values == ['nan', 'inf', 1.5]
+    Cell.loadRawCells(None)
@@ -0,0 +1,131 @@
+# __main__.py
+# Joseph Rotella (jrotella, F0)
+#
+# Headless evaluator for saved workbooks, for getting computed values without
+# the GUI (or any of its dependencies):
+#
+#     python -m formulae [--format csv|jsonl] [--jobs N] PATH...
+#
+# Every sheet of every workbook is evaluated, and every non-empty cell's
+# value is written to standard output, one cell per line, as it's computed.
+# A directory stands for the workbooks in it; with --jobs, workbooks are
+# evaluated by that many processes at once (their output still comes in the
+# order given).
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from formulae.errors import FormulaError
+from formulae.workbook import readWorkbook
+
+kFormats = ['csv', 'jsonl']
+kFields = ['workbook', 'sheet', 'cell', 'row', 'col', 'value']
+
+
+def cellName(row, col):
+    letters = ''
+    col += 1
+    while col > 0:
+        col, letter = divmod(col - 1, 26)
+        letters = chr(ord('A') + letter) + letters
+    return f'{letters}{row + 1}'
+
+
+# Returns the output records (dicts of kFields) of every cell in a workbook
+def evaluateWorkbook(path):
+    for sheet in readWorkbook(path):
+        for (row, col), value in sheet.evaluate():
+            if isinstance(value, FormulaError):
+                value = value.code
+            yield {'workbook': path, 'sheet': sheet.name,
+                   'cell': cellName(row, col), 'row': row, 'col': col,
+                   'value': value}
+
+
+# Returns a record as a line of JSON. Non-finite numbers (e.g., a cell holding
+# nan or inf) aren't valid JSON, so they're written as the text the grid
+# shows for them instead.
+def jsonLine(record):
+    value = record['value']
+    if isinstance(value, float) and not math.isfinite(value):
+        record = dict(record, value=str(value))
+    return json.dumps(record, allow_nan=False) + '\n'
+
+
+# (runs in a worker process, which can only send back whole results)
+def _evaluateWorkbookToList(path):
+    return list(evaluateWorkbook(path))
+
+
+# Returns the workbook files the given paths stand for, in order
+def findWorkbooks(paths):
+    workbooks = []
+    for path in paths:
+        if os.path.isdir(path):
+            workbooks += sorted(os.path.join(path, name)
+                                for name in os.listdir(path)
+                                if not name.startswith('.')
+                                and os.path.isfile(os.path.join(path, name)))
+        else:
+            workbooks.append(path)
+    return workbooks
+
+
+# Writes the records of the given workbooks' cells in order, evaluating up
+# to jobs workbooks at once. Returns whether every workbook could be read.
+def writeWorkbooks(workbooks, write, jobs=1):
+    if jobs <= 1 or len(workbooks) <= 1:
+        results = [lambda path=path: evaluateWorkbook(path)
+                   for path in workbooks]
+        return _writeResults(workbooks, results, write)
+    with ProcessPoolExecutor(jobs) as pool:
+        results = [pool.submit(_evaluateWorkbookToList, path).result
+                   for path in workbooks]
+        return _writeResults(workbooks, results, write)
+
+
+# (results are functions returning each workbook's records)
+def _writeResults(workbooks, results, write):
+    succeeded = True
+    for path, result in zip(workbooks, results):
+        try:
+            for record in result():
+                write(record)
+        except Exception as e:
+            # (a workbook that can't be read shouldn't stop the others)
+            print(f'{path}: could not be read ({e})', file=sys.stderr)
+            succeeded = False
+    return succeeded
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m formulae',
+        description='Evaluates SimpleSheets workbooks, writing every cell\'s '
+                    'value to standard output.')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='workbook file, or directory of workbooks')
+    parser.add_argument('--format', choices=kFormats, default='csv',
+                        help='output format (default: csv)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='how many workbooks to evaluate at once')
+    options = parser.parse_args(args)
+
+    if options.format == 'csv':
+        writer = csv.DictWriter(sys.stdout, kFields, lineterminator='\n')
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        write = lambda record: sys.stdout.write(jsonLine(record))
+
+    succeeded = writeWorkbooks(findWorkbooks(options.paths), write,
+                               options.jobs)
+    return 0 if succeeded else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
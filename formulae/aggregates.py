@@ -0,0 +1,148 @@
+# aggregates.py
+# Joseph Rotella (jrotella, F0)
+#
+# Running state for formulae that aggregate a single range (e.g.,
+# =SUM(A1:A50000)), so that when one cell in the range changes, the result can
+# be updated by applying the change (old value -> new value) in constant time
+# instead of re-reading the whole range.
+import math
+
+from formulae.errors import FormulaError
+
+# every finite float is a whole multiple of 2 ** -kFloatShift
+kFloatShift = 1074
+# float64 represents every int smaller than this exactly
+kMaxExactInt = 2 ** 53
+
+
+# Returns a finite float as an exact whole number of 2 ** -kFloatShift units
+def _scaledFloat(number):
+    numerator, denominator = number.as_integer_ratio()
+    # (the denominator is always a power of two)
+    return numerator << (kFloatShift + 1 - denominator.bit_length())
+
+
+# Returns numerator / denominator as a float, rounded correctly (which int
+# division already does), but overflowing to infinity like float sums do
+def _divide(numerator, denominator):
+    try:
+        return numerator / denominator
+    except OverflowError:
+        return math.copysign(math.inf, numerator)
+
+
+# The running sum and count of some numbers. Sums are kept exactly (ints as
+# ints, floats as whole numbers of tiny units), so removing a number undoes
+# adding it exactly, and the result never drifts no matter how many changes
+# are applied: it's always the correctly rounded sum of the current numbers.
+class RunningSum(object):
+    def __init__(self, numbers=()):
+        self.count = 0
+        self.floatCount = 0  # (if any numbers are floats, so is the sum)
+        self.intTotal = 0
+        self.floatTotal = 0  # in units of 2 ** -kFloatShift
+        # infinities and NaNs can't be scaled, so they're just counted
+        self.nanCount = 0
+        self.infCount = 0
+        self.negativeInfCount = 0
+        # errors (see formulae.errors) are also just counted; while there are
+        # any, the total is an error
+        self.errorCount = 0
+        for number in numbers:
+            self.add(number)
+
+    # Adds a number (or removes it, if weight is -1). None (the numeric view
+    # of a non-numerical value) is ignored.
+    def add(self, number, weight=1):
+        if number is None:
+            return
+        elif isinstance(number, FormulaError):
+            self.errorCount += weight
+            return
+        self.count += weight
+        if not isinstance(number, float):
+            self.intTotal += weight * number
+            return
+        self.floatCount += weight
+        if math.isfinite(number):
+            self.floatTotal += weight * _scaledFloat(number)
+        elif number != number:
+            self.nanCount += weight
+        elif number > 0:
+            self.infCount += weight
+        else:
+            self.negativeInfCount += weight
+
+    def remove(self, number):
+        self.add(number, -1)
+
+    # Applies a change to one of the numbers
+    def replace(self, oldNumber, newNumber):
+        self.remove(oldNumber)
+        self.add(newNumber)
+
+    # Returns inf, -inf, or NaN if any non-finite numbers decide the sum,
+    # otherwise None
+    def _nonFiniteTotal(self):
+        if self.nanCount or (self.infCount and self.negativeInfCount):
+            return math.nan
+        elif self.infCount:
+            return math.inf
+        elif self.negativeInfCount:
+            return -math.inf
+        return None
+
+    def total(self):
+        nonFinite = self._nonFiniteTotal()
+        if nonFinite is not None:
+            return nonFinite
+        elif self.floatCount == 0:
+            return self.intTotal
+        return _divide((self.intTotal << kFloatShift) + self.floatTotal,
+                       1 << kFloatShift)
+
+    # (0 if there are no numbers, like AVERAGE)
+    def mean(self):
+        nonFinite = self._nonFiniteTotal()
+        if nonFinite is not None:
+            return nonFinite
+        elif self.count == 0:
+            return 0
+        elif self.floatCount == 0:
+            return _divide(self.intTotal, self.count)
+        return _divide((self.intTotal << kFloatShift) + self.floatTotal,
+                       self.count << kFloatShift)
+
+
+# Returns the sum of some numbers, exactly as a RunningSum of them would
+# have it (an int if they're all ints, otherwise the correctly rounded sum),
+# so that a range's sum is the same however it's computed
+def exactSum(numbers):
+    total = sum(numbers)
+    if type(total) is int:
+        return total
+    # fsum is also correctly rounded, as long as every int is exactly a float
+    # and no partial sum overflows
+    if all(type(number) is float or abs(number) < kMaxExactInt
+           for number in numbers):
+        return floatSum(numbers)
+    return RunningSum(numbers).total()
+
+
+# (the same, for numbers that are all exactly floats)
+def floatSum(numbers):
+    try:
+        return math.fsum(numbers)
+    except (OverflowError, ValueError):  # (e.g., inf + -inf)
+        return RunningSum(numbers).total()
+
+
+# Returns the mean of some numbers (0 if there are none), exactly as a
+# RunningSum of them would have it
+def exactMean(numbers):
+    if not numbers:
+        return 0
+    total = sum(numbers)
+    if type(total) is int:
+        return _divide(total, len(numbers))
+    return RunningSum(numbers).mean()
@@ -0,0 +1,645 @@
+# benchmarks.py
+# Joseph Rotella (jrotella, F0)
+#
+# Rough timing benchmarks for the formula engine. Run from the main project
+# directory with `python -m formulae.benchmarks [name ...]` (runs all of them
+# if no names are given).
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from formulae import Cell, CellRef, Formula, FormulaTemplate, Range
+from formulae.data_structures import CompactDependencyGraph, DependencyGraph
+
+
+# Times a function, returning its result and the elapsed time in seconds
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+# Runs a function, returning its result and how many bytes of memory were
+# allocated (and not freed) while it ran. Tracing is slow, so don't time this.
+def measured(fn, *args):
+    tracemalloc.start()
+    result = fn(*args)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, retained
+
+
+def reportMemory(label, numBytes, count):
+    print(f'  {label}: {numBytes / 2 ** 20:.1f} MB '
+          f'({numBytes / count:.0f} bytes each)')
+
+
+def report(label, seconds, count=None):
+    if count:
+        print(f'  {label}: {seconds * 1000:.1f} ms '
+              f'({seconds / count * 1e6:.2f} us each)')
+    else:
+        print(f'  {label}: {seconds * 1000:.1f} ms')
+
+
+# 100k formulas, each summing a 10-row window of column A, looked up through
+# the range index vs. a linear scan over every range
+def benchmarkRangeIndex(numFormulas=100000, numLookups=10000):
+    deps = DependencyGraph()
+
+    def build():
+        for row in range(numFormulas):
+            deps.setDependencies(CellRef(row, 1),
+                                 {Range(row, 0, row + 9, 0)})
+
+    _, buildTime = timed(build)
+    report(f'index {numFormulas} range dependencies', buildTime, numFormulas)
+
+    lookups = [CellRef(random.randrange(numFormulas), 0)
+               for _ in range(numLookups)]
+
+    def indexed():
+        return [len(deps.getShallowDependents(ref)) for ref in lookups]
+
+    def scanned():
+        counts = []
+        for ref in lookups:
+            count = 0
+            for cellRange in deps.rangeDependents:
+                if cellRange.contains(ref.row, ref.col):
+                    count += len(deps.rangeDependents[cellRange])
+            counts.append(count)
+        return counts
+
+    indexedCounts, indexedTime = timed(indexed)
+    report('indexed lookups', indexedTime, numLookups)
+    # a full scan is slow enough that a sample will do
+    sampleSize = max(numLookups // 100, 1)
+    lookups = lookups[:sampleSize]
+    scannedCounts, scanTime = timed(scanned)
+    report('linear-scan lookups', scanTime, sampleSize)
+    assert scannedCounts == indexedCounts[:sampleSize]
+
+    # end-to-end: editing a cell under 10 overlapping range formulas
+    Cell.loadRawCells(None)
+    for row in range(numFormulas // 10):
+        Cell.setRaw(row, 0, str(row))
+    for row in range(numFormulas // 10):
+        Cell.setRaw(row, 1, f'=SUM(A{row + 1}:A{row + 10})')
+
+    def edit():
+        for row in range(0, numFormulas // 10, 100):
+            Cell.setRaw(row, 0, '1')
+            Cell.recalculate(row, 0)
+
+    _, editTime = timed(edit)
+    report('edit + recalculate under ranges', editTime, numFormulas // 1000)
+    Cell.loadRawCells(None)
+
+
+# A column of structurally identical formulae, parsed per cell vs. shared
+# through interned templates
+def benchmarkSharedFormulae(numRows=100000):
+    texts = [f'=MULTIPLY(B{row + 1}, C{row + 1})' for row in range(numRows)]
+
+    def parseSeparately():
+        formulae = []
+        for text in texts:
+            formula = Formula.fromText(text)
+            formulae.append((formula, formula.compile()))
+        return formulae
+
+    def loadShared():
+        Cell.loadRawCells(None)
+        for row in range(numRows):
+            Cell.setRaw(row, 0, texts[row])
+
+    # a sample is enough to see the per-formula cost of separate parsing
+    sampleSize = numRows // 10
+    fullTexts, texts = texts, texts[:sampleSize]
+    _, separateTime = timed(parseSeparately)
+    report(f'parse + compile {sampleSize} formulae separately',
+           separateTime, sampleSize)
+    _, separateMemory = measured(parseSeparately)
+    reportMemory('per-cell trees and compiled code', separateMemory,
+                 sampleSize)
+
+    texts = fullTexts
+    _, sharedTime = timed(loadShared)
+    report(f'setRaw {numRows} shared formulae', sharedTime, numRows)
+    print(f'  {FormulaTemplate.count()} template(s) in use')
+    Cell.loadRawCells(None)
+    _, sharedMemory = measured(loadShared)
+    reportMemory('whole cells (raw text, shared template, dependencies)',
+                 sharedMemory, numRows)
+    Cell.loadRawCells(None)
+
+
+# Aggregates over a 100k-cell column of mixed numbers and text, with and
+# without NumPy, in each storage backend (only the columnar one reads ranges
+# as arrays; the default one always aggregates in pure Python)
+def benchmarkVectorizedAggregates(numRows=100000, repeats=5):
+    from formulae import operators
+    from formulae.storage import DictCellStore, ColumnarCellStore
+    rawCells = {(row, 0): str(row) if row % 10 else 'text'
+                for row in range(numRows)}
+    formulae = [Formula.fromText(f'={name}(A1:A{numRows})').compile()
+                for name in ['SUM', 'AVERAGE', 'MIN', 'MAX', 'MODE']]
+
+    def evaluate():
+        return [compiled(0, 0) for _ in range(repeats)
+                for compiled in formulae]
+
+    numpy = operators.numpy
+    if numpy is None:
+        print('  NumPy is not installed; only timing pure Python')
+    for storeClass in [DictCellStore, ColumnarCellStore]:
+        print(f'  {storeClass.__name__}:')
+        Cell.setStorageBackend(storeClass)
+        Cell.loadRawCells(rawCells)
+        for row in range(numRows):
+            Cell.getValue(row, 0)  # warm the value cache
+        if numpy is not None:
+            vectorResults, vectorTime = timed(evaluate)
+            report('  with NumPy available', vectorTime, len(vectorResults))
+        operators.numpy = None
+        try:
+            pythonResults, pythonTime = timed(evaluate)
+        finally:
+            operators.numpy = numpy
+        report('  pure-Python aggregates', pythonTime, len(pythonResults))
+        Cell.loadRawCells(None)
+    Cell.setStorageBackend(DictCellStore)
+
+
+# A 500k-cell imported dataset (mostly numbers, some text) in each storage
+# backend: memory held, and the time to aggregate a column
+def benchmarkStorageBackends(numRows=50000, numCols=10):
+    from formulae.storage import DictCellStore, ColumnarCellStore
+    rawCells = {}
+    for row in range(numRows):
+        for col in range(numCols):
+            if col == 0:
+                rawCells[row, col] = f'Item {row % 1000}'
+            elif col % 2:
+                rawCells[row, col] = str(row * col)
+            else:
+                rawCells[row, col] = f'{row / (col + 1):.2f}'
+    numCells = numRows * numCols
+    sumColumn = Formula.fromText(f'=SUM(B1:B{numRows})').compile()
+
+    for storeClass in [DictCellStore, ColumnarCellStore]:
+        print(f'  {storeClass.__name__}:')
+        Cell.setStorageBackend(storeClass)
+        _, loadTime = timed(Cell.loadRawCells, rawCells)
+        report(f'  load {numCells} cells', loadTime, numCells)
+        total, sumTime = timed(sumColumn, 0, 0)
+        report(f'  SUM over {numRows} rows', sumTime)
+        Cell.loadRawCells(None)
+        _, memory = measured(Cell.loadRawCells, rawCells)
+        reportMemory('  memory held', memory, numCells)
+        Cell.loadRawCells(None)
+    Cell.setStorageBackend(DictCellStore)
+
+
+# A 1M-cell sheet (100k rows of 9 numbers or labels and a formula reading its
+# row and a shared rate cell): memory held per cell, and the time to hash refs
+def benchmarkCellMemory(numRows=100000, numCols=10):
+    rawCells = {}
+    for row in range(numRows):
+        for col in range(numCols - 1):
+            rawCells[row, col] = str(row * col) if col else f'Item {row}'
+        rawCells[row, numCols - 1] = f'=MULTIPLY(B{row + 1}, B1)'
+    numCells = numRows * numCols
+
+    Cell.loadRawCells(None)
+    _, memory = measured(Cell.loadRawCells, rawCells)
+    reportMemory(f'{numCells} cells', memory, numCells)
+    refs = list(Cell._deps.dependencies)
+    _, hashTime = timed(lambda: [hash(ref) for ref in refs])
+    report(f'hash {len(refs)} refs', hashTime, len(refs))
+    Cell.loadRawCells(None)
+
+
+# 300k formula cells with 3 dependencies each (two cells in their row, and
+# the cell above, so each column is one long chain) in each dependency graph
+def benchmarkDependencyGraphs(numRows=300000):
+    def build(graph):
+        graph.setDependencies(CellRef(0, 3), {CellRef(0, 0), CellRef(0, 1)})
+        for row in range(1, numRows):
+            graph.setDependencies(CellRef(row, 3), {
+                CellRef(row, 0), CellRef(row, 1), CellRef(row - 1, 3)})
+        graph.compact()
+        return graph
+
+    numEdges = numRows * 3 - 1
+    for graphClass in [DependencyGraph, CompactDependencyGraph]:
+        print(f'  {graphClass.__name__}:')
+        graph, buildTime = timed(build, graphClass())
+        report(f'  add {numEdges} edges', buildTime, numEdges)
+        order, orderTime = timed(graph.getRecalcOrder, CellRef(0, 0))
+        report(f'  recalc order of {len(order)} cells', orderTime)
+        graph = None
+        graph, memory = measured(build, graphClass())
+        reportMemory('  memory held', memory, numEdges)
+        # (so the next graph isn't timed while the garbage collector is also
+        # going through this one's millions of objects)
+        graph = None
+
+
+# Recalculating 40k formulae that all read A1 (so they form one big level of
+# independent cells), serially and across processes
+def benchmarkParallelRecalc(numRows=40000, numWorkers=4):
+    from formulae.parallel import ParallelRecalculator
+    Cell.loadRawCells(None)
+    for row in range(numRows + 100):
+        Cell.setRaw(row, 0, str(row))
+    for row in range(numRows):
+        Cell.setRaw(row, 1, f'=ADD(A1, AVERAGE(A{row + 1}:A{row + 100}), '
+                            f'MAX(A{row + 1}:A{row + 100}))')
+
+    def editAndRecalculate(value):
+        Cell.setRaw(0, 0, value)
+        return Cell.recalculate(0, 0)
+
+    recalculator = ParallelRecalculator(numWorkers)
+    Cell.setRecalculator(recalculator)
+    editAndRecalculate('-1')  # starts up the worker processes
+    for label, engine in [('serial', None),
+                          (f'{numWorkers} processes', recalculator)]:
+        Cell.setRecalculator(engine)
+        for value in ['1', '2']:
+            changed, recalcTime = timed(editAndRecalculate, value)
+            assert len(changed) == numRows
+        report(f'{label}: recalculate {numRows} cells', recalcTime, numRows)
+    print(f'  ({os.cpu_count()} CPU core(s) available; with fewer than '
+          f'{numWorkers}, the processes just add overhead)')
+    Cell.setRecalculator(None)
+    recalculator.shutdown()
+    Cell.loadRawCells(None)
+
+
+# A single column of 1M formulae, each adding 1 to the cell above: reading
+# the last one (which computes the whole chain), then editing the first
+def benchmarkLongChains(numRows=1000000):
+    Cell.loadRawCells(None)
+    Cell.setRaw(0, 0, '0')
+    for row in range(1, numRows):
+        Cell.setRaw(row, 0, f'=ADD(A{row}, 1)')
+
+    value, readTime = timed(Cell.getValue, numRows - 1, 0)
+    assert value == numRows - 1
+    report(f'read the end of a {numRows}-cell chain', readTime, numRows)
+
+    def editAndRecalculate():
+        Cell.setRaw(0, 0, '1')
+        return Cell.recalculate(0, 0)
+
+    changed, recalcTime = timed(editAndRecalculate)
+    assert len(changed) == numRows - 1
+    report('edit + recalculate the chain', recalcTime, numRows)
+    Cell.loadRawCells(None)
+
+
+# Editing one cell at a time under SUM/AVERAGE/COUNT formulae over a 50k-row
+# column of imported numbers: kept as running sums vs. re-reading the range
+# (which formulae with more than just the range as operands still do)
+def benchmarkRunningAggregates(numRows=50000, numEdits=1000):
+    rawCells = {(row, 0): f'{row * 1.5}' for row in range(numRows)}
+    rng = random.Random(16)
+    edits = [(rng.randrange(numRows), f'{rng.uniform(0, 1000):.2f}')
+             for _ in range(numEdits)]
+
+    def editAndRecalculate(edits):
+        for row, text in edits:
+            Cell.setRaw(row, 0, text)
+            Cell.recalculate(row, 0)
+
+    # re-reading is slow enough that a sample of edits will do
+    for label, extraOperand, sample in [
+            ('running sums', '', edits),
+            ('re-reading the range', ', 0', edits[:numEdits // 50])]:
+        Cell.loadRawCells(rawCells)
+        for row, name in enumerate(['SUM', 'AVERAGE', 'COUNT']):
+            Cell.setRaw(row, 1, f'={name}(A1:A{numRows}{extraOperand})')
+            Cell.getValue(row, 1)
+        _, editTime = timed(editAndRecalculate, sample)
+        report(f'{label}: edit + recalculate', editTime, len(sample))
+    Cell.loadRawCells(None)
+
+
+# 1000 exact and 1000 approximate VLOOKUPs into a 100k-row table, found
+# through column indexes vs. scanning the table's first column
+def benchmarkLookups(numRows=100000, numLookups=1000):
+    rng = random.Random(17)
+    rawCells = {}
+    for row in range(numRows):
+        rawCells[row, 0] = str(row * 10)
+        rawCells[row, 1] = f'Item {row}'
+    for row in range(numLookups):
+        rawCells[row, 2] = str(rng.randrange(numRows) * 10)
+        rawCells[row, 3] = f'=VLOOKUP(C{row + 1}, A1:B{numRows}, 2, 0)'
+        rawCells[row, 4] = f'=VLOOKUP(ADD(C{row + 1}, 5), A1:B{numRows}, 2)'
+    Cell.loadRawCells(rawCells)
+
+    def evaluate():
+        return [Cell.getValue(row, col)
+                for row in range(numLookups) for col in [3, 4]]
+
+    results, lookupTime = timed(evaluate)
+    report(f'{len(results)} indexed lookups (incl. building the index)',
+           lookupTime, len(results))
+
+    def editAndRecalculate():
+        for row in range(numLookups):
+            Cell.setRaw(row, 2, str(rng.randrange(numRows) * 10))
+            Cell.recalculate(row, 2)
+
+    _, editTime = timed(editAndRecalculate)
+    report('edit a key + recalculate its lookups', editTime, numLookups)
+
+    # a scan is slow enough that a sample will do
+    keyColumn = Range(0, 0, numRows - 1, 0)
+    sample = [Cell.getValue(row, 2) for row in range(numLookups // 100)]
+
+    def scan():
+        return [keyColumn.getValues().index(key) for key in sample]
+
+    _, scanTime = timed(scan)
+    report('linear-scan lookups', scanTime, len(sample))
+    Cell.loadRawCells(None)
+
+
+# Importing a 50k-cell table (5k rows of 10 numbers) under row totals and a
+# grand total: one setRaw + recalculate per cell, like saving each cell in the
+# grid, vs. a single setRawMany
+def benchmarkBulkWrites(numRows=5000, numCols=10):
+    table = {(row, col): str(row * col)
+             for row in range(numRows) for col in range(numCols)}
+    numCells = len(table)
+    lastCol = chr(ord('A') + numCols - 1)
+    totalCol = chr(ord('A') + numCols)
+
+    def setUp():
+        Cell.loadRawCells(None)
+        for row in range(numRows):
+            Cell.setRaw(row, numCols, f'=SUM(A{row + 1}:{lastCol}{row + 1})')
+        Cell.setRaw(0, numCols + 1, f'=SUM({totalCol}1:{totalCol}{numRows})')
+        Cell.getValue(0, numCols + 1)
+
+    def importOneByOne(cells):
+        for row, col in cells:
+            Cell.setRaw(row, col, cells[row, col])
+            Cell.recalculate(row, col)
+
+    # one by one is slow enough that a sample will do
+    setUp()
+    sample = dict(list(table.items())[:numCells // 10])
+    _, oneByOneTime = timed(importOneByOne, sample)
+    report(f'setRaw + recalculate {len(sample)} cells one by one',
+           oneByOneTime, len(sample))
+
+    setUp()
+    changed, bulkTime = timed(Cell.setRawMany, table)
+    report(f'setRawMany {numCells} cells', bulkTime, numCells)
+    assert len(changed) == numRows  # (the first row's totals stay 0)
+    Cell.loadRawCells(None)
+
+
+# Recalculating 100k formulae (a chain, plus a few slow range formulae) with
+# and without the profiler, and the profiler's report
+def benchmarkProfiler(numRows=100000):
+    from formulae.profiler import FormulaProfiler
+    Cell.loadRawCells(None)
+    Cell.setRaw(0, 0, '0')
+    for row in range(1, numRows):
+        Cell.setRaw(row, 0, f'=ADD(A{row}, 1)')
+    for row in range(3):
+        Cell.setRaw(row, 1, f'=MODE(A1:A{numRows}, {row})')
+    Cell.getValue(0, 1)
+
+    def editAndRecalculate(value):
+        Cell.setRaw(0, 0, value)
+        return Cell.recalculate(0, 0)
+
+    profiler = FormulaProfiler()
+    for label, engine, value in [('without profiler', None, '1'),
+                                 ('with profiler', profiler, '2')]:
+        Cell.setProfiler(engine)
+        _, recalcTime = timed(editAndRecalculate, value)
+        report(f'{label}: recalculate {numRows} cells', recalcTime, numRows)
+    Cell.setProfiler(None)
+    print('\n'.join(f'  {line}' for line in profiler.report(5).split('\n')))
+    Cell.loadRawCells(None)
+
+
+# How numberize used to convert text operands, by trying int() and float()
+# and catching the exceptions (kept here for comparison)
+def _numberizeByExceptions(operand):
+    try:
+        return int(operand.replace(',', ''))
+    except:
+        try:
+            return float(operand.replace(',', ''))
+        except:
+            return None
+
+
+# Evaluating 50k rows of divisions (and formulae reading them, and text
+# cells) on a clean sheet vs. a sheet where half of them are errors, plus
+# converting text operands with and without exceptions
+def benchmarkErrorValues(numRows=50000):
+    from formulae.operators import numberize
+
+    def evaluateSheet():
+        return [Cell.getValue(row, 3) for row in range(numRows)]
+
+    for label, divisors in [('clean sheet', ['1', '2']),
+                            ('half errors', ['0', '2']),
+                            ('half text', ['n/a', '2'])]:
+        rawCells = {}
+        for row in range(numRows):
+            rawCells[row, 0] = str(row)
+            rawCells[row, 1] = divisors[row % len(divisors)]
+            rawCells[row, 2] = f'=DIVIDE(A{row + 1}, B{row + 1})'
+            rawCells[row, 3] = f'=ADD(C{row + 1}, B{row + 1}, 1)'
+        Cell.loadRawCells(rawCells)
+        _, evaluateTime = timed(evaluateSheet)
+        report(f'{label}: evaluate {numRows * 2} formulae', evaluateTime,
+               numRows * 2)
+
+    texts = [f'Item {row}' for row in range(numRows)]
+    for label, fn in [('with exceptions', _numberizeByExceptions),
+                      ('with precheck', numberize)]:
+        _, convertTime = timed(lambda: [fn(text) for text in texts])
+        report(f'{label}: numberize {numRows} text operands', convertTime,
+               numRows)
+    Cell.loadRawCells(None)
+
+
+# Switching between two sheets of 20k formulae each by reloading their raw
+# cells (as the app used to) vs. swapping their engines
+def benchmarkSheetSwitching(numRows=20000, numSwitches=10):
+    from formulae.engine import SheetEngine
+
+    def makeSheet(offset):
+        rawCells = {(row, 0): str(row + offset) for row in range(numRows)}
+        rawCells.update({(row, 1): f'=MULTIPLY(A{row + 1}, 2)'
+                         for row in range(numRows)})
+        return rawCells
+
+    sheets = [makeSheet(0), makeSheet(1)]
+
+    def switchByReloading():
+        for i in range(numSwitches):
+            sheets[i % 2] = Cell.getRawCells()
+            Cell.loadRawCells(sheets[(i + 1) % 2])
+            Cell.getValue(numRows - 1, 1)
+
+    Cell.loadRawCells(sheets[1])
+    _, reloadTime = timed(switchByReloading)
+    report(f'reload {numRows * 2} cells on switch', reloadTime, numSwitches)
+
+    engines = [SheetEngine.fromRawCells(rawCells) for rawCells in sheets]
+
+    def switchEngines():
+        for i in range(numSwitches):
+            Cell.setEngine(engines[(i + 1) % 2])
+            Cell.getValue(numRows - 1, 1)
+
+    Cell.setEngine(engines[0])
+    Cell.getValue(numRows - 1, 1)
+    _, switchTime = timed(switchEngines)
+    report(f'swap engines of {numRows * 2} cells on switch', switchTime,
+           numSwitches)
+    Cell.setEngine(SheetEngine())
+
+
+# Editing a cell that 200k off-screen formulae read, recalculating
+# everything vs. only what's on screen (lazily), and then scrolling to the
+# bottom, where the lazily skipped formulae are computed as they're read
+def benchmarkLazyEvaluation(numRows=200000, numEdits=5):
+    rawCells = {(row, 1): f'=MULTIPLY(A1, {row})' for row in range(numRows)}
+    rawCells[0, 0] = '1'
+    screen = Range(0, 0, 19, 8)
+
+    def editAndRecalculate():
+        for edit in range(numEdits):
+            Cell.setRaw(0, 0, str(edit + 2))
+            Cell.recalculate(0, 0)
+            for row in range(screen.startRow, screen.endRow + 1):
+                for col in range(screen.startCol, screen.endCol + 1):
+                    Cell.getValue(row, col)
+
+    def scrollToBottom():
+        Cell.setDemanded([Range(numRows - 20, 0, numRows - 1, 8)])
+        return [Cell.getValue(row, 1) for row in range(numRows - 20, numRows)]
+
+    for label, lazy in [('eager', False), ('lazy', True)]:
+        Cell.loadRawCells(rawCells)
+        Cell.setLazyEvaluation(lazy)
+        Cell.setDemanded([screen])
+        Cell.getValue(numRows - 1, 1)  # (everything's been computed once)
+        _, editTime = timed(editAndRecalculate)
+        report(f'{label}: edit feeding {numRows} formulae', editTime,
+               numEdits)
+        values, scrollTime = timed(scrollToBottom)
+        assert values[-1] == (numEdits + 1) * (numRows - 1)
+        report(f'{label}: then scroll to the bottom', scrollTime)
+    Cell.setLazyEvaluation(False)
+    Cell.setDemanded([])
+    Cell.loadRawCells(None)
+
+
+# Editing a cell that 200k formulae read, recalculating everything at once
+# vs. in time slices (see formulae.scheduler): the UI is frozen for the
+# whole recalculation in the first case, but only for the longest slice in
+# the second
+def benchmarkSlicedRecalc(numRows=200000):
+    from formulae.scheduler import SlicedRecalculation
+    rawCells = {(row, 1): f'=MULTIPLY(A1, {row})' for row in range(numRows)}
+    rawCells[0, 0] = '1'
+    Cell.loadRawCells(rawCells)
+    Cell.getValue(numRows - 1, 1)
+
+    Cell.setRaw(0, 0, '2')
+    _, recalcTime = timed(Cell.recalculate, 0, 0)
+    report(f'at once: edit feeding {numRows} formulae', recalcTime)
+
+    Cell.setRaw(0, 0, '3')
+    order, orderTime = timed(Cell.getRecalcOrder, 0, 0)
+    recalculation = SlicedRecalculation(order)
+    sliceTimes = []
+    while not recalculation.isDone():
+        sliceTimes.append(timed(recalculation.step)[1])
+    assert Cell.getValue(numRows - 1, 1) == 3 * (numRows - 1)
+    report('sliced: finding the cells to recompute', orderTime)
+    report(f'sliced: {len(sliceTimes)} slices, in total', sum(sliceTimes))
+    report('sliced: longest slice (longest the UI waits)', max(sliceTimes))
+    Cell.loadRawCells(None)
+
+
+# Editing a cell that 200k formulae read with the recalculation on a worker
+# thread (see formulae.worker), while this thread stands in for the UI,
+# reading a cell every few milliseconds: how long those reads wait for the
+# engine
+def benchmarkEngineWorker(numRows=200000):
+    from formulae.worker import EngineWorker
+    rawCells = {(row, 1): f'=MULTIPLY(A1, {row})' for row in range(numRows)}
+    rawCells[0, 0] = '1'
+    Cell.loadRawCells(rawCells)
+    Cell.getValue(numRows - 1, 1)
+    worker = EngineWorker()
+
+    start = time.perf_counter()
+    with worker.lock:
+        Cell.setRaw(0, 0, '2')
+        worker.recalculate(0, 0)
+    waits = []
+    done = False
+    while not done:
+        time.sleep(0.005)
+        readStart = time.perf_counter()
+        with worker.lock:
+            Cell.getValue(0, 1)
+        waits.append(time.perf_counter() - readStart)
+        done = any(batch.done for batch in worker.getBatches())
+    recalcTime = time.perf_counter() - start
+    worker.stop()
+    assert Cell.getValue(numRows - 1, 1) == 2 * (numRows - 1)
+    report(f'recalculating {numRows} formulae in the background', recalcTime)
+    waits.sort()
+    report(f'{len(waits)} reads meanwhile, median', waits[len(waits) // 2])
+    # (the worker holds the lock while it works out which cells depend on
+    # the edited one, which isn't done in slices)
+    report('longest read', waits[-1])
+    Cell.loadRawCells(None)
+
+
+kBenchmarks = {
+    'range-index': benchmarkRangeIndex,
+    'shared-formulae': benchmarkSharedFormulae,
+    'vectorized-aggregates': benchmarkVectorizedAggregates,
+    'storage-backends': benchmarkStorageBackends,
+    'cell-memory': benchmarkCellMemory,
+    'dependency-graphs': benchmarkDependencyGraphs,
+    'parallel-recalc': benchmarkParallelRecalc,
+    'long-chains': benchmarkLongChains,
+    'running-aggregates': benchmarkRunningAggregates,
+    'lookups': benchmarkLookups,
+    'bulk-writes': benchmarkBulkWrites,
+    'profiler': benchmarkProfiler,
+    'error-values': benchmarkErrorValues,
+    'sheet-switching': benchmarkSheetSwitching,
+    'lazy-evaluation': benchmarkLazyEvaluation,
+    'sliced-recalc': benchmarkSlicedRecalc,
+    'engine-worker': benchmarkEngineWorker,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(kBenchmarks)
+    for name in names:
+        print(name)
+        kBenchmarks[name]()
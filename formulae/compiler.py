@@ -0,0 +1,131 @@
+# compiler.py
+# Joseph Rotella (jrotella, F0)
+#
+# Compiles parsed Formula trees into flat Python functions so that evaluating
+# a cell doesn't have to walk the tree (and re-check every operand's type)
+# each time it's read.
+
+from formulae.errors import kValueError
+from formulae.operators import applyNumerical, numberizeOperands
+
+
+class FormulaCompiler(object):
+    def __init__(self, getValue, getNumber, relative=False):
+        # getValue(row, col) is used to read referenced cells at runtime, and
+        # getNumber(row, col) to read their numeric views (or None)
+        self.relative = relative
+        self.namespace = {'_get': getValue, '_getNum': getNumber,
+                          '_applyNum': applyNumerical}
+        self.nextName = 0
+
+    # Returns a function of an anchor (row, col) equivalent to
+    # formula.evaluate(), or a wrapper around formula.evaluate if the formula
+    # can't be compiled (e.g., it's nested too deeply for Python's compiler).
+    # If compiling relatively, the formula's references are offsets from the
+    # anchor; otherwise the anchor is ignored.
+    def compile(self, formula):
+        try:
+            source = (f'def _compiled(row, col):\n'
+                      f'    return {self._emit(formula)}\n')
+            code = compile(source, '<formula>', 'exec')
+            exec(code, self.namespace)
+            return self.namespace['_compiled']
+        except (SyntaxError, RecursionError, MemoryError, ValueError):
+            if self.relative:
+                return lambda row, col: formula.shifted(row, col).evaluate()
+            return lambda row, col: formula.evaluate()
+
+    # binds a Python object into the generated function's namespace
+    def _bind(self, value):
+        name = f'_k{self.nextName}'
+        self.nextName += 1
+        self.namespace[name] = value
+        return name
+
+    # returns source for an expression that evaluates the given formula
+    def _emit(self, formula):
+        from formulae import Range
+        operator = formula.operator
+        operandCount = 0
+        for operand in formula.operands:
+            if isinstance(operand, Range) and not operator.rangeOperands:
+                operandCount += operand.size()
+            else:
+                operandCount += 1
+        if operator.operandLimit and operandCount > operator.operandLimit:
+            return self._bind(kValueError)
+
+        if operator.vectorFunc is not None:
+            rangeSources = [self._rangeSource(operand)
+                            for operand in formula.operands
+                            if isinstance(operand, Range)]
+            if rangeSources:
+                # let the operator gather its ranges (vectorized if possible)
+                operands = [operand for operand in formula.operands
+                            if not isinstance(operand, Range)]
+                scalarSources = self._emitOperands(operator, operands)
+                return (f'{self._bind(operator)}.operateWithRanges('
+                        f'[{", ".join(scalarSources)}], '
+                        f'[{", ".join(rangeSources)}])')
+
+        operandSources = self._emitOperands(operator, formula.operands)
+        operands = f'[{", ".join(operandSources)}]'
+        if operator.numerical and self._hasRuntimeOperands(formula.operands):
+            # (runtime operands may be errors, which are the result instead)
+            return f'_applyNum({self._bind(operator.func)}, {operands})'
+        return f'{self._bind(operator.func)}({operands})'
+
+    @staticmethod
+    def _hasRuntimeOperands(operands):
+        from formulae import Formula, CellRef, Range
+        for operand in operands:
+            if (isinstance(operand, Formula) or isinstance(operand, CellRef)
+                    or isinstance(operand, Range)):
+                return True
+        return False
+
+    # returns source for an expression giving a (correctly anchored) Range
+    def _rangeSource(self, cellRange):
+        source = self._bind(cellRange)
+        if self.relative:
+            source = f'{source}.shifted(row, col)'
+        return source
+
+    # returns source for each operand's value(s)
+    def _emitOperands(self, operator, operands):
+        from formulae import Formula, CellRef, Range
+        operandSources = []
+        for operand in operands:
+            if isinstance(operand, Formula):
+                operandSources.append(self._emit(operand))
+            elif isinstance(operand, CellRef):
+                # numerical operators only need cells' (precomputed) numeric
+                # views, not their values
+                getter = '_getNum' if operator.numerical else '_get'
+                if self.relative:
+                    operandSources.append(f'{getter}(row + {operand.row}, '
+                                          f'col + {operand.col})')
+                else:
+                    operandSources.append(
+                        f'{getter}({operand.row}, {operand.col})')
+            elif isinstance(operand, Range):
+                # ranges are expanded lazily, when the formula's evaluated
+                if operator.rangeOperands:
+                    operandSources.append(self._rangeSource(operand))
+                elif operator.countsEmptyOperands():
+                    operandSources.append(f'*{self._rangeSource(operand)}'
+                                          f'.getValues(True)')
+                else:
+                    operandSources.append(f'*{self._rangeSource(operand)}'
+                                          f'.getNumbers()')
+            elif operator.numerical:
+                # literals never change, so numberize them just this once
+                for number in numberizeOperands([operand]):
+                    operandSources.append(self._bind(number))
+            else:
+                operandSources.append(self._bind(operand))
+        return operandSources
+
+
+def compileFormula(formula, getValue, getNumber, relative=False):
+    return FormulaCompiler(getValue, getNumber, relative).compile(formula)
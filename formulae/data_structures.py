@@ -2,6 +2,10 @@
 # Joseph Rotella (jrotella, F0)
 #
 # Contains implementations of useful data structures.
+import math
+from array import array
+from bisect import bisect_left, insort
+
 
 class Stack(object):
     class Item(object):
@@ -33,10 +37,207 @@ class Stack(object):
         else:
             return None
 
-# A bare-bones "graph" for representing formula dependency relationships
+# A spatial index answering "which ranges contain cell (row, col)?" in
+# logarithmic time. Each column is treated as an implicit segment tree over
+# row numbers: a range's rows are split into at most two aligned power-of-two
+# blocks per level, and each block is filed under every column the range
+# spans. Finding the ranges containing a cell then only requires checking the
+# one block per level that contains its row.
+class RangeIndex(object):
+    def __init__(self):
+        self.blocks = {}  # (col, level, block number) -> set of ranges
+        self.numLevels = 0
+        self.count = 0
+
+    # yields the (level, block number) pairs exactly covering a row interval
+    @staticmethod
+    def _decompose(startRow, endRow):
+        lo, hi = startRow, endRow + 1  # half-open
+        level = 0
+        while lo < hi:
+            if lo & 1:
+                yield level, lo
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                yield level, hi
+            lo >>= 1
+            hi >>= 1
+            level += 1
+
+    def add(self, cellRange):
+        for level, block in RangeIndex._decompose(cellRange.startRow,
+                                                  cellRange.endRow):
+            self.numLevels = max(self.numLevels, level + 1)
+            for col in range(cellRange.startCol, cellRange.endCol + 1):
+                key = (col, level, block)
+                if key not in self.blocks:
+                    self.blocks[key] = set()
+                self.blocks[key].add(cellRange)
+        self.count += 1
+
+    def remove(self, cellRange):
+        for level, block in RangeIndex._decompose(cellRange.startRow,
+                                                  cellRange.endRow):
+            for col in range(cellRange.startCol, cellRange.endCol + 1):
+                key = (col, level, block)
+                self.blocks[key].discard(cellRange)
+                if len(self.blocks[key]) == 0:
+                    del self.blocks[key]
+        self.count -= 1
+
+    # Returns a list of all indexed ranges that contain the given cell
+    def getContaining(self, row, col):
+        containing = []
+        if self.count == 0:
+            return containing
+        for level in range(self.numLevels):
+            found = self.blocks.get((col, level, row >> level))
+            if found:
+                containing += found
+        return containing
+
+    def __len__(self):
+        return self.count
+
+# Indexes the values in one column of cells for lookups (e.g., VLOOKUP): a
+# hash index from each value to the rows holding it, for exact matches, and
+# all the values in sorted order, for approximate matches and comparisons.
+# Values are sorted by their sort keys: numbers come before text, and text is
+# compared case-insensitively (formula text is upper-cased anyway). Queries
+# only consider the rows from startRow to endRow.
+class ColumnIndex(object):
+    def __init__(self, values=()):
+        self.rowsByKey = {}  # sort key -> sorted rows holding that value
+        self.entries = []  # sorted (sort key, row) pairs
+        self.rows = []  # sorted rows of every indexed value
+        for row, value in values:
+            key = ColumnIndex.sortKey(value)
+            if key is not None:
+                if key not in self.rowsByKey:
+                    self.rowsByKey[key] = []
+                self.rowsByKey[key].append(row)
+                self.entries.append((key, row))
+                self.rows.append(row)
+        for rows in self.rowsByKey.values():
+            rows.sort()
+        self.entries.sort()
+        self.rows.sort()
+
+    # Returns (0, number) or (1, folded text) for a value, or None if it
+    # can't be looked up (empty cells and NaNs)
+    @staticmethod
+    def sortKey(value):
+        if isinstance(value, int) or isinstance(value, float):
+            return (0, value) if value == value else None
+        elif isinstance(value, str) and value != '':
+            return (1, value.casefold())
+        return None
+
+    def add(self, row, value):
+        key = ColumnIndex.sortKey(value)
+        if key is None:
+            return
+        if key not in self.rowsByKey:
+            self.rowsByKey[key] = []
+        insort(self.rowsByKey[key], row)
+        insort(self.entries, (key, row))
+        insort(self.rows, row)
+
+    def remove(self, row, value):
+        key = ColumnIndex.sortKey(value)
+        if key is None:
+            return
+        rows = self.rowsByKey[key]
+        del rows[bisect_left(rows, row)]
+        if not rows:
+            del self.rowsByKey[key]
+        del self.entries[bisect_left(self.entries, (key, row))]
+        del self.rows[bisect_left(self.rows, row)]
+
+    def replace(self, row, oldValue, newValue):
+        self.remove(row, oldValue)
+        self.add(row, newValue)
+
+    # Returns the first row holding a value, or None
+    def firstRow(self, value, startRow, endRow):
+        rows = self.rowsByKey.get(ColumnIndex.sortKey(value), [])
+        i = bisect_left(rows, startRow)
+        return rows[i] if i < len(rows) and rows[i] <= endRow else None
+
+    def _covers(self, startRow, endRow):
+        return not self.rows or (startRow <= self.rows[0]
+                                 and self.rows[-1] <= endRow)
+
+    # Returns the row holding the largest value no larger than the given one
+    # (and of the same kind, number or text), or None. Ties go to the last
+    # such row, like a binary search of sorted values would find.
+    def lastAtMost(self, value, startRow, endRow):
+        key = ColumnIndex.sortKey(value)
+        if key is None:
+            return None
+        i = bisect_left(self.entries, (key, math.inf)) - 1
+        # (usually, every indexed row is in the range, so this doesn't loop)
+        while i >= 0 and self.entries[i][0][0] == key[0]:
+            row = self.entries[i][1]
+            if startRow <= row <= endRow:
+                return row
+            i -= 1
+        return None
+
+    # Returns the row holding the smallest value no smaller than the given
+    # one (and of the same kind), or None. Ties go to the first such row.
+    def firstAtLeast(self, value, startRow, endRow):
+        key = ColumnIndex.sortKey(value)
+        if key is None:
+            return None
+        i = bisect_left(self.entries, (key,))
+        while i < len(self.entries) and self.entries[i][0][0] == key[0]:
+            row = self.entries[i][1]
+            if startRow <= row <= endRow:
+                return row
+            i += 1
+        return None
+
+    # Counts the rows whose values compare to the given one as asked (with
+    # one of =, <>, <, <=, >, or >=). Only values of the same kind compare,
+    # except that every other row (even an empty one) is <> the value.
+    def countCompared(self, comparison, value, startRow, endRow):
+        key = ColumnIndex.sortKey(value)
+        if comparison == '<>':
+            return (endRow - startRow + 1
+                    - self.countCompared('=', value, startRow, endRow))
+        elif key is None:
+            return 0
+        elif comparison == '=':
+            rows = self.rowsByKey.get(key, [])
+            return (bisect_left(rows, endRow + 1)
+                    - bisect_left(rows, startRow))
+
+        kindStart = bisect_left(self.entries, ((key[0],),))
+        kindEnd = bisect_left(self.entries, ((key[0] + 1,),))
+        valueStart = bisect_left(self.entries, (key,))
+        valueEnd = bisect_left(self.entries, (key, math.inf))
+        start, end = {'<': (kindStart, valueStart),
+                      '<=': (kindStart, valueEnd),
+                      '>': (valueEnd, kindEnd),
+                      '>=': (valueStart, kindEnd)}[comparison]
+        if self._covers(startRow, endRow):
+            return end - start
+        count = 0
+        for i in range(start, end):
+            if startRow <= self.entries[i][1] <= endRow:
+                count += 1
+        return count
+
+# A bare-bones "graph" for representing formula dependency relationships.
+# A cell may depend on individual cells (CellRefs) or on whole ranges; each
+# range a cell depends on is stored as a single edge.
 class DependencyGraph(object):
     def __init__(self):
         self.dependents = {}
+        self.rangeDependents = {}
+        self.rangeIndex = RangeIndex()  # indexes the keys of rangeDependents
         self.dependencies = {}
 
     def setDependencies(self, cellRef, dependencies: set):
@@ -49,34 +250,368 @@ class DependencyGraph(object):
 
         # If there were any old dependencies the cell no longer has, remove them
         for oldDependency in oldDependencies - dependencies:
-            self.dependents[oldDependency].remove(cellRef)
+            dependentsMap = self._dependentsMapFor(oldDependency)
+            dependentsMap[oldDependency].remove(cellRef)
+            if len(dependentsMap[oldDependency]) == 0:
+                del dependentsMap[oldDependency]
+                if oldDependency.isRange:
+                    self.rangeIndex.remove(oldDependency)
             self.dependencies[cellRef].remove(oldDependency)
 
         # Add all new dependencies (but don't re-add ones that already exist)
         for dependency in dependencies - oldDependencies:
-            if dependency not in self.dependents:
-                self.dependents[dependency] = set()
+            dependentsMap = self._dependentsMapFor(dependency)
+            if dependency not in dependentsMap:
+                dependentsMap[dependency] = set()
+                if dependency.isRange:
+                    self.rangeIndex.add(dependency)
 
-            self.dependents[dependency].add(cellRef)
+            dependentsMap[dependency].add(cellRef)
             self.dependencies[cellRef].add(dependency)
 
-        # If this cell has no deps or isn't anyone's dep, remove to save space
+        # If this cell has no deps, remove to save space
         if len(self.dependencies[cellRef]) == 0:
             del self.dependencies[cellRef]
-        if cellRef in self.dependents and len(self.dependents[cellRef]) == 0:
-            del self.dependents[cellRef]
 
+    def _dependentsMapFor(self, dependency):
+        return self.rangeDependents if dependency.isRange else self.dependents
+
+    # Gets only the cells that directly depend on a given cell, whether by
+    # referencing it or a range containing it
+    def getShallowDependents(self, cellRef):
+        dependents = self.dependents.get(cellRef, set())
+        for cellRange in self.rangeIndex.getContaining(cellRef.row,
+                                                        cellRef.col):
+            dependents = dependents.union(self.rangeDependents[cellRange])
+        return dependents
+
+    # Gets only the cells that depend on a given cell through a range
+    def getRangeDependents(self, cellRef):
+        dependents = set()
+        for cellRange in self.rangeIndex.getContaining(cellRef.row,
+                                                        cellRef.col):
+            dependents.update(self.rangeDependents[cellRange])
+        return dependents
+
+    # The traversals below work on node keys, which are just CellRefs here;
+    # subclasses storing cells differently override these three methods
+    def _key(self, cellRef):
+        return cellRef
+
+    def _cellRef(self, key):
+        return key
+
+    def _shallowDependentKeys(self, key):
+        return self.getShallowDependents(key)
+
+    # Gets all cells that transitively depend on a given cell, visiting each
+    # one only once (so diamonds and cycles don't blow up)
     def getDependents(self, cellRef):
-        if cellRef not in self.dependents:
-            return set()
-
-        dependents = self.dependents[cellRef]
-        for dependent in dependents:
-            # we catch infinite recursion only at runtime -- don't do it here!
-            if dependent is not cellRef:
-                dependents = dependents.union(self.getDependents(dependent))
+        return {self._cellRef(key)
+                for key in self._dependentKeys([self._key(cellRef)])}
+
+    # Gets all cells that transitively depend on any of the given cells
+    def getGroupDependents(self, cellRefs):
+        return {self._cellRef(key) for key in
+                self._dependentKeys([self._key(cellRef)
+                                     for cellRef in cellRefs])}
+
+    # (of any of the given keys)
+    def _dependentKeys(self, keys):
+        dependents = set()
+        toVisit = list(keys)
+        while toVisit:
+            for dependent in self._shallowDependentKeys(toVisit.pop()):
+                if dependent not in dependents:
+                    dependents.add(dependent)
+                    toVisit.append(dependent)
         return dependents
 
-    # Gets only the first layer of dependencies of a given cell
+    # Gets the transitive dependents of a cell in an order in which they can
+    # be recomputed, i.e., every cell comes after all of the cells it depends
+    # on. Cells caught in a dependency cycle can't be ordered, so they're
+    # tacked on at the end.
+    def getRecalcOrder(self, cellRef):
+        levels, cyclic = self.getRecalcLevels(cellRef)
+        return [cur for level in levels for cur in level] + cyclic
+
+    # Splits the transitive dependents of a cell into levels: each cell only
+    # depends on cells in earlier levels, so the cells within a level can be
+    # recomputed in any order (or at the same time). Also returns the cells
+    # caught in dependency cycles, which can't be put in any level.
+    def getRecalcLevels(self, cellRef):
+        key = self._key(cellRef)
+        affected = self._dependentKeys([key])
+        affected.discard(key)
+        return self._levelKeys(affected)
+
+    # Gets the given cells and all of their transitive dependents, in an
+    # order in which they can be recomputed (as in getRecalcOrder)
+    def getGroupRecalcOrder(self, cellRefs):
+        keys = [self._key(cellRef) for cellRef in cellRefs]
+        affected = self._dependentKeys(keys).union(keys)
+        levels, cyclic = self._levelKeys(affected)
+        return [cur for level in levels for cur in level] + cyclic
+
+    # Splits a set of keys into levels and cycles (see getRecalcLevels),
+    # returning them as CellRefs
+    def _levelKeys(self, affected):
+        # count how many of each cell's dependencies still need recomputing
+        shallowDependents = {}
+        pendingCounts = dict.fromkeys(affected, 0)
+        for cur in affected:
+            shallowDependents[cur] = self._shallowDependentKeys(cur)
+            for dependent in shallowDependents[cur]:
+                if dependent in pendingCounts:
+                    pendingCounts[dependent] += 1
+        level = [cur for cur in affected if pendingCounts[cur] == 0]
+
+        levels = []
+        leveled = 0
+        while level:
+            levels.append(level)
+            leveled += len(level)
+            nextLevel = []
+            for cur in level:
+                for dependent in shallowDependents[cur]:
+                    if pendingCounts.get(dependent, 0) > 0:
+                        pendingCounts[dependent] -= 1
+                        if pendingCounts[dependent] == 0:
+                            nextLevel.append(dependent)
+            level = nextLevel
+
+        cyclic = []
+        if leveled < len(affected):
+            cyclic = [self._cellRef(cur) for cur in affected
+                      if pendingCounts[cur] > 0]
+        return ([[self._cellRef(cur) for cur in level] for level in levels],
+                cyclic)
+
+    # Gets only the first layer of dependencies of a given cell (which may
+    # include ranges)
     def getShallowDependencies(self, cellRef):
         return self.dependencies.get(cellRef, set())
+
+    # Folds any buffered edits into the graph's main storage (a no-op here,
+    # since edits are applied directly)
+    def compact(self):
+        pass
+
+# Integer adjacency lists in compressed sparse row (CSR) form: the sorted
+# nodes that have edges, and for the i-th of them, its targets are
+# targets[offsets[i]:offsets[i + 1]]. That's 8 bytes per edge, vs. hundreds
+# for a set entry per edge. Rebuilding the arrays for every edit would be
+# slow, so edits are buffered and merged in batches once there are enough of
+# them.
+class CSRAdjacency(object):
+    kMinPendingEdits = 4096
+
+    def __init__(self):
+        self.nodes = array('q')
+        self.offsets = array('q', [0])
+        self.targets = array('q')
+        self.added = {}  # node -> list of targets not yet merged
+        self.removed = {}  # node -> set of merged targets since removed
+        self.pendingEdits = 0
+
+    def _mergedTargets(self, node):
+        i = bisect_left(self.nodes, node)
+        if i < len(self.nodes) and self.nodes[i] == node:
+            return self.targets[self.offsets[i]:self.offsets[i + 1]]
+        return ()
+
+    # Returns a sequence of a node's targets
+    def get(self, node):
+        targets = self._mergedTargets(node)
+        if not self.pendingEdits:
+            return targets
+        removed = self.removed.get(node)
+        if removed:
+            targets = [target for target in targets if target not in removed]
+        added = self.added.get(node)
+        if added:
+            targets = list(targets) + added
+        return targets
+
+    # Adds an edge (which must not already exist)
+    def add(self, node, target):
+        removed = self.removed.get(node)
+        if removed and target in removed:
+            removed.remove(target)
+            if not removed:
+                del self.removed[node]
+        else:
+            if node not in self.added:
+                self.added[node] = []
+            self.added[node].append(target)
+        self._edited()
+
+    # Removes an edge (which must exist)
+    def remove(self, node, target):
+        added = self.added.get(node)
+        if added and target in added:
+            added.remove(target)
+            if not added:
+                del self.added[node]
+        else:
+            if node not in self.removed:
+                self.removed[node] = set()
+            self.removed[node].add(target)
+        self._edited()
+
+    def _edited(self):
+        self.pendingEdits += 1
+        if self.pendingEdits > max(CSRAdjacency.kMinPendingEdits,
+                                   len(self.targets) // 4):
+            self.compact()
+
+    # Merges buffered edits into the arrays. Runs of nodes without edits are
+    # copied over as whole slices.
+    def compact(self):
+        if self.pendingEdits == 0:
+            return
+        merged = (array('q'), array('q', [0]), array('q'))
+        nodes, offsets, targets = merged
+        i = 0
+        for node in sorted(set(self.added).union(self.removed)):
+            j = bisect_left(self.nodes, node, i)
+            self._copyUnedited(merged, i, j)
+            i = j
+            nodeTargets = self.added.get(node, [])
+            if i < len(self.nodes) and self.nodes[i] == node:
+                # (new nodes, e.g., while a sheet is loading, skip this)
+                removed = self.removed.get(node, ())
+                nodeTargets = [target for target in self.targets[
+                    self.offsets[i]:self.offsets[i + 1]]
+                    if target not in removed] + nodeTargets
+                i += 1
+            if nodeTargets:
+                nodes.append(node)
+                targets.extend(nodeTargets)
+                offsets.append(len(targets))
+        self._copyUnedited(merged, i, len(self.nodes))
+        self.nodes, self.offsets, self.targets = merged
+        self.added = {}
+        self.removed = {}
+        self.pendingEdits = 0
+
+    # copies the i-th through (j - 1)-th nodes (and their targets) to the end
+    # of a new set of arrays
+    def _copyUnedited(self, merged, i, j):
+        if i >= j:
+            return
+        nodes, offsets, targets = merged
+        shift = len(targets) - self.offsets[i]
+        nodes.extend(self.nodes[i:j])
+        targets.extend(self.targets[self.offsets[i]:self.offsets[j]])
+        offsets.extend([offset + shift
+                        for offset in self.offsets[i + 1:j + 1]])
+
+# A DependencyGraph for very large sheets. Cells are numbered
+# row * maxCols + col, and edges are kept in CSRAdjacency arrays instead of
+# dicts of sets, so even millions of edges take little memory. Range
+# dependencies are numbered too, and stored as negative numbers (-1 - range
+# number) among a cell's dependencies.
+class CompactDependencyGraph(DependencyGraph):
+    def __init__(self, maxCols=26):
+        # edges are stored differently, so the parent's dicts aren't used
+        from formulae import CellRef
+        self.cellRefClass = CellRef
+        self.maxCols = maxCols
+        self.dependencyIds = CSRAdjacency()  # cell -> cells and ranges
+        self.dependentIds = CSRAdjacency()  # cell -> cells
+        self.rangeDependentIds = CSRAdjacency()  # range number -> cells
+        self.rangeIds = {}  # range -> range number
+        self.ranges = []  # range number -> range
+        self.freeRangeIds = []
+        self.rangeIndex = RangeIndex()  # indexes the ranges in use
+
+    # (negative keys are range numbers; see _rangeKey)
+    def _key(self, cellRef):
+        if not 0 <= cellRef.col < self.maxCols:
+            raise Exception(f'Column {cellRef.col} is out of bounds')
+        if cellRef.row < 0:
+            raise Exception(f'Row {cellRef.row} is out of bounds')
+        return cellRef.row * self.maxCols + cellRef.col
+
+    def _cellRef(self, key):
+        return self.cellRefClass(*divmod(key, self.maxCols))
+
+    def _rangeKey(self, cellRange):
+        rangeId = self.rangeIds.get(cellRange)
+        if rangeId is None:
+            if self.freeRangeIds:
+                rangeId = self.freeRangeIds.pop()
+                self.ranges[rangeId] = cellRange
+            else:
+                rangeId = len(self.ranges)
+                self.ranges.append(cellRange)
+            self.rangeIds[cellRange] = rangeId
+            self.rangeIndex.add(cellRange)
+        return -1 - rangeId
+
+    def _freeRange(self, rangeId):
+        cellRange = self.ranges[rangeId]
+        self.rangeIndex.remove(cellRange)
+        del self.rangeIds[cellRange]
+        self.ranges[rangeId] = None
+        self.freeRangeIds.append(rangeId)
+
+    def setDependencies(self, cellRef, dependencies: set):
+        node = self._key(cellRef)
+        oldKeys = set(self.dependencyIds.get(node))
+        newKeys = {self._rangeKey(dependency) if dependency.isRange
+                   else self._key(dependency)
+                   for dependency in dependencies}
+
+        for key in oldKeys - newKeys:
+            self.dependencyIds.remove(node, key)
+            if key < 0:
+                rangeId = -1 - key
+                self.rangeDependentIds.remove(rangeId, node)
+                if not self.rangeDependentIds.get(rangeId):
+                    self._freeRange(rangeId)
+            else:
+                self.dependentIds.remove(key, node)
+
+        for key in newKeys - oldKeys:
+            self.dependencyIds.add(node, key)
+            if key < 0:
+                self.rangeDependentIds.add(-1 - key, node)
+            else:
+                self.dependentIds.add(key, node)
+
+    def _shallowDependentKeys(self, key):
+        dependents = self.dependentIds.get(key)
+        if not self.rangeIds:
+            return dependents
+        containing = self.rangeIndex.getContaining(*divmod(key, self.maxCols))
+        if containing:
+            # a cell can depend on this one through several ranges
+            dependents = set(dependents)
+            for cellRange in containing:
+                dependents.update(
+                    self.rangeDependentIds.get(self.rangeIds[cellRange]))
+        return dependents
+
+    def getShallowDependents(self, cellRef):
+        return {self._cellRef(key)
+                for key in self._shallowDependentKeys(self._key(cellRef))}
+
+    def getRangeDependents(self, cellRef):
+        dependents = set()
+        for cellRange in self.rangeIndex.getContaining(cellRef.row,
+                                                        cellRef.col):
+            dependents.update(
+                self._cellRef(key) for key in
+                self.rangeDependentIds.get(self.rangeIds[cellRange]))
+        return dependents
+
+    def getShallowDependencies(self, cellRef):
+        return {self.ranges[-1 - key] if key < 0 else self._cellRef(key)
+                for key in self.dependencyIds.get(self._key(cellRef))}
+
+    def compact(self):
+        self.dependencyIds.compact()
+        self.dependentIds.compact()
+        self.rangeDependentIds.compact()
@@ -0,0 +1,52 @@
+# engine.py
+# Joseph Rotella (jrotella, F0)
+#
+# Per-sheet formula engine state. Every sheet of a workbook keeps its own
+# SheetEngine (cells with their parsed formulae and cached values, dependency
+# graph, volatile cells, lookup indexes, and which cells are demanded), so
+# switching sheets just swaps which engine the Cell class works on instead of
+# re-parsing the sheet.
+from formulae.data_structures import DependencyGraph
+from formulae.storage import DictCellStore
+
+
+class SheetEngine(object):
+    def __init__(self, storeClass=DictCellStore, graphClass=DependencyGraph):
+        # while the engine is active (see Cell.setEngine), these are kept in
+        # Cell's class attributes, and only put back here when it's not
+        self.store = storeClass()
+        self.deps = graphClass()
+        self.volatileCells = set()
+        self.columnIndexes = {}
+        # lazy evaluation state (see Cell.setDemanded)
+        self.demanded = []
+        self.demand = None
+        self.pendingRoots = []
+
+    # Returns a new engine holding the given raw cells (as loaded by
+    # Cell.loadRawCells), with the same backends as the active one
+    @staticmethod
+    def fromRawCells(rawCells):
+        from formulae import Cell
+        engine = SheetEngine(type(Cell._store), type(Cell._deps))
+        engine.run(Cell.loadRawCells, rawCells)
+        return engine
+
+    # Calls fn(*args) with this engine active, then switches back to the one
+    # that was active before
+    def run(self, fn, *args):
+        from formulae import Cell
+        previous = Cell.getEngine()
+        Cell.setEngine(self)
+        try:
+            return fn(*args)
+        finally:
+            Cell.setEngine(previous)
+
+    def getRawCells(self):
+        from formulae import Cell
+        return self.run(Cell.getRawCells)
+
+    def empty(self):
+        from formulae import Cell
+        return self.run(Cell.empty)
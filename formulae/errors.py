@@ -0,0 +1,54 @@
+# errors.py
+# Joseph Rotella (jrotella, F0)
+#
+# Typed error values for formula results (e.g., #DIV/0!). Errors are values,
+# not exceptions: a formula whose operands include an error just results in
+# that error, so errors propagate through the sheet without anything being
+# raised (and without losing what went wrong).
+
+
+class FormulaError(object):
+    _errors = {}
+
+    def __init__(self, code, description):
+        self.code = code  # what the cell shows
+        self.description = description
+        FormulaError._errors[code] = self
+
+    # errors are singletons (so they can be compared by identity), so pickle
+    # them by code
+    def __reduce__(self):
+        return FormulaError.get, (self.code,)
+
+    @staticmethod
+    def get(code):
+        return FormulaError._errors[code]
+
+    # Returns the error for an exception raised while computing a formula
+    # (errors are normally returned, so this is only a safety net)
+    @staticmethod
+    def fromException(exception):
+        if isinstance(exception, ZeroDivisionError):
+            return kDivZeroError
+        elif (isinstance(exception, OverflowError)
+              or isinstance(exception, ValueError)):
+            return kNumError
+        elif (isinstance(exception, IndexError)
+              or isinstance(exception, TypeError)):
+            return kValueError
+        return kRuntimeError
+
+    def __str__(self):
+        return self.code
+
+    def __repr__(self):
+        return f'FormulaError({self.code})'
+
+
+kDivZeroError = FormulaError('#DIV/0!', 'Division by zero')
+kValueError = FormulaError('#VALUE!', 'Wrong number or kind of operands')
+kRefError = FormulaError('#REF!', 'Reference outside of the range')
+kNotFoundError = FormulaError('#N/A', 'Value not found')
+kNumError = FormulaError('#NUM!', 'Result isn\'t a representable number')
+kCycleError = FormulaError('#CYCLE!', 'Circular reference')
+kRuntimeError = FormulaError('#ERROR!', 'Formula couldn\'t be computed')
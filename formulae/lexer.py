@@ -0,0 +1,112 @@
+# lexer.py
+# Joseph Rotella (jrotella, F0)
+#
+# Single-pass tokenizer for formula strings.
+import string
+from enum import Enum
+
+
+class TokenType(Enum):
+    IDENTIFIER = 0  # operator names and text literals
+    NUMBER = 1
+    REF = 2
+    RANGE = 3
+    OPEN = 4
+    CLOSE = 5
+    COMMA = 6
+
+
+class Token(object):
+    def __init__(self, tokenType: TokenType, text, position, value=None):
+        self.type = tokenType
+        self.text = text
+        self.position = position  # index of the token in the formula text
+        self.value = value  # parsed value (number or (row, col) corners)
+
+    def __repr__(self):
+        return f'Token({self.type.name}, {self.text!r}, {self.position})'
+
+
+# Raised for malformed formulae; position is the index in the formula text at
+# which the problem was found
+class FormulaSyntaxError(Exception):
+    def __init__(self, message, position):
+        super().__init__(f'{message} (at position {position})')
+        self.position = position
+
+
+kPunctuation = {'(': TokenType.OPEN, ')': TokenType.CLOSE,
+                ',': TokenType.COMMA}
+kWhitespace = set(string.whitespace)
+kDigits = set(string.digits)
+kNumberStarts = set(string.digits + '.-+')
+
+
+# Returns (row, col) if text is a cell reference like B12, otherwise None
+def _parseRef(text):
+    # (only ASCII digits; str.isdigit also takes, e.g., superscripts, which
+    # int() rejects)
+    if (len(text) > 1 and text[0] in string.ascii_uppercase
+            and all(char in kDigits for char in text[1:])):
+        try:
+            return int(text[1:]) - 1, ord(text[0]) - ord('A')
+        except ValueError:
+            return None  # (too many digits for int() to convert)
+    return None
+
+
+def _parseNumber(text):
+    if text[0] not in kNumberStarts:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text)
+        except ValueError:
+            return None
+
+
+# Classifies a run of non-punctuation characters as a typed token
+def _valueToken(text, position):
+    if ':' in text:
+        corners = text.split(':')
+        if len(corners) != 2:
+            raise FormulaSyntaxError('Illegal cell range format', position)
+        start, end = _parseRef(corners[0]), _parseRef(corners[1])
+        if start is None or end is None:
+            raise FormulaSyntaxError('Illegal entity in cell range', position)
+        return Token(TokenType.RANGE, text, position, (start, end))
+
+    ref = _parseRef(text)
+    if ref is not None:
+        return Token(TokenType.REF, text, position, ref)
+    number = _parseNumber(text)
+    if number is not None:
+        return Token(TokenType.NUMBER, text, position, number)
+    return Token(TokenType.IDENTIFIER, text, position, text)
+
+
+# Yields the tokens in text (from index start onward) in one scan. Whitespace
+# is ignored everywhere, including inside values, so `A 1` is the same as A1.
+def tokenize(text, start=0):
+    length = len(text)
+    i = start
+    while i < length:
+        char = text[i]
+        if char in kPunctuation:
+            yield Token(kPunctuation[char], char, i)
+            i += 1
+        elif char in kWhitespace:
+            i += 1
+        else:
+            valueStart = i
+            hasWhitespace = False
+            while i < length and text[i] not in kPunctuation:
+                if text[i] in kWhitespace:
+                    hasWhitespace = True
+                i += 1
+            value = text[valueStart:i]
+            if hasWhitespace:
+                value = ''.join(value.split())
+            yield _valueToken(value, valueStart)
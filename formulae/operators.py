@@ -6,43 +6,99 @@
 import math
 import random
 
+from formulae.aggregates import exactMean, exactSum, floatSum, \
+    kMaxExactInt
+from formulae.errors import FormulaError, kDivZeroError, kNotFoundError, \
+    kNumError, kValueError
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional; operators fall back to pure Python
+    numpy = None
+
+# ranges smaller than this aren't worth gathering into arrays
+kMinVectorSize = 256
+
 
 # defines an abstract operator on arbitrarily many (numerical) operands
 class Operator(object):
     _operators = {}
 
-    def __init__(self, name, func, numerical=True, operandLimit=None):
+    def __init__(self, name, func, numerical=True, operandLimit=None,
+                 vectorFunc=None, volatile=False, runningFunc=None,
+                 rangeOperands=False):
         self.name = name
         self.func = func
         self.numerical = numerical
         self.operandLimit = operandLimit
+        # whether results can change without any inputs changing (e.g., RAND);
+        # those are only recomputed on new recalculation epochs (see
+        # Cell.recalculateVolatile)
+        self.volatile = volatile
+        # optional NumPy version of func for order-independent operators;
+        # takes the numerical operands' values and which of them are ints
+        self.vectorFunc = vectorFunc
+        # optional version of func for a single range operand, taking the
+        # range's RunningSum (see formulae.aggregates) and size; operators
+        # with one can be kept up to date as the range's cells change
+        self.runningFunc = runningFunc
+        # whether func gets range operands as Range objects (e.g., to look
+        # values up in them) rather than as the values of their cells
+        self.rangeOperands = rangeOperands
         Operator._operators[self.name] = self
 
-    def _numberizeOperands(self, operands):
-        newOperands = []
-        for operand in operands:
-            if isinstance(operand, int) or isinstance(operand, float):
-                newOperands.append(operand)
-            else:
-                try:
-                    newOperands.append(int(operand.replace(',', '')))
-                except:
-                    try:
-                        newOperands.append(float(operand.replace(',', '')))
-                    except:
-                        # TODO: should we "zeroify" or just skip?
-                        # newOperands.append(0)
-                        pass
-        return newOperands
+    # operators are singletons (and their funcs can't be pickled), so pickle
+    # them by name
+    def __reduce__(self):
+        return Operator.get, (self.name,)
+
+    # Whether empty cells matter to this operator, i.e., whether it counts
+    # its operands (non-numerical operators and those with operand limits)
+    def countsEmptyOperands(self):
+        return not self.numerical or self.operandLimit is not None
 
     def operate(self, operands):
-        # TODO: make this more robust
         if self.operandLimit and len(operands) > self.operandLimit:
-            raise Exception('Too many operands')
+            return kValueError
         if self.numerical:
-            operands = self._numberizeOperands(operands)
+            return applyNumerical(self.func, operands)
         return self.func(operands)
 
+    # Applies the operator to some operands plus the cells in some ranges.
+    # If NumPy is available and the sheet's storage backend can read large
+    # ranges as arrays, the operator is applied in one vectorized call.
+    def operateWithRanges(self, operands, ranges):
+        if (numpy is None or self.vectorFunc is None
+                or sum(cellRange.size() for cellRange in ranges)
+                < kMinVectorSize):
+            return self.operate(self._withRangeValues(operands, ranges))
+
+        # (only some storage backends can supply arrays; see
+        # CellStore.numericArrayInRange)
+        rangeArrays = [cellRange.getNumericArray() for cellRange in ranges]
+        if None in rangeArrays:
+            return self.operate(self._withRangeValues(operands, ranges))
+        gathered = [gatherNumeric(operands)] + rangeArrays
+        if None in gathered:  # some ints were too big for floats
+            return self.operate(self._withRangeValues(operands, ranges))
+
+        values = numpy.concatenate([array.values[array.valid]
+                                    for array in gathered])
+        isInt = numpy.concatenate([array.isInt[array.valid]
+                                   for array in gathered])
+        return self.vectorFunc(values, isInt)
+
+    # Appends the values of the cells in some ranges to a list of operands
+    # (or just their numeric views, if that's all this operator looks at)
+    def _withRangeValues(self, operands, ranges):
+        operands = list(operands)
+        for cellRange in ranges:
+            if self.countsEmptyOperands():
+                operands += cellRange.getValues(True)
+            else:
+                operands += cellRange.getNumbers()
+        return operands
+
     @staticmethod
     def get(name):
         if name in Operator._operators:
@@ -50,10 +106,122 @@ class Operator(object):
         else:
             raise Exception(f'Illegal operator {name}')
 
+# Whether int() or float() could possibly parse some text: after any
+# whitespace and a sign, numbers start with a digit, a '.', inf, or nan. Most
+# text fails this check, so it doesn't have to raise (and catch) exceptions.
+def _mightBeNumber(text):
+    text = text.lstrip()
+    if text[:1] == '+' or text[:1] == '-':
+        text = text[1:]
+    first = text[:1]
+    return (first.isdigit() or first == '.'
+            or text[:3].lower() in ('inf', 'nan'))
+
+# Converts text to an int or float, or returns None if it isn't a number
+def _parseNumber(text):
+    if not _mightBeNumber(text):
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text)
+        except ValueError:
+            return None
+
+# Converts an operand to a number, or returns None if it isn't numerical.
+# Errors (see formulae.errors) are passed through, to propagate.
+def numberize(operand):
+    if isinstance(operand, int) or isinstance(operand, float):
+        return operand
+    if operand is None or isinstance(operand, FormulaError):
+        return operand
+    return _parseNumber(operand.replace(',', ''))
+
+# Converts a (non-formula) cell's text into its value: an int or float if
+# it's a number, or otherwise just the text itself
+def parseLiteral(text):
+    number = _parseNumber(text)
+    return text if number is None else number
+
+# Converts operands to numbers, skipping any that aren't numerical, or
+# returns the first error among them
+def numberizeOperands(operands):
+    newOperands = []
+    for operand in operands:
+        # operands are usually already numbers (cells' numeric views), so
+        # only fall back to converting anything else
+        operandType = type(operand)
+        if operandType is int or operandType is float:
+            newOperands.append(operand)
+            continue
+        number = numberize(operand)
+        if type(number) is FormulaError:
+            return number
+        # TODO: should we "zeroify" or just skip?
+        if number is not None:
+            newOperands.append(number)
+    return newOperands
+
+# Applies a numerical operator's function to its operands' numbers, unless
+# one of the operands is an error, which is the result instead
+def applyNumerical(func, operands):
+    numbers = numberizeOperands(operands)
+    if type(numbers) is FormulaError:
+        return numbers
+    return func(numbers)
+
+# Operand values gathered into NumPy arrays: a float array of values, a mask
+# of which values are numerical at all (the rest are NaN), and a mask of which
+# ones were ints (so results can have the same types as in pure Python)
+class NumericArray(object):
+    def __init__(self, values, valid, isInt):
+        self.values = values
+        self.valid = valid
+        self.isInt = isInt
+
+    def __len__(self):
+        return len(self.values)
+
+# Gathers operand values into a NumericArray, or returns None if some of them
+# can't be represented exactly as floats. Requires NumPy.
+def gatherNumeric(operands):
+    numbers = [numberize(operand) for operand in operands]
+    if any(type(number) is FormulaError for number in numbers):
+        return None  # (the first error is the result, which isn't a number)
+    isInt = [type(number) is int for number in numbers]
+    valid = [number is not None for number in numbers]
+    if not all(valid):
+        numbers = [number if number is not None else math.nan
+                   for number in numbers]
+    try:
+        values = numpy.array(numbers, dtype=numpy.float64)
+    except OverflowError:
+        return None
+    isInt = numpy.array(isInt, dtype=bool)
+    if isInt.any() and numpy.abs(values[isInt]).max() >= kMaxExactInt:
+        return None
+    return NumericArray(values, numpy.array(valid, dtype=bool), isInt)
+
 # OPERATOR FUNCTIONS
+# (sums are exact, so they're the same as a running sum's; see
+# formulae.aggregates)
 def average(operands):
-    if operands == []: return 0
-    return sum(operands) / len(operands)
+    return exactMean(operands)
+
+def divide(operands):
+    divisor = math.prod(operands[1:])
+    if divisor == 0:
+        return kDivZeroError
+    return operands[0] / divisor
+
+def power(operands):
+    base, exponent = operands[0], operands[1]
+    if base == 0 and exponent < 0:
+        return kDivZeroError
+    result = pow(base, exponent)
+    # (negative numbers to fractional powers are complex)
+    return kNumError if isinstance(result, complex) else result
 
 def safe(fn):
     def safeFn(operands):
@@ -81,22 +249,173 @@ def mode(operands):
             mostFrequentElements.append(el)
     return average(mostFrequentElements)
 
+# VECTORIZED OPERATOR FUNCTIONS
+# These take an array of numerical operand values and a mask of which were
+# ints, and return exactly what their pure-Python counterparts would (up to
+# float rounding), including the result's type.
+
+def vectorSum(values, isInt):
+    if len(values) == 0:
+        return 0
+    if not isInt.all():
+        # (ints are exact in the array, so fsum is as exact as exactSum)
+        return floatSum(values.tolist())
+    if len(values) * numpy.abs(values).max() < kMaxExactInt:
+        return int(values.sum())  # no partial sum can lose precision
+    return sum(int(value) for value in values.tolist())
+
+def vectorAverage(values, isInt):
+    if len(values) == 0:
+        return 0
+    if not isInt.all():
+        return exactMean(values.tolist())
+    return vectorSum(values, isInt) / len(values)
+
+def vectorExtreme(argFn):
+    def extreme(values, isInt):
+        if len(values) == 0:
+            return 0
+        idx = int(argFn(values))
+        return int(values[idx]) if isInt[idx] else float(values[idx])
+    return extreme
+
+def vectorProduct(values, isInt):
+    if isInt.all():  # keep arbitrary-precision int results
+        return math.prod(int(value) for value in values.tolist())
+    with numpy.errstate(all='ignore'):  # Python doesn't warn on overflow
+        return float(numpy.prod(values))
+
+def vectorMode(values, isInt):
+    if len(values) == 0:
+        return 0
+    uniqueValues, counts = numpy.unique(values, return_counts=True)
+    mostFrequentElements = uniqueValues[counts == counts.max()]
+    return float(mostFrequentElements.sum()) / len(mostFrequentElements)
+
+# LOOKUP OPERATOR FUNCTIONS
+# These get their range operands as Range objects (see Operator.rangeOperands)
+# and find cells through the ranges' lookup indexes. Bad operands and failed
+# lookups result in errors.
+
+# Comparisons a COUNTIF criterion can start with (longest first)
+kComparisons = ['>=', '<=', '<>', '>', '<', '=']
+
+# Returns the error a lookup's operands result in (the first error among
+# them, or #VALUE! if there are too few or the range isn't one), or None
+def _operandError(operands, minimum, rangeIdx):
+    if len(operands) < minimum:
+        return kValueError
+    for operand in operands:
+        if type(operand) is FormulaError:
+            return operand
+    if not getattr(operands[rangeIdx], 'isRange', False):
+        return kValueError
+    return None
+
+# Returns an operand as an int, or #VALUE! if it isn't a whole number
+def _wholeNumberOperand(operand):
+    if getattr(operand, 'isRange', False):
+        return kValueError
+    number = numberize(operand)
+    if number is None or (isinstance(number, float)
+                          and not number.is_integer()):
+        return kValueError
+    return int(number)
+
+# VLOOKUP(value, range, column number, [approximate = 1]): the value in the
+# given column of the row whose first cell matches the value (approximately,
+# i.e., the largest value no larger than it, unless approximate is 0)
+def vlookup(operands):
+    error = _operandError(operands, 3, 1)
+    if error is not None:
+        return error
+    cellRange = operands[1]
+    colNumber = _wholeNumberOperand(operands[2])
+    approximate = (_wholeNumberOperand(operands[3]) if len(operands) > 3
+                   else 1)
+    if colNumber is kValueError or approximate is kValueError:
+        return kValueError
+    rowOffset = cellRange.find(operands[0], 1 if approximate != 0 else 0)
+    if rowOffset is None:
+        return kNotFoundError
+    return cellRange.valueAt(rowOffset, colNumber - 1)
+
+# MATCH(value, range, [match type = 1]): the position (from 1) in a single
+# row or column of the cell matching the value; see Range.find for the types
+def match(operands):
+    error = _operandError(operands, 2, 1)
+    if error is not None:
+        return error
+    cellRange = operands[1]
+    matchType = (_wholeNumberOperand(operands[2]) if len(operands) > 2
+                 else 1)
+    if matchType is kValueError:
+        return kValueError
+    alongRow = cellRange.startRow == cellRange.endRow
+    if not alongRow and cellRange.startCol != cellRange.endCol:
+        return kNotFoundError
+    offset = cellRange.find(operands[0], matchType, alongRow)
+    if offset is None:
+        return kNotFoundError
+    return offset + 1
+
+# INDEX(range, row number, [column number = 1]): the value at a position
+# (from 1) in a range (or #REF! if the range doesn't have that position)
+def indexOf(operands):
+    error = _operandError(operands, 2, 0)
+    if error is not None:
+        return error
+    rowNumber = _wholeNumberOperand(operands[1])
+    colNumber = (_wholeNumberOperand(operands[2]) if len(operands) > 2
+                 else 1)
+    if rowNumber is kValueError or colNumber is kValueError:
+        return kValueError
+    return operands[0].valueAt(rowNumber - 1, colNumber - 1)
+
+# COUNTIF(range, criterion): how many cells in a range match a criterion,
+# which is either a value or text comparing to one (e.g., >5 or <>APPLE)
+def countif(operands):
+    error = _operandError(operands, 2, 0)
+    if error is not None:
+        return error
+    cellRange = operands[0]
+    criterion = operands[1]
+    if isinstance(criterion, str):
+        for comparison in kComparisons:
+            if criterion.startswith(comparison):
+                return cellRange.countCompared(
+                    comparison, parseLiteral(criterion[len(comparison):]))
+    return cellRange.countCompared('=', criterion)
+
 # OPERATOR DEFINITIONS
 
 # Utility operator for literal formulae
 Operator('LITERAL', lambda x: x[0], numerical=False, operandLimit=1)
 
-Operator('COUNT', lambda x: len(x), numerical=False)
+Operator('COUNT', lambda x: len(x), numerical=False,
+         runningFunc=lambda total, size: size)
+
+Operator('VLOOKUP', vlookup, numerical=False, operandLimit=4,
+         rangeOperands=True)
+Operator('MATCH', match, numerical=False, operandLimit=3,
+         rangeOperands=True)
+Operator('INDEX', indexOf, numerical=False, operandLimit=3,
+         rangeOperands=True)
+Operator('COUNTIF', countif, numerical=False, operandLimit=2,
+         rangeOperands=True)
 
 Operator('ABS', lambda x: abs(x[0]), operandLimit=1)
-Operator('ADD', sum)
-Operator('AVERAGE', average)
-Operator('DIVIDE', lambda x: x[0] / math.prod(x[1:]), operandLimit=2)
-Operator('MIN', safe(min))
-Operator('MAX', safe(max))
-Operator('MODE', mode)
-Operator('MULTIPLY', math.prod)
-Operator('POW', lambda x: pow(x[0], x[1]), operandLimit=2)
-Operator('RAND', lambda x: random.random())  # TODO: Figure out how to stop this recomputing when scrolling!
+Operator('ADD', exactSum, vectorFunc=vectorSum,
+         runningFunc=lambda total, size: total.total())
+Operator('AVERAGE', average, vectorFunc=vectorAverage,
+         runningFunc=lambda total, size: total.mean())
+Operator('DIVIDE', divide, operandLimit=2)
+Operator('MIN', safe(min), vectorFunc=vectorExtreme(lambda x: x.argmin()))
+Operator('MAX', safe(max), vectorFunc=vectorExtreme(lambda x: x.argmax()))
+Operator('MODE', mode, vectorFunc=vectorMode)
+Operator('MULTIPLY', math.prod, vectorFunc=vectorProduct)
+Operator('POW', power, operandLimit=2)
+Operator('RAND', lambda x: random.random(), volatile=True)
 Operator('SUBTRACT', lambda x: x[0] - sum(x[1:]), operandLimit=2)
-Operator('SUM', sum)
+Operator('SUM', exactSum, vectorFunc=vectorSum,
+         runningFunc=lambda total, size: total.total())
@@ -0,0 +1,145 @@
+# parallel.py
+# Joseph Rotella (jrotella, F0)
+#
+# Optional recalculation engine that spreads big recalculations across CPU
+# cores. Each level of the dependency graph only contains cells that don't
+# depend on each other, so a large level is split into chunks that worker
+# processes evaluate at the same time. Workers get the formulae and a
+# snapshot of just the values those formulae read, and send back the results.
+# Use it with Cell.setRecalculator(ParallelRecalculator()). It's off by
+# default, since shipping formulae and values between processes only pays off
+# with several idle cores and levels of thousands of costly formulae: with
+# fewer cores than workers (e.g., the parallel-recalc benchmark on one core),
+# it's slower than recalculating serially.
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from formulae import Cell, CellRef
+from formulae.errors import FormulaError
+from formulae.storage import SnapshotCellStore
+
+# levels smaller than this aren't worth shipping to other processes
+kMinParallelCells = 2000
+# templates used by fewer cells in a chunk than this are evaluated by walking
+# their trees in the worker process instead of being compiled again there
+kMinCompiledCells = 8
+
+
+# Runs in a worker process: evaluates formulae using only the given snapshot
+# of cell values. Formulae are grouped by template, as (relative formula,
+# positions) pairs; results are in the same order as the positions.
+def _evaluateChunk(groups, values):
+    Cell._store = SnapshotCellStore(values)
+    Cell._columnIndexes = {}  # (any left from an earlier chunk are stale)
+    results = []
+    for formula, positions in groups:
+        # compiling only pays off if the template is used by enough cells
+        if len(positions) >= kMinCompiledCells:
+            evaluate = formula.compile(relative=True)
+        else:
+            evaluate = lambda row, col: formula.shifted(row, col).evaluate()
+        for row, col in positions:
+            try:
+                results.append(evaluate(row, col))
+            except Exception as e:
+                results.append(FormulaError.fromException(e))
+    return results
+
+
+class ParallelRecalculator(object):
+    def __init__(self, maxWorkers=None, minParallelCells=kMinParallelCells):
+        self.maxWorkers = maxWorkers or os.cpu_count() or 1
+        self.minParallelCells = minParallelCells
+        self.pool = None  # created the first time it's needed
+
+    # Same as Cell.recalculate(row, col), but evaluates large levels of
+    # dependents in parallel
+    def recalculate(self, row, col):
+        levels, cyclic = Cell._deps.getRecalcLevels(CellRef(row, col))
+        changed = []
+        for level in levels:
+            dirty = []
+            for cellRef in level:
+                cell = Cell._store.getFormulaCell(cellRef.row, cellRef.col)
+                if cell is not None and cell.dirty:
+                    dirty.append(cellRef)
+            if len(dirty) < self.minParallelCells or self.maxWorkers < 2:
+                Cell.recalculateCells(dirty, changed)
+            else:
+                self._recalculateInParallel(dirty, changed)
+        # cycles have no independent cells, so there's nothing to parallelize
+        Cell.recalculateCells(cyclic, changed)
+        return changed
+
+    def _recalculateInParallel(self, cellRefs, changed):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.maxWorkers)
+        # neighboring cells tend to read the same inputs, so keep them in the
+        # same chunk to keep the snapshots small
+        cellRefs = sorted(cellRefs, key=lambda cellRef: (cellRef.col,
+                                                         cellRef.row))
+        numChunks = self.maxWorkers * 2
+        chunkSize = -(-len(cellRefs) // numChunks)
+        chunks = [cellRefs[i:i + chunkSize]
+                  for i in range(0, len(cellRefs), chunkSize)]
+        groups = [self._groupByTemplate(chunk) for chunk in chunks]
+        snapshots = [self._snapshot(chunk) for chunk in chunks]
+
+        store = Cell._store
+        for chunkGroups, results in zip(groups,
+                                        self.pool.map(_evaluateChunk, groups,
+                                                      snapshots)):
+            positions = [position for _, groupPositions in chunkGroups
+                         for position in groupPositions]
+            for (row, col), value in zip(positions, results):
+                cell = store.getFormulaCell(row, col)
+                oldValue = cell.cachedValue
+                cell.setComputedValue(value)
+                if Cell.valueChanged(oldValue, value):
+                    changed.append(CellRef(row, col))
+
+    # Groups cells by their formula template, so each worker only has to
+    # parse each template once (see _evaluateChunk)
+    @staticmethod
+    def _groupByTemplate(cellRefs):
+        groups = {}
+        for cellRef in cellRefs:
+            cell = Cell._store.getFormulaCell(cellRef.row, cellRef.col)
+            if cell.template.ident not in groups:
+                groups[cell.template.ident] = (cell.template.formula, [])
+            groups[cell.template.ident][1].append((cellRef.row, cellRef.col))
+        return list(groups.values())
+
+    # Returns the values of every cell the given cells' formulae read
+    @staticmethod
+    def _snapshot(cellRefs):
+        from formulae import Range
+        store = Cell._store
+        positions = set()
+        ranges = set()
+        for cellRef in cellRefs:
+            for dependency in Cell._deps.getShallowDependencies(cellRef):
+                if dependency.isRange:
+                    ranges.add(dependency)
+                else:
+                    positions.add((dependency.row, dependency.col))
+
+        # neighboring cells' ranges usually overlap (e.g., sliding windows),
+        # so read their bounding box once if that's no bigger than all of them
+        if ranges:
+            bounds = Range(min(r.startRow for r in ranges),
+                           min(r.startCol for r in ranges),
+                           max(r.endRow for r in ranges),
+                           max(r.endCol for r in ranges))
+            if bounds.size() <= sum(r.size() for r in ranges):
+                ranges = [bounds]
+            for cellRange in ranges:
+                positions.update(store.positionsInRange(cellRange))
+
+        return {position: store.getValue(*position) for position in positions
+                if position in store}
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -0,0 +1,133 @@
+# profiler.py
+# Joseph Rotella (jrotella, F0)
+#
+# Opt-in profiler for the formula engine, for finding the cells that make a
+# sheet slow: records how many times each cell is evaluated and how long that
+# takes, both by itself and including the cells it read that had to be
+# evaluated first. Use it with Cell.setProfiler(FormulaProfiler()). Without a
+# profiler, evaluation isn't timed (or slowed down) at all. Cells evaluated in
+# other processes (see formulae.parallel) aren't profiled.
+import json
+import time
+
+from formulae import Cell, CellRef
+
+
+# How a single cell's evaluations went
+class CellProfile(object):
+    def __init__(self, row, col):
+        self.row = row
+        self.col = col
+        self.evaluations = 0
+        # in seconds, including the cells it read that were evaluated for it
+        # (whether that happened in the middle of it or just before it)
+        self.totalTime = 0.0
+        self.selfTime = 0.0  # in seconds, not including them
+        # from the dependency graph, filled in by FormulaProfiler.hotspots()
+        self.fanIn = 0  # how many cells the formula reads (ranges in full)
+        self.fanOut = 0  # how many formulae read the cell directly
+
+    @property
+    def name(self):
+        return f'{chr(ord("A") + self.col)}{self.row + 1}'
+
+    def toDict(self):
+        return {'cell': self.name, 'row': self.row, 'col': self.col,
+                'evaluations': self.evaluations,
+                'totalTime': self.totalTime, 'selfTime': self.selfTime,
+                'fanIn': self.fanIn, 'fanOut': self.fanOut}
+
+
+class FormulaProfiler(object):
+    kSortKeys = ['selfTime', 'totalTime', 'evaluations', 'fanIn', 'fanOut']
+
+    def __init__(self):
+        self.profiles = {}  # (row, col) -> CellProfile
+        # for each evaluation in progress, the time spent evaluating other
+        # cells in the middle of it so far (which isn't its self time)
+        self.nestedTimes = []
+        # cells read by a formula are usually evaluated just before it (see
+        # Cell._evaluateWithDependencies) rather than in the middle of it, so
+        # these track which cell each one was evaluated for, and how long the
+        # cells evaluated for each cell took in total
+        self.demanders = {}  # Cell -> Cell
+        self.precedentTimes = {}  # Cell -> seconds
+
+    def reset(self):
+        self.profiles = {}
+        self.demanders = {}
+        self.precedentTimes = {}
+
+    # Called when a cell is about to be evaluated (before the one given)
+    # because the given one reads it
+    def demand(self, cell, demander):
+        if cell not in self.demanders:
+            self.demanders[cell] = demander
+
+    # Called in place of Cell._evaluate while profiling: evaluates the cell
+    # with the given (untimed) method, timing it
+    def evaluate(self, cell, evaluate):
+        self.nestedTimes.append(0.0)
+        start = time.perf_counter()
+        try:
+            return evaluate(cell)
+        finally:
+            elapsed = time.perf_counter() - start
+            nestedTime = self.nestedTimes.pop()
+            if self.nestedTimes:
+                self.nestedTimes[-1] += elapsed
+            totalTime = elapsed + self.precedentTimes.pop(cell, 0.0)
+            demander = self.demanders.pop(cell, None)
+            if demander is not None:
+                self.precedentTimes[demander] = (
+                    self.precedentTimes.get(demander, 0.0) + totalTime)
+            profile = self.profiles.get((cell.row, cell.col))
+            if profile is None:
+                profile = CellProfile(cell.row, cell.col)
+                self.profiles[cell.row, cell.col] = profile
+            profile.evaluations += 1
+            profile.totalTime += totalTime
+            profile.selfTime += elapsed - nestedTime
+
+    # Returns the profiles of the evaluated cells, costliest first by the
+    # given measure (one of kSortKeys), optionally only the first few
+    def hotspots(self, limit=None, sortBy='selfTime'):
+        if sortBy not in FormulaProfiler.kSortKeys:
+            raise Exception(f'Can\'t sort profiles by {sortBy}')
+        for profile in self.profiles.values():
+            cellRef = CellRef(profile.row, profile.col)
+            profile.fanIn = sum(
+                dependency.size() if dependency.isRange else 1
+                for dependency in Cell._deps.getShallowDependencies(cellRef))
+            profile.fanOut = len(Cell._deps.getShallowDependents(cellRef))
+        profiles = sorted(self.profiles.values(),
+                          key=lambda profile: getattr(profile, sortBy),
+                          reverse=True)
+        return profiles if limit is None else profiles[:limit]
+
+    # Returns a table of the top hotspots, as text
+    def report(self, limit=20, sortBy='selfTime'):
+        profiles = self.hotspots(limit, sortBy)
+        evaluations = sum(profile.evaluations
+                          for profile in self.profiles.values())
+        selfTime = sum(profile.selfTime for profile in self.profiles.values())
+        lines = [f'{evaluations} evaluations of {len(self.profiles)} cells '
+                 f'in {selfTime * 1000:.1f} ms',
+                 f'{"cell":>6} {"evals":>8} {"self ms":>10} {"total ms":>10}'
+                 f' {"fan-in":>8} {"fan-out":>8}']
+        for profile in profiles:
+            lines.append(f'{profile.name:>6} {profile.evaluations:>8} '
+                         f'{profile.selfTime * 1000:>10.3f} '
+                         f'{profile.totalTime * 1000:>10.3f} '
+                         f'{profile.fanIn:>8} {profile.fanOut:>8}')
+        return '\n'.join(lines)
+
+    # Returns every cell's profile as JSON, costliest first
+    def toJSON(self, sortBy='selfTime'):
+        return json.dumps({'cells': [profile.toDict() for profile
+                                     in self.hotspots(sortBy=sortBy)]},
+                          indent=2)
+
+    def dump(self, path, sortBy='selfTime'):
+        with open(path, 'w') as file:
+            file.write(self.toJSON(sortBy))
@@ -0,0 +1,83 @@
+# scheduler.py
+# Joseph Rotella (jrotella, F0)
+#
+# Time-sliced recalculation, so that a big recalculation doesn't freeze the
+# UI. A SlicedRecalculation recomputes cells in recalculation order for a few
+# milliseconds at a time (see step), and the UI runs a slice at a time from
+# its event loop, handling input and repainting in between. Cells that
+# haven't been recomputed yet are still marked out of date, so dropping a
+# recalculation part-way through never leaves wrong values behind: reading
+# one of its cells just computes it then.
+import time
+
+from formulae import Cell
+
+# how long a slice runs for (in seconds)
+kSliceTime = 0.008
+# how many cells are recomputed between looking at the clock
+kCellsPerCheck = 32
+
+
+class SlicedRecalculation(object):
+    # cellRefs are the cells to recompute, in recalculation order (e.g.,
+    # from Cell.getRecalcOrder); the active sheet's engine is the one they're
+    # recomputed in
+    def __init__(self, cellRefs):
+        # (a cell may be listed more than once if, e.g., it's what's left of
+        # an earlier recalculation; the first time is enough)
+        self.cellRefs = list(dict.fromkeys(cellRefs))
+        self.position = 0
+        self.engine = Cell.getEngine()
+
+    # Returns a recalculation of the given cells (in recalculation order)
+    # and whatever an earlier one that's being dropped hadn't gotten to yet
+    # (unless that was in another sheet, whose cells are just left out of
+    # date)
+    @staticmethod
+    def replacing(previous, cellRefs):
+        if previous is None or previous.engine is not Cell.getEngine():
+            return SlicedRecalculation(cellRefs)
+        return SlicedRecalculation(previous.remaining() + list(cellRefs))
+
+    def isDone(self):
+        return self.position >= len(self.cellRefs)
+
+    # How much of the recalculation is done, from 0 to 1
+    def progress(self):
+        if not self.cellRefs:
+            return 1.0
+        return self.position / len(self.cellRefs)
+
+    # CellRefs to the cells that haven't been gotten to yet
+    def remaining(self):
+        return self.cellRefs[self.position:]
+
+    # Recomputes cells for about sliceTime seconds (or until done). Returns
+    # CellRefs to the cells whose values may have changed, in the order they
+    # were recomputed.
+    def step(self, sliceTime=kSliceTime):
+        if Cell.getEngine() is not self.engine:
+            # (e.g., another sheet was opened in the meantime)
+            return self.engine.run(self.step, sliceTime)
+        deadline = time.perf_counter() + sliceTime
+        changed = []
+        while not self.isDone():
+            end = min(self.position + kCellsPerCheck, len(self.cellRefs))
+            for cellRef in self.cellRefs[self.position:end]:
+                cell = Cell._store.getFormulaCell(cellRef.row, cellRef.col)
+                if cell is None:
+                    continue
+                if not cell.dirty:
+                    # something read it between slices, so it may have
+                    # changed without the recalculation seeing it
+                    changed.append(cellRef)
+                elif Cell.valueChanged(cell.cachedValue, cell._evaluate()):
+                    changed.append(cellRef)
+            self.position = end
+            if time.perf_counter() >= deadline:
+                break
+        return changed
+
+    # Recomputes everything that's left, all at once
+    def finish(self):
+        return self.step(float('inf'))
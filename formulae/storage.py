@@ -0,0 +1,526 @@
+# storage.py
+# Joseph Rotella (jrotella, F0)
+#
+# Pluggable storage backends for cell contents. A backend stores every cell's
+# raw text and value; formula cells are always kept as Cell objects, since
+# those hold the formula's template and cached value.
+import sys
+from abc import ABC, abstractmethod
+from array import array
+
+from formulae.errors import FormulaError
+from formulae.operators import numpy, NumericArray, kMaxExactInt, \
+    numberize, parseLiteral
+
+
+class CellStore(ABC):
+    # Returns the Cell object at a position, or None if there is none (which,
+    # depending on the backend, may be the case even for populated cells)
+    @abstractmethod
+    def getCell(self, row, col):
+        pass
+
+    # Returns the Cell object at a position if it holds a formula
+    def getFormulaCell(self, row, col):
+        cell = self.getCell(row, col)
+        if cell is not None and cell.template is not None:
+            return cell
+        return None
+
+    @abstractmethod
+    def getValue(self, row, col):
+        pass
+
+    # Returns a cell's value as a number, or None if it isn't numerical
+    @abstractmethod
+    def getNumericValue(self, row, col):
+        pass
+
+    @abstractmethod
+    def getRaw(self, row, col):
+        pass
+
+    # Stores a non-formula cell
+    @abstractmethod
+    def setLiteral(self, row, col, text):
+        pass
+
+    # Stores a formula cell, returning its Cell object
+    @abstractmethod
+    def setFormula(self, row, col, text, template):
+        pass
+
+    @abstractmethod
+    def delete(self, row, col):
+        pass
+
+    @abstractmethod
+    def __contains__(self, position):
+        pass
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    # Returns the (row, col) position of every populated cell
+    @abstractmethod
+    def positions(self):
+        pass
+
+    # Returns the positions of the populated cells in a Range, in row-major
+    # order
+    @abstractmethod
+    def positionsInRange(self, cellRange):
+        pass
+
+    # Returns the Cell objects of the formula cells in a Range, in no
+    # particular order
+    def formulaCellsInRange(self, cellRange):
+        cells = []
+        for row, col in self.positionsInRange(cellRange):
+            cell = self.getFormulaCell(row, col)
+            if cell is not None:
+                cells.append(cell)
+        return cells
+
+    # Returns the values of the populated cells in a Range, in row-major order
+    def valuesInRange(self, cellRange):
+        return [self.getValue(row, col)
+                for row, col in self.positionsInRange(cellRange)]
+
+    # Returns the numeric views of the numerical cells in a Range, in
+    # row-major order
+    def numbersInRange(self, cellRange):
+        numbers = []
+        for row, col in self.positionsInRange(cellRange):
+            number = self.getNumericValue(row, col)
+            if number is not None:
+                numbers.append(number)
+        return numbers
+
+    # Returns the values of the populated cells in a Range as a NumericArray,
+    # or None if they can't all be represented as floats or this backend
+    # can't read them as an array directly (gathering them cell by cell into
+    # one costs more than NumPy saves, so they're aggregated in pure Python
+    # instead). Requires NumPy.
+    def numericArrayInRange(self, cellRange):
+        return None
+
+
+# Returns the keys of a dict keyed by (row, col) that are in a Range, in
+# row-major order. Probes every position in the range or filters every key,
+# whichever is cheaper.
+def positionsInRange(cells, cellRange):
+    if cellRange.size() <= len(cells):
+        cols = range(cellRange.startCol, cellRange.endCol + 1)
+        return [(row, col)
+                for row in range(cellRange.startRow, cellRange.endRow + 1)
+                for col in cols if (row, col) in cells]
+    else:
+        return sorted(pos for pos in cells
+                      if cellRange.contains(pos[0], pos[1]))
+
+
+# Stores every cell as a Cell object in a dict keyed by (row, col)
+class DictCellStore(CellStore):
+    def __init__(self):
+        self.cells = {}
+        self.formulaCells = {}  # col -> row -> Cell, just for formulae
+
+    def getCell(self, row, col):
+        return self.cells.get((row, col))
+
+    def getValue(self, row, col):
+        cell = self.cells.get((row, col))
+        return cell.value() if cell is not None else ''
+
+    def getNumericValue(self, row, col):
+        cell = self.cells.get((row, col))
+        return cell.numericValue() if cell is not None else None
+
+    def getRaw(self, row, col):
+        cell = self.cells.get((row, col))
+        return cell.raw if cell is not None else ''
+
+    def _getOrCreate(self, row, col):
+        from formulae import Cell
+        cell = self.cells.get((row, col))
+        if cell is None:
+            cell = Cell(row, col)
+            self.cells[row, col] = cell
+        return cell
+
+    def setLiteral(self, row, col, text):
+        self._getOrCreate(row, col).setLiteral(text)
+        self._forgetFormula(row, col)
+
+    def setFormula(self, row, col, text, template):
+        cell = self._getOrCreate(row, col)
+        cell.setFormula(text, template)
+        if col not in self.formulaCells:
+            self.formulaCells[col] = {}
+        self.formulaCells[col][row] = cell
+        return cell
+
+    def _forgetFormula(self, row, col):
+        column = self.formulaCells.get(col)
+        if column is not None:
+            column.pop(row, None)
+            if not column:
+                del self.formulaCells[col]
+
+    def delete(self, row, col):
+        self.cells.pop((row, col), None)
+        self._forgetFormula(row, col)
+
+    def __contains__(self, position):
+        return position in self.cells
+
+    def __len__(self):
+        return len(self.cells)
+
+    def positions(self):
+        return list(self.cells)
+
+    def positionsInRange(self, cellRange):
+        return positionsInRange(self.cells, cellRange)
+
+    # Only looks at the range's columns, probing each one's rows or filtering
+    # its formula cells, whichever is cheaper
+    def formulaCellsInRange(self, cellRange):
+        cells = []
+        numRows = cellRange.endRow - cellRange.startRow + 1
+        for col in range(cellRange.startCol, cellRange.endCol + 1):
+            column = self.formulaCells.get(col)
+            if column is None:
+                continue
+            if numRows <= len(column):
+                cells += [column[row]
+                          for row in range(cellRange.startRow,
+                                           cellRange.endRow + 1)
+                          if row in column]
+            else:
+                cells += [column[row] for row in column
+                          if cellRange.startRow <= row <= cellRange.endRow]
+        return cells
+
+    # Reads non-formula cells' precomputed numeric views directly
+    def numbersInRange(self, cellRange):
+        cells = self.cells
+        numbers = []
+        for position in self.positionsInRange(cellRange):
+            cell = cells[position]
+            if cell.template is None:
+                number = cell.numeric
+            else:
+                number = cell.numericValue()
+            if number is not None:
+                numbers.append(number)
+        return numbers
+
+
+# A single column of a ColumnarCellStore. Cells are stored densely by row in
+# typed arrays: a kind code per row and a float64 per row for numbers. Text is
+# interned and kept in a sparse dict, as are the Cell objects for formulae.
+class Column(object):
+    kEmpty = 0
+    kInt = 1
+    kFloat = 2
+    kText = 3
+    kCell = 4  # formulae (and numbers floats can't represent exactly)
+
+    def __init__(self):
+        self.kinds = array('b')
+        self.numbers = array('d')
+        # raw text of text cells, and of numbers whose raw text isn't just
+        # the number printed back out (e.g., '1.50' or '+3')
+        self.texts = {}
+        # numeric views of text cells that are still numbers (e.g., '1,000')
+        self.textNumbers = {}
+        self.cells = {}
+        self.count = 0
+
+    def _grow(self, row):
+        if row >= len(self.kinds):
+            extraRows = row + 1 - len(self.kinds)
+            self.kinds.frombytes(bytes(extraRows))
+            self.numbers.frombytes(bytes(extraRows
+                                         * self.numbers.itemsize))
+
+    def kindAt(self, row):
+        return self.kinds[row] if 0 <= row < len(self.kinds) else Column.kEmpty
+
+    def clear(self, row):
+        if self.kindAt(row) == Column.kEmpty:
+            return
+        self.kinds[row] = Column.kEmpty
+        self.numbers[row] = 0
+        self.texts.pop(row, None)
+        self.textNumbers.pop(row, None)
+        self.cells.pop(row, None)
+        self.count -= 1
+
+    def set(self, row, kind, number=0.0, text=None, cell=None,
+            textNumber=None):
+        self.clear(row)
+        self._grow(row)
+        self.kinds[row] = kind
+        self.numbers[row] = number
+        if text is not None:
+            self.texts[row] = sys.intern(text)
+        if textNumber is not None:
+            self.textNumbers[row] = textNumber
+        if cell is not None:
+            self.cells[row] = cell
+        self.count += 1
+
+
+# Stores cells column by column in typed arrays (see Column), which is far
+# more compact than a Cell object per cell for large imported datasets and
+# lets range scans read numbers straight out of contiguous memory
+class ColumnarCellStore(CellStore):
+    def __init__(self):
+        self.columns = {}
+        self.count = 0
+
+    def _kindAt(self, row, col):
+        column = self.columns.get(col)
+        return column.kindAt(row) if column is not None else Column.kEmpty
+
+    def getCell(self, row, col):
+        if self._kindAt(row, col) == Column.kCell:
+            return self.columns[col].cells[row]
+        return None
+
+    def getValue(self, row, col):
+        kind = self._kindAt(row, col)
+        if kind == Column.kEmpty:
+            return ''
+        column = self.columns[col]
+        if kind == Column.kInt:
+            return int(column.numbers[row])
+        elif kind == Column.kFloat:
+            return column.numbers[row]
+        elif kind == Column.kText:
+            return column.texts[row]
+        else:
+            return column.cells[row].value()
+
+    def getNumericValue(self, row, col):
+        kind = self._kindAt(row, col)
+        if kind == Column.kEmpty:
+            return None
+        column = self.columns[col]
+        if kind == Column.kInt:
+            return int(column.numbers[row])
+        elif kind == Column.kFloat:
+            return column.numbers[row]
+        elif kind == Column.kText:
+            return column.textNumbers.get(row)
+        else:
+            return column.cells[row].numericValue()
+
+    def getRaw(self, row, col):
+        kind = self._kindAt(row, col)
+        if kind == Column.kEmpty:
+            return ''
+        column = self.columns[col]
+        if kind == Column.kCell:
+            return column.cells[row].raw
+        elif row in column.texts:
+            return column.texts[row]
+        elif kind == Column.kInt:
+            return str(int(column.numbers[row]))
+        else:
+            return repr(column.numbers[row])
+
+    def _column(self, col):
+        if col not in self.columns:
+            self.columns[col] = Column()
+        return self.columns[col]
+
+    def setLiteral(self, row, col, text):
+        from formulae import Cell
+        column = self._column(col)
+        self.count -= column.count
+        # same typing rules as Cell.value()
+        number = parseLiteral(text)
+        if type(number) is int:
+            kind = Column.kInt
+        elif type(number) is float:
+            kind = Column.kFloat
+        else:
+            kind = Column.kText
+
+        if kind == Column.kText:
+            column.set(row, kind, text=text, textNumber=numberize(text))
+        elif kind == Column.kInt and abs(number) >= kMaxExactInt:
+            cell = Cell(row, col)
+            cell.setLiteral(text)
+            column.set(row, Column.kCell, cell=cell)
+        else:
+            roundTrips = (str(number) if kind == Column.kInt
+                          else repr(number)) == text
+            column.set(row, kind, number,
+                       text=None if roundTrips else text)
+        self.count += column.count
+
+    def setFormula(self, row, col, text, template):
+        from formulae import Cell
+        column = self._column(col)
+        self.count -= column.count
+        cell = Cell(row, col)
+        cell.setFormula(text, template)
+        column.set(row, Column.kCell, cell=cell)
+        self.count += column.count
+        return cell
+
+    def delete(self, row, col):
+        column = self.columns.get(col)
+        if column is not None:
+            self.count -= column.count
+            column.clear(row)
+            self.count += column.count
+
+    def __contains__(self, position):
+        return self._kindAt(*position) != Column.kEmpty
+
+    def __len__(self):
+        return self.count
+
+    def positions(self):
+        positions = []
+        for col in self.columns:
+            kinds = self.columns[col].kinds
+            positions += [(row, col) for row in range(len(kinds))
+                          if kinds[row]]
+        return positions
+
+    def positionsInRange(self, cellRange):
+        cols = [col for col in range(cellRange.startCol, cellRange.endCol + 1)
+                if col in self.columns]
+        if not cols:
+            return []
+        endRow = min(cellRange.endRow + 1,
+                     max(len(self.columns[col].kinds) for col in cols))
+        if len(cols) == 1:
+            col = cols[0]
+            kinds = self.columns[col].kinds
+            return [(row, col)
+                    for row in range(cellRange.startRow,
+                                     min(endRow, len(kinds)))
+                    if kinds[row]]
+        return [(row, col) for row in range(cellRange.startRow, endRow)
+                for col in cols if self.columns[col].kindAt(row)]
+
+    def formulaCellsInRange(self, cellRange):
+        cells = []
+        for col in range(cellRange.startCol, cellRange.endCol + 1):
+            column = self.columns.get(col)
+            if column is None:
+                continue
+            for row in column.cells:
+                cell = column.cells[row]
+                if (cellRange.startRow <= row <= cellRange.endRow
+                        and cell.template is not None):
+                    cells.append(cell)
+        return cells
+
+    # Reads numbers directly out of each column's float64 array; only text
+    # and formula cells need to be converted one by one
+    def numericArrayInRange(self, cellRange):
+        arrays = []
+        for col in range(cellRange.startCol, cellRange.endCol + 1):
+            column = self.columns.get(col)
+            if column is None:
+                continue
+            start = cellRange.startRow
+            end = min(cellRange.endRow + 1, len(column.kinds))
+            if start >= end:
+                continue
+            kinds = numpy.frombuffer(column.kinds, dtype=numpy.int8)[start:end]
+            values = numpy.frombuffer(column.numbers,
+                                      dtype=numpy.float64)[start:end]
+            valid = (kinds == Column.kInt) | (kinds == Column.kFloat)
+            isInt = kinds == Column.kInt
+
+            others = numpy.flatnonzero(kinds >= Column.kText)
+            if len(others) > 0:
+                values = values.copy()
+                for idx in others.tolist():
+                    row = start + idx
+                    if kinds[idx] == Column.kText:
+                        number = column.textNumbers.get(row)
+                    else:
+                        number = column.cells[row].numericValue()
+                    if number is None:
+                        continue
+                    if isinstance(number, FormulaError):
+                        return None  # (the result is the first error)
+                    if type(number) is int and abs(number) >= kMaxExactInt:
+                        return None
+                    values[idx] = number
+                    valid[idx] = True
+                    isInt[idx] = type(number) is int
+            arrays.append(NumericArray(values, valid, isInt))
+
+        if not arrays:
+            return NumericArray(numpy.empty(0), numpy.empty(0, dtype=bool),
+                                numpy.empty(0, dtype=bool))
+        return NumericArray(numpy.concatenate([a.values for a in arrays]),
+                            numpy.concatenate([a.valid for a in arrays]),
+                            numpy.concatenate([a.isInt for a in arrays]))
+
+
+# A read-only store of plain values for some cells (e.g., just the ones a few
+# formulae read), for evaluating formulae away from the real cells, such as in
+# another process. Snapshots don't know cells' raw text.
+class SnapshotCellStore(CellStore):
+    def __init__(self, values):
+        self.values = values  # (row, col) -> value
+        self.numbers = {}  # (row, col) -> numeric view, for numerical cells
+        for position in values:
+            number = numberize(values[position])
+            if number is not None:
+                self.numbers[position] = number
+
+    def getCell(self, row, col):
+        return None
+
+    def getValue(self, row, col):
+        return self.values.get((row, col), '')
+
+    def getNumericValue(self, row, col):
+        return self.numbers.get((row, col))
+
+    def getRaw(self, row, col):
+        raise Exception('Cell snapshots only store values')
+
+    def setLiteral(self, row, col, text):
+        raise Exception('Cell snapshots are read-only')
+
+    def setFormula(self, row, col, text, template):
+        raise Exception('Cell snapshots are read-only')
+
+    def delete(self, row, col):
+        raise Exception('Cell snapshots are read-only')
+
+    def __contains__(self, position):
+        return position in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def positions(self):
+        return list(self.values)
+
+    def positionsInRange(self, cellRange):
+        return positionsInRange(self.values, cellRange)
+
+    def formulaCellsInRange(self, cellRange):
+        return []
+
+    def numbersInRange(self, cellRange):
+        numbers = self.numbers
+        return [numbers[position]
+                for position in positionsInRange(numbers, cellRange)]
@@ -0,0 +1,45 @@
+# workbook.py
+# Joseph Rotella (jrotella, F0)
+#
+# Reading saved workbook files. A workbook has three lines per sheet: its
+# name, its cells (see Cell.serializeRaw), and its charts. Charts are left
+# serialized here, since only the UI knows what to do with them, so reading
+# a workbook doesn't need any of the UI's modules.
+from formulae import Cell
+
+
+class SheetData(object):
+    def __init__(self, name, cells, charts):
+        self.name = name
+        self.cells = cells  # raw cells, as for Cell.loadRawCells
+        self.charts = charts  # the serialized charts line
+
+    # Returns every cell's computed value as ((row, col), value) pairs in
+    # reading order. Cells whose formulae can't be parsed are 'SYNTAX-ERROR'
+    # (as the grid shows them). This loads the sheet into the active engine.
+    def evaluate(self):
+        Cell.loadRawCells(self.cells)
+        for row, col in sorted(self.cells or {}):
+            if (self.cells[row, col].startswith('=')
+                    and not Cell.hasFormula(row, col)):
+                yield (row, col), 'SYNTAX-ERROR'
+            else:
+                yield (row, col), Cell.getValue(row, col)
+
+
+# Returns the SheetData of each sheet in a workbook file's contents
+def parseWorkbook(data):
+    # note -- we want to get empty strings, so splitlines() and other
+    # "clever" Python built-ins are a bad idea
+    lines = data.split('\n')
+    sheets = []
+    # (a sheet missing any of its lines is left out)
+    for i in range(0, len(lines) - 2, 3):
+        cells = Cell.deserializeRawCells(lines[i + 1])
+        sheets.append(SheetData(lines[i], cells, lines[i + 2]))
+    return sheets
+
+
+def readWorkbook(path):
+    with open(path, 'r') as file:
+        return parseWorkbook(file.read())
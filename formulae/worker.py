@@ -0,0 +1,141 @@
+# worker.py
+# Joseph Rotella (jrotella, F0)
+#
+# Optional worker thread for the formula engine, so that big recalculations
+# don't happen on the UI thread. The UI posts which cell it changed with
+# recalculate(); the worker works out what depends on it and recomputes that
+# a slice at a time (see formulae.scheduler), posting a ValueBatch of the new
+# values after every slice, which the UI collects with getBatches() (e.g.,
+# from a timer). The engine itself is shared, so anything using it on either
+# thread needs to hold the worker's lock. The worker only holds it for a
+# slice at a time, so the UI never waits long for it, and reads all of a
+# batch's values while holding it, so a batch never mixes values from before
+# and after some other change. Nothing needs to poll for batches once
+# isBusy() says everything posted has been recalculated.
+import queue
+import threading
+import time
+
+from formulae import Cell
+from formulae.scheduler import SlicedRecalculation
+
+# posted to make the worker stop
+kStop = 'stop'
+
+
+# The new values of the cells a slice of a recalculation changed
+class ValueBatch(object):
+    def __init__(self, engine, values, progress, done):
+        self.engine = engine  # the SheetEngine the cells are in
+        self.values = values  # list of (CellRef, value)
+        self.progress = progress  # how much of the recalculation is done
+        self.done = done  # whether this is its last batch
+
+
+class EngineWorker(object):
+    def __init__(self, lock=None):
+        self.lock = lock or threading.RLock()
+        self.requests = queue.Queue()
+        self.batches = queue.Queue()
+        # how many posted recalculations haven't finished yet
+        self.unfinished = 0
+        self.unfinishedLock = threading.Lock()
+        # the rest is only used by the worker thread
+        self.recalculation = None
+        self.started = 0  # requests the recalculation in progress covers
+        self.waiters = []  # Events to set once there's nothing left to do
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # Recalculates everything that depends on the given cell (which has
+    # already been changed), then starts a new recalculation epoch, like
+    # Cell.recalculate and Cell.recalculateVolatile. A recalculation still in
+    # progress is replaced by this one (see SlicedRecalculation.replacing).
+    def recalculate(self, row, col):
+        self._post((Cell.getEngine(), row, col))
+
+    def recalculateVolatile(self):
+        self._post((Cell.getEngine(), None, None))
+
+    def _post(self, request):
+        with self.unfinishedLock:
+            self.unfinished += 1
+        self.requests.put(request)
+
+    # Whether anything posted hasn't been recalculated yet. Once this is
+    # False, every batch has already been posted, so collecting them with
+    # getBatches() after checking this never misses any.
+    def isBusy(self):
+        with self.unfinishedLock:
+            return self.unfinished > 0
+
+    # Returns the batches posted since the last call, oldest first
+    def getBatches(self):
+        batches = []
+        while True:
+            try:
+                batches.append(self.batches.get_nowait())
+            except queue.Empty:
+                return batches
+
+    # Blocks until everything posted so far has been recalculated
+    def wait(self):
+        done = threading.Event()
+        self.requests.put(done)
+        done.wait()
+
+    def stop(self):
+        self.requests.put(kStop)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            if self.recalculation is None:
+                for waiter in self.waiters:
+                    waiter.set()
+                self.waiters = []
+                request = self.requests.get()
+            else:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    request = None
+            if request == kStop:
+                return
+            elif isinstance(request, threading.Event):
+                self.waiters.append(request)
+                continue
+            with self.lock:
+                if request is not None:
+                    engine, row, col = request
+                    engine.run(self._startRecalculation, row, col)
+                    self.started += 1
+                batch = self._step()
+            self.batches.put(batch)
+            if batch.done:
+                # (only once its last batch has been posted; see isBusy)
+                with self.unfinishedLock:
+                    self.unfinished -= self.started
+                self.started = 0
+            # give a thread waiting for the lock (e.g., the UI's) a chance to
+            # take it before the next slice
+            time.sleep(0)
+
+    def _startRecalculation(self, row, col):
+        cellRefs = [] if row is None else Cell.getRecalcOrder(row, col)
+        cellRefs += Cell.startVolatileEpoch()
+        self.recalculation = SlicedRecalculation.replacing(self.recalculation,
+                                                           cellRefs)
+
+    # Runs a slice of the recalculation, returning the batch of values it
+    # changed
+    def _step(self):
+        recalculation = self.recalculation
+        changed = recalculation.step()
+        values = recalculation.engine.run(
+            lambda: [(cellRef, Cell.getValue(cellRef.row, cellRef.col))
+                     for cellRef in changed])
+        if recalculation.isDone():
+            self.recalculation = None
+        return ValueBatch(recalculation.engine, values,
+                          recalculation.progress(), recalculation.isDone())
@@ -5,6 +5,7 @@
 # independent states and event-driven design patterns.
 # *Very* loosely inspired by the design of the React framework.
 import copy
+import threading
 from enum import Enum
 
 from cmu_112_graphics import App as CMUApp, WrappedCanvas
@@ -141,6 +142,9 @@ class UIElement(ABC):
     def runModal(self, modal):
         App.instance.runModal(modal)
 
+    def runLater(self, key, fn, delay=0):
+        App.instance.runLater(key, fn, delay)
+
 class EventType(Enum):
     CLICK = 0
     DRAG = 1
@@ -154,6 +158,10 @@ class App(CMUApp, UIElement):
     # listeners in `initChildren()`)
     keyListeners = []
     ephemeralListener = None
+    # held while handling an event or drawing, so that other threads (e.g.,
+    # one doing the app's computation) can keep from changing what the UI
+    # reads in the middle of it
+    lock = threading.RLock()
 
     def __init__(self, title, scene):
         UIElement.__init__(self, 'root', 0, 0, {})
@@ -174,14 +182,17 @@ class App(CMUApp, UIElement):
     def mousePressed(self, event):
         self.dragStart = (event.x, event.y)
         App._addEventMetadata(event)
-        self.sendMouseEventToChildren(self, event, EventType.CLICK)
+        with App.lock:
+            self.sendMouseEventToChildren(self, event, EventType.CLICK)
 
     def mouseDragged(self, event):
         # Sadly, MouseMotionEvents don't capture state, so no metadata
-        self.sendMouseEventToChildren(self, event, EventType.DRAG)
+        with App.lock:
+            self.sendMouseEventToChildren(self, event, EventType.DRAG)
 
     def mouseReleased(self, event):
-        self.sendMouseEventToChildren(self, event, EventType.RELEASE)
+        with App.lock:
+            self.sendMouseEventToChildren(self, event, EventType.RELEASE)
 
     def sendMouseEventToChildren(self, element: UIElement, event, evtType):
         childIdx = len(element.children) - 1
@@ -253,6 +264,10 @@ class App(CMUApp, UIElement):
 
     def keyPressed(self, event):
         App._addEventMetadata(event)
+        with App.lock:
+            self._sendKeypress(event)
+
+    def _sendKeypress(self, event):
         # get the easy one taken care of first (also most likely to be
         # topmost, so makes sense to call first)
         if App.ephemeralListener is not None:
@@ -276,7 +291,8 @@ class App(CMUApp, UIElement):
                 App.keyListeners[i].onKeypress(event)
 
     def redrawAll(self, canvas):
-        self.draw(RelativeCanvas(canvas, 0, 0))
+        with App.lock:
+            self.draw(RelativeCanvas(canvas, 0, 0))
 
     def getWidth(self):
         return self.width
@@ -295,6 +311,20 @@ class App(CMUApp, UIElement):
             onDismiss=lambda name=name: self._dismissModal(name)))
         self.curModalId += 1
 
+    # Calls fn from the event loop after delay milliseconds (letting it
+    # handle input and repaint first), then redraws. Scheduling another call
+    # with the same key before then replaces this one.
+    def runLater(self, key, fn, delay=0):
+        def callAndRedraw():
+            with App.lock:
+                fn()
+            self._redrawAllWrapper()
+            # with calls scheduled back to back, Tk would never get idle
+            # enough to actually show the new drawing
+            self._root.update_idletasks()
+        self._deferredMethodCall(afterId=key, afterDelay=delay,
+                                 afterFn=callAndRedraw, replace=True)
+
     def _dismissModal(self, name):
         self.removeChild(name)
 
@@ -8,7 +8,8 @@ from enum import Enum
 
 from data_visualization import ChartType, Series, LineChart, ChartData, \
     BarChart, PieChart, ScatterChart
-from formulae import Cell, CellRef, Formula, Operator
+from formulae import Cell, CellRef, Formula, Operator, Range
+from formulae.scheduler import SlicedRecalculation
 from modular_graphics import UIElement
 from modular_graphics.atomic_elements import Rectangle, Line
 from ui_components.UICell import UICell
@@ -21,6 +22,9 @@ class SpreadsheetGrid(UIElement):
     numRows = 20
     numCols = 9
     siderWidth = 25
+    # how often to check for the engine worker's batches while it's busy (in
+    # milliseconds)
+    workerPollDelay = 50
 
     def __init__(self, name, x, y, **props):
         super().__init__(name, x, y, props)
@@ -30,6 +34,12 @@ class SpreadsheetGrid(UIElement):
         self.selectedCells = []
         self.highlighted = []
         self.charts = []
+        # the SlicedRecalculation in progress, if any (see recalculate)
+        self.recalculation = None
+        # optional formulae.worker.EngineWorker to recalculate on instead,
+        # and how far along its recalculation is (None if it's done)
+        self.engineWorker = props.get('engineWorker')
+        self.workerProgress = None
         self.dragStartX = 0
         self.dragStartY = 0
         self.dragThreshold = 2
@@ -43,6 +53,9 @@ class SpreadsheetGrid(UIElement):
         # 2. Charts (need to cover body cells but be covered by headers/siders)
         # 3. Headers/siders & preview
 
+        # only what's on screen needs computing (see Cell.setDemanded)
+        self.updateDemanded()
+
         # body cells
         for rowNum in range(self.numRows):
             for colNum in range(self.numCols):
@@ -113,6 +126,18 @@ class SpreadsheetGrid(UIElement):
 
         self.makeKeyListener()
 
+    # tells the formula engine which cells are visible (on the grid or in
+    # charts), so that those are the ones kept up to date
+    def updateDemanded(self):
+        demanded = [Range(self.curTopRow, self.curLeftCol,
+                          self.curTopRow + self.numRows - 1,
+                          self.curLeftCol + self.numCols - 1)]
+        for chart in self.charts:
+            demanded += [Range(cellRef.row, cellRef.col,
+                               cellRef.row, cellRef.col)
+                         for cellRef in chart.cellRefs()]
+        Cell.setDemanded(demanded)
+
     # called by text field after new value entered
     # NOTE: this might be called by a selected-but-not-active cell,
     #       so ALWAYS use sender instead of (possibly-None) self.activeCell
@@ -126,21 +151,102 @@ class SpreadsheetGrid(UIElement):
             try:
                 Cell.setRaw(row, col, sender.text)
             except:
+                # the cell's old value is gone (it's stored as text), so its
+                # dependents still need recalculating below
                 sender.setOutputText('SYNTAX-ERROR')
-                return  # if we've already got a syntax error, don't try to eval
-
-            if Cell.hasFormula(row, col):
-                # This is already being rendered by the cell on deactivation
-                self.renderCell(row, col, explicitRerender=False)
             else:
-                sender.setOutputText(None)
+                if Cell.hasFormula(row, col):
+                    # This is already being rendered by the cell on
+                    # deactivation
+                    self.renderCell(row, col, explicitRerender=False)
+                else:
+                    sender.setOutputText(None)
 
-        for cellRef in Cell.getDependents(row, col):
-            depRow, depCol = cellRef.row, cellRef.col
-            if self.absPosIsVisible(depRow, depCol):
-                self.renderCell(depRow, depCol)
+        # every edit also starts a new recalculation epoch (e.g., for RAND)
+        if self.engineWorker is not None:
+            self.engineWorker.recalculate(row, col)
+            self.watchWorker()
+        else:
+            self.recalculate(Cell.getRecalcOrder(row, col)
+                             + Cell.startVolatileEpoch())
+
+    # recomputes volatile formulae (e.g., RAND), which otherwise keep their
+    # values until the next edit
+    def recalculateVolatile(self):
+        if self.engineWorker is not None:
+            self.engineWorker.recalculateVolatile()
+            self.watchWorker()
+        else:
+            self.recalculate(Cell.startVolatileEpoch())
+
+    # Recomputes the given cells (in recalculation order) a few milliseconds
+    # at a time from the event loop, so the UI stays responsive however big
+    # the recalculation is, repainting cells as each slice finishes. A
+    # recalculation still in progress is replaced by this one (which takes
+    # over whatever it hadn't gotten to).
+    def recalculate(self, cellRefs):
+        self.recalculation = SlicedRecalculation.replacing(self.recalculation,
+                                                           cellRefs)
+        # small recalculations are done in the first slice, right away
+        self.recalculateSlice()
+
+    def recalculateSlice(self):
+        if self.recalculation is None:
+            return  # (dropped, e.g., by reload)
+        # only repaint dependents whose values actually changed
+        self.renderChangedCells(self.recalculation.step())
+        if self.recalculation.isDone():
+            self.recalculation = None
+        else:
+            self.runLater('recalculate', self.recalculateSlice)
         self.updatePreview()
 
+    # checks for the engine worker's batches from the event loop until it's
+    # done with everything posted to it (so nothing polls while it's idle)
+    def watchWorker(self):
+        if self.workerProgress is None:
+            self.workerProgress = 0.0
+            self.updatePreview()
+        self.runLater('engineWorker', self.showWorkerBatches,
+                      SpreadsheetGrid.workerPollDelay)
+
+    # shows the values the engine worker has recomputed since last time;
+    # each batch's values are from the same moment, so they're shown as is
+    # rather than read again
+    def showWorkerBatches(self):
+        # (checked first: once it's not busy, every batch has been posted)
+        busy = self.engineWorker.isBusy()
+        batches = self.engineWorker.getBatches()
+        for batch in batches:
+            if batch.engine is not Cell.getEngine():
+                continue  # (a sheet that's no longer open)
+            for cellRef, value in batch.values:
+                if self.absPosIsVisible(cellRef.row, cellRef.col):
+                    cell = self.getChildForAbsRowCol(cellRef.row, cellRef.col)
+                    cell.setOutputText(str(value))
+                    cell.rerender()
+            self.workerProgress = None if batch.done else batch.progress
+        if busy:
+            self.runLater('engineWorker', self.showWorkerBatches,
+                          SpreadsheetGrid.workerPollDelay)
+        else:
+            self.workerProgress = None
+        if batches or not busy:
+            self.updatePreview()
+
+    # how much of the recalculation in progress is done (from 0 to 1), or
+    # None if there isn't one
+    def recalculationProgress(self):
+        if self.recalculation is not None:
+            return self.recalculation.progress()
+        return self.workerProgress
+
+    # repaints the visible cells among the given CellRefs
+    def renderChangedCells(self, cellRefs):
+        for cellRef in cellRefs:
+            if self.absPosIsVisible(cellRef.row, cellRef.col):
+                self.renderCell(cellRef.row, cellRef.col)
+
     def renderCell(self, row, col, explicitRerender=True):
         cell = self.getChildForAbsRowCol(row, col)
         cell.setOutputText(str(Cell.getValue(row, col)))
@@ -220,7 +326,20 @@ class SpreadsheetGrid(UIElement):
             return
 
         row, col = self.absRowColFromCellName(self.activeCell.name)
-        for depRef in Cell.getShallowDependencies(row, col):
+        depRefs = []
+        for dependency in Cell.getShallowDependencies(row, col):
+            if dependency.isRange:
+                # only expand the part of the range that's on screen
+                visibleRange = dependency.clippedTo(
+                    self.curTopRow, self.curLeftCol,
+                    self.curTopRow + self.numRows - 1,
+                    self.curLeftCol + self.numCols - 1)
+                if visibleRange is not None:
+                    depRefs += visibleRange.cellRefs()
+            else:
+                depRefs.append(dependency)
+
+        for depRef in depRefs:
             if self.absPosIsVisible(depRef.row, depRef.col):
                 child = self.getChildForAbsRowCol(depRef.row, depRef.col)
                 child.highlight('orange')
@@ -309,7 +428,10 @@ class SpreadsheetGrid(UIElement):
 
     def updatePreview(self):
         preview = self.getChild('preview')
-        if len(self.selectedCells) == 0:
+        progress = self.recalculationProgress()
+        if progress is not None:
+            preview.setText(f'Calculating... {int(progress * 100)}%')
+        elif len(self.selectedCells) == 0:
             preview.setText('')
         elif len(self.selectedCells) == 1:
             selectedRow, selectedCol = self.absRowColFromCellName(
@@ -358,6 +480,8 @@ class SpreadsheetGrid(UIElement):
             self.insertChart(ChartType.BAR)
         elif event.key == 'r' and event.commandDown:
             self.transposeSelection()
+        elif event.key == 'F9':
+            self.recalculateVolatile()
 
     def navigate(self, arrowDir, blockSelect=False):
         if self.selectedCells == []:
@@ -417,6 +541,7 @@ class SpreadsheetGrid(UIElement):
                 absCol = upperLeft.col + col
                 oldValues[absRow, absCol] = Cell.getRaw(absRow, absCol)
 
+        newValues = {}
         for row in range(squareSize):
             for col in range(squareSize):
                 # Don't wipe out cells that aren't in orig OR transpose
@@ -428,13 +553,28 @@ class SpreadsheetGrid(UIElement):
                     trgCol = upperLeft.col + row
                     # swap transposed cells, or clear out ones that were
                     # part of the original but aren't part of the transpose
-                    cellToUpdate = self.getChildForAbsRowCol(trgRow, trgCol)
-                    newVal = oldValues.get((srcRow, srcCol), '')
-                    # this does error handling, dependency updating, etc. for us
-                    # note, however, that it assumes the cell has already
-                    # re-rendered, so we'll have to do that manually afterward
-                    cellToUpdate.setText(newVal)
-                    cellToUpdate.rerender()
+                    newValues[trgRow, trgCol] = oldValues.get((srcRow, srcCol),
+                                                              '')
+        self.saveCells(newValues)
+
+    # Sets many cells' text at once (with '' clearing a cell), recalculating
+    # their dependents just once, then repaints them and whatever changed
+    def saveCells(self, newValues):
+        changed = Cell.setRawMany({pos: newValues[pos] or None
+                                   for pos in newValues})
+        for row, col in newValues:
+            if self.absPosIsVisible(row, col):
+                uiCell = self.getChildForAbsRowCol(row, col)
+                uiCell.setText(newValues[row, col], notify=False)
+                if Cell.hasFormula(row, col):
+                    uiCell.setOutputText(str(Cell.getValue(row, col)))
+                elif newValues[row, col].startswith('='):
+                    uiCell.setOutputText('SYNTAX-ERROR')
+                else:
+                    uiCell.setOutputText(None)
+                uiCell.rerender()
+        self.renderChangedCells(changed)
+        self.recalculateVolatile()
 
     def startImport(self):
         if len(self.selectedCells) == 0:
@@ -454,20 +594,18 @@ class SpreadsheetGrid(UIElement):
             return False
 
         curRow, curCol = selRow, selCol
+        newValues = {}
         for row in table.rows:
             for cell in row:
                 text = cell  # Tables want to be immutable
                 while len(text) > 0 and text[0] == '=':
                     # No arbitrary code execution!
                     text = text[1:]
-                Cell.setRaw(curRow, curCol, text)  # safe b/c no formulae
-                if self.absPosIsVisible(curRow, curCol):
-                    uiCell = self.getChildForAbsRowCol(curRow, curCol)
-                    uiCell.setOutputText(None)
-                    uiCell.setText(text)
+                newValues[curRow, curCol] = text  # safe b/c no formulae
                 curCol += 1
             curRow += 1
             curCol = selCol
+        self.saveCells(newValues)
         return True
 
     # returns a tuple of the currently selected column indices (absolute,
@@ -551,6 +689,7 @@ class SpreadsheetGrid(UIElement):
     # adds a chart to our app state and then appends it to the view
     def addChart(self, chartData):
         self.charts.append(chartData)
+        self.updateDemanded()
         self.appendChartChild(chartData)
 
     # appends a chart to the view based on chart data
@@ -587,6 +726,7 @@ class SpreadsheetGrid(UIElement):
         while i < len(self.charts):
             if self.charts[i].ident == ident:
                 self.charts.pop(i)
+                self.updateDemanded()
                 return
             i += 1
 
@@ -637,6 +777,10 @@ class SpreadsheetGrid(UIElement):
         self.selectedCells = []
         self.highlighted = []
         self.activeCell = None
+        # the other sheet's cells are left out of date, which is fine (they're
+        # recomputed when read)
+        self.recalculation = None
+        self.workerProgress = None
         self.curLeftCol = 0
         self.curTopRow = 0
         self.charts = charts
@@ -159,11 +159,13 @@ class UICell(DoubleClickable, UIElement):
         self._renderText(True)
 
     # Sets the text the text field holds
-    def setText(self, text):
+    # (pass notify=False if whoever's listening already knows, e.g., if they
+    # set the text themselves)
+    def setText(self, text, notify=True):
         self.text = str(text)
         self._renderText(self.active)
         # Our text has changed -- notify!
-        if 'onChange' in self.props:
+        if notify and 'onChange' in self.props:
             self.props['onChange'](self)
 
     # Sets the output text for a text field containing a formula